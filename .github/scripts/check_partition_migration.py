@@ -0,0 +1,69 @@
+"""
+CI check of payments migration 0013 (partitioning payments_webhookevent) on a populated table:
+migrate an empty Postgres database to 0012, store events across a year and beyond the months
+the migration creates partitions for, run the remaining migrations and check that every row
+survived, event ids are still unique, and ensure_partitions moves DEFAULT rows out.
+
+    DATABASE_URL=postgres://.../migration_check python .github/scripts/check_partition_migration.py
+"""
+import os, sys
+from datetime import timedelta
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[2]))
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "config.settings")
+
+import django
+django.setup()
+
+from django.db import IntegrityError, connection, transaction
+from django.db.migrations.executor import MigrationExecutor
+from django.utils import timezone
+
+BEFORE = [("payments", "0012_webhookevent_sweeper")]
+
+def _count(table: str) -> int:
+    with connection.cursor() as cur:
+        cur.execute(f"SELECT count(*) FROM {table}")
+        return cur.fetchone()[0]
+
+def main():
+    if connection.vendor != "postgresql":
+        sys.exit("needs a Postgres DATABASE_URL")
+    executor = MigrationExecutor(connection)
+    executor.migrate(BEFORE)
+    apps = executor.loader.project_state(BEFORE).apps
+    school = apps.get_model("schools", "School").objects.create(name="CI", code="ci")
+    acct = apps.get_model("payments", "AggregatorAccount").objects.create(school=school, provider="SUREPAY")
+    Event = apps.get_model("payments", "WebhookEvent")
+    now = timezone.now()
+    # the last one is past the migration's MONTHS_AHEAD, so it lands in the DEFAULT partition
+    times = [now - timedelta(days=d) for d in (400, 200, 35, 0)] + [now + timedelta(days=200)]
+    Event.objects.bulk_create([Event(aggregator_account=acct, provider="SUREPAY", event_id=f"e{i}",
+                                     payload={"n": i}, received_at=t) for i, t in enumerate(times)])
+
+    executor = MigrationExecutor(connection)
+    executor.migrate(executor.loader.graph.leaf_nodes())
+
+    from payments import partitions
+    from payments.models import WebhookEvent
+    assert partitions.is_partitioned()
+    assert sorted(WebhookEvent.objects.values_list("event_id", flat=True)) == [f"e{i}" for i in range(len(times))]
+    assert _count(partitions.KEY_TABLE) == len(times)
+    assert _count(partitions.DEFAULT) == 1
+    try:
+        with transaction.atomic():
+            WebhookEvent.objects.create(aggregator_account_id=acct.id, provider="SUREPAY", event_id="e0")
+        sys.exit("duplicate event id was accepted")
+    except IntegrityError:
+        pass
+    latest = WebhookEvent.objects.create(aggregator_account_id=acct.id, provider="SUREPAY", event_id="new")
+    assert latest.id > max(WebhookEvent.objects.exclude(id=latest.id).values_list("id", flat=True))
+
+    partitions.ensure_partitions(months_ahead=8)
+    assert _count(partitions.DEFAULT) == 0
+    assert WebhookEvent.objects.count() == len(times) + 1
+    print("migration 0013 ok:", len(partitions.partitions()), "partitions")
+
+if __name__ == "__main__":
+    main()
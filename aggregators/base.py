@@ -1,6 +1,8 @@
 # aggregators/base.py
 from abc import ABC, abstractmethod
 class AggregatorAdapter(ABC):
+    # Bump when parse_webhook output changes so stored canonical events get re-parsed
+    version = "2"
     def __init__(self, account):
         self.account = account
     @abstractmethod
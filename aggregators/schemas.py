@@ -1,4 +1,5 @@
 # aggregators/schemas.py
+from datetime import datetime
 from decimal import Decimal
 from pydantic import BaseModel, Field, field_validator
 from payments.enums import PaymentNarration
@@ -11,6 +12,8 @@ class CanonicalPaymentEvent(BaseModel):
     currency: str = Field(min_length=3, max_length=3)
     status: str
     narration: PaymentNarration = Field(default=PaymentNarration.OTHER)
+    # when the provider says the status happened; orders out-of-order deliveries
+    occurred_at: datetime | None = None
     raw: dict
 
     @field_validator("amount")
@@ -25,4 +28,27 @@ class CanonicalPaymentEvent(BaseModel):
     def currency_upper_3(cls, v):
         u = (v or "").upper()
         if len(u) != 3: raise ValueError("currency must be 3 letters")
-        return u
\ No newline at end of file
+        return u
+
+def to_compact(canonical: dict) -> dict:
+    """Canonical event without `raw`, JSON-safe for storing on WebhookEvent.canonical."""
+    return {
+        "event_id": canonical["event_id"],
+        "external_txn_id": canonical["external_txn_id"],
+        "provider_student_id": canonical["provider_student_id"],
+        "amount": str(canonical["amount"]),
+        "currency": canonical["currency"],
+        "status": canonical["status"],
+        "narration": str(canonical.get("narration") or PaymentNarration.OTHER),
+        "occurred_at": canonical["occurred_at"].isoformat() if canonical.get("occurred_at") else None,
+    }
+
+def from_compact(data: dict, raw: dict) -> dict:
+    """Inverse of to_compact; `raw` is attached by reference (no copy)."""
+    return {
+        **data,
+        "amount": Decimal(data["amount"]),
+        "narration": PaymentNarration(data.get("narration") or PaymentNarration.OTHER.value),
+        "occurred_at": datetime.fromisoformat(data["occurred_at"]) if data.get("occurred_at") else None,
+        "raw": raw,
+    }
@@ -31,6 +31,7 @@ class SurepayAdapter(AggregatorAdapter):
             currency=(payload.get("currency") or "UGX"),
             status=status_map.get((payload.get("status") or "").upper(), PaymentStatus.PENDING.value),
             narration=narration_map.get((payload.get("narration") or "").lower(), PaymentNarration.OTHER),
+            occurred_at=payload.get("occurred_at") or None,
             raw=payload,
         )
         return model.model_dump()
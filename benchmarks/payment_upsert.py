@@ -0,0 +1,82 @@
+"""
+Rows/sec of the Payment write in process_event: the old select_for_update().get_or_create()
+plus unconditional save() vs payments.processing.upsert_payment (the hash-checked ORM path and,
+on Postgres, the single INSERT ... ON CONFLICT statement behind PAYMENT_UPSERT_SQL).
+
+Runs against the configured DATABASE_URL, one transaction per row like the Celery task:
+
+    DATABASE_URL=postgres://... python benchmarks/payment_upsert.py --rows 5000
+
+Three phases per implementation: fresh inserts, identical re-deliveries (the retry-storm case)
+and status changes. Rows are created under a throwaway school and deleted afterwards.
+"""
+import argparse, os, sys, time, uuid
+from decimal import Decimal
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "config.settings")
+
+import django
+django.setup()
+
+from django.conf import settings
+from django.db import connection, transaction
+from payments.models import AggregatorAccount, PayloadBlob, Payment, WebhookEvent
+from payments.processing import PAYMENT_INSERT_FIELDS, _new_payment, upsert_payment
+from schools.models import School
+
+def legacy_upsert(new: Payment):
+    PayloadBlob.objects.store_pending([new])
+    p, created = Payment.objects.select_for_update().get_or_create(
+        provider=new.provider, external_txn_id=new.external_txn_id,
+        defaults={f: getattr(new, f) for f in PAYMENT_INSERT_FIELDS},
+    )
+    if not created:
+        p.status, p.amount, p.currency, p.narration, p.raw = new.status, new.amount, new.currency, new.narration, new.raw
+        p.save(update_fields=["status", "amount", "currency", "narration", "raw_blob_id", "raw_json", "student",
+                              "school_student_id", "updated_at"])
+
+def _payments(event, prefix, rows, status):
+    for i in range(rows):
+        canonical = {
+            "external_txn_id": f"{prefix}-{i}", "provider_student_id": "bench-student",
+            "amount": Decimal("1000"), "currency": "UGX", "status": status, "narration": "Fees",
+            "raw": {"transaction_id": f"{prefix}-{i}", "status": status, "amount": 1000, "meta": {"channel": "mobile"}},
+        }
+        yield _new_payment(event, canonical, None, "", False)
+
+def _phase(fn, payments) -> float:
+    payments = list(payments)
+    started = time.perf_counter()
+    for p in payments:
+        with transaction.atomic():
+            fn(p)
+    return len(payments) / (time.perf_counter() - started)
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--rows", type=int, default=2000)
+    args = ap.parse_args()
+
+    school = School.objects.create(name="bench", code=f"bench-{uuid.uuid4().hex[:8]}")
+    acct = AggregatorAccount.objects.create(school=school, provider="SUREPAY")
+    event = WebhookEvent(aggregator_account=acct, provider="SUREPAY", event_id="bench", payload={})
+    print(f"database: {connection.vendor}, rows per phase: {args.rows}")
+    print(f"{'implementation':<20} {'insert/s':>10} {'duplicate/s':>12} {'change/s':>10}")
+    try:
+        runs = [("get_or_create", legacy_upsert, False), ("upsert_payment", upsert_payment, False)]
+        if connection.vendor == "postgresql":
+            runs.append(("upsert_payment sql", upsert_payment, True))
+        for name, fn, sql in runs:
+            settings.PAYMENT_UPSERT_SQL = sql
+            prefix = f"{name}-{uuid.uuid4().hex[:8]}"
+            inserted = _phase(fn, _payments(event, prefix, args.rows, "PENDING"))
+            duplicate = _phase(fn, _payments(event, prefix, args.rows, "PENDING"))
+            changed = _phase(fn, _payments(event, prefix, args.rows, "SUCCEEDED"))
+            print(f"{name:<20} {inserted:>10.0f} {duplicate:>12.0f} {changed:>10.0f}")
+    finally:
+        school.delete()
+
+if __name__ == "__main__":
+    main()
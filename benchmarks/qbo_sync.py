@@ -0,0 +1,147 @@
+"""
+Payments synced to QuickBooks per second for one realm: sync_payment_to_qbo (one task per
+payment, run from a thread pool like a `-P threads` worker) vs the /batch path (qbo.batch).
+
+QBOClient talks to an in-process stand-in for the QBO API that answers every request after
+--latency-ms, so the numbers reflect the client (pooled keep-alive session, gzip, the per-realm
+rate limiter) rather than Intuit's sandbox:
+
+    DATABASE_URL=postgres://... python benchmarks/qbo_sync.py --payments 300 --concurrency 8
+
+The realm is paced by qbo.ratelimit at --rate-limit requests a minute (QBO_RATE_LIMIT_PER_MINUTE
+by default). Rows are created under a throwaway school and deleted afterwards.
+"""
+import argparse, gzip, itertools, json, os, sys, threading, time, uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "config.settings")
+
+import django
+django.setup()
+
+from django.conf import settings
+from django.db import connection, connections
+from django.utils import timezone
+from payments.models import Payment
+from schools.models import QBOConnection, School
+import qbo.client
+from qbo import customers, ratelimit
+from qbo.batch import sync_batch
+from qbo.sessions import close_sessions
+from qbo.tasks import sync_payment_to_qbo
+
+ENTITIES = {"salesreceipt": "SalesReceipt", "payment": "Payment"}
+
+class StandIn(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    latency = 0.0
+    ids = itertools.count(1)
+    calls = 0
+
+    def _send(self, data):
+        type(self).calls += 1
+        time.sleep(self.latency)
+        body = json.dumps(data).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        if "gzip" in self.headers.get("Accept-Encoding", ""):
+            body = gzip.compress(body)
+            self.send_header("Content-Encoding", "gzip")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        self._send({"QueryResponse": {}})
+
+    def do_POST(self):
+        raw = self.rfile.read(int(self.headers["Content-Length"]))
+        if self.headers.get("Content-Encoding") == "gzip":
+            raw = gzip.decompress(raw)
+        body = json.loads(raw)
+        path = self.path.split("?", 1)[0].rsplit("/", 1)[-1]
+        if path == "batch":
+            out = []
+            for item in body["BatchItemRequest"]:
+                entity = next(k for k in item if k not in ("bId", "operation"))
+                out.append({"bId": item["bId"], entity: {**item[entity], "Id": str(next(self.ids))}})
+            self._send({"BatchItemResponse": out})
+        else:
+            self._send({ENTITIES[path]: {**body, "Id": str(next(self.ids))}})
+
+    def log_message(self, *args):
+        pass
+
+def _payments(school, n):
+    prefix = uuid.uuid4().hex[:8]
+    return Payment.objects.bulk_create([
+        Payment(school=school, provider="SUREPAY", external_txn_id=f"bench-{prefix}-{i}", provider_student_id="bench-student",
+                amount=1000, currency="UGX", status="SUCCEEDED", narration="Fees")
+        for i in range(n)
+    ])
+
+def _task(payment_id):
+    try:
+        sync_payment_to_qbo(payment_id=payment_id)
+    finally:
+        connections.close_all()
+
+def run_tasks(school, n, concurrency) -> float:
+    ids = [p.id for p in _payments(school, n)]
+    started = time.perf_counter()
+    with ThreadPoolExecutor(concurrency) as pool:
+        list(pool.map(_task, ids))
+    return n / (time.perf_counter() - started)
+
+def run_batch(school, n) -> float:
+    _payments(school, n)
+    started = time.perf_counter()
+    synced = 0
+    while synced < n:
+        done, _ = sync_batch(school)
+        if not done:
+            break
+        synced += done
+    return synced / (time.perf_counter() - started)
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--payments", type=int, default=120)
+    ap.add_argument("--concurrency", type=int, default=8)
+    ap.add_argument("--latency-ms", type=float, default=150)
+    ap.add_argument("--rate-limit", type=int, default=None, help="requests/minute per realm")
+    args = ap.parse_args()
+
+    StandIn.latency = args.latency_ms / 1000
+    server = ThreadingHTTPServer(("127.0.0.1", 0), StandIn)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    qbo.client.API_BASE = f"http://127.0.0.1:{server.server_address[1]}"
+    settings.QBO_SYNC_ENABLED = True
+    if args.rate_limit:
+        settings.QBO_RATE_LIMIT_PER_MINUTE = args.rate_limit
+
+    school = School.objects.create(name="bench", code=f"bench-{uuid.uuid4().hex[:8]}")
+    QBOConnection.objects.create(school=school, realm_id=f"bench-{uuid.uuid4().hex[:8]}", access_token="at",
+                                 refresh_token="rt", token_expires_at=timezone.now() + timedelta(hours=1))
+    school = School.objects.select_related("qbo").get(pk=school.pk)
+    print(f"database: {connection.vendor}, payments: {args.payments}, latency: {args.latency_ms:.0f}ms, "
+          f"rate limit: {ratelimit.current_rate(school.qbo.realm_id)}/min")
+    print(f"{'path':<22} {'payments/s':>11} {'QBO calls':>10}")
+    try:
+        for name, run in ((f"task x{args.concurrency}", lambda: run_tasks(school, args.payments, args.concurrency)),
+                          ("batch", lambda: run_batch(school, args.payments))):
+            customers.clear()
+            StandIn.calls = 0
+            rate = run()
+            print(f"{name:<22} {rate:>11.1f} {StandIn.calls:>10}")
+    finally:
+        school.delete()
+        server.shutdown()
+        close_sessions()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,129 @@
+"""
+Load test for the webhook ingest path: WSGI (DRF) view vs the ASGI view.
+
+Start both servers against the same database and broker, e.g.
+
+    gunicorn config.wsgi -w 4 --threads 8 -b 127.0.0.1:8001
+    uvicorn config.asgi:application --workers 4 --port 8002
+
+create a school + SUREPAY account (code "bench", secret "bench-secret") and run
+
+    python benchmarks/webhook_ingest.py \
+        --wsgi http://127.0.0.1:8001/api/webhooks/SUREPAY \
+        --asgi http://127.0.0.1:8002/api/webhooks/SUREPAY/async \
+        --concurrency 1000 --requests 50000
+
+Each request carries a unique event_id so every one reaches the insert. The client uses
+only the standard library (asyncio streams, HTTP/1.1 keep-alive, one connection per
+concurrent worker) and reports requests/sec and p50/p99 latency per target.
+"""
+import argparse, asyncio, hashlib, hmac, json, time, uuid
+from urllib.parse import urlsplit
+
+def _signed_request(url, school, secret: bytes) -> bytes:
+    parts = urlsplit(url)
+    payload = {
+        "event_id": f"bench-{uuid.uuid4().hex}", "transaction_id": f"bench-{uuid.uuid4().hex}",
+        "amount": 1000, "currency": "UGX", "status": "PENDING", "student_id": "bench-student",
+    }
+    body = json.dumps(payload).encode()
+    sig = hmac.new(secret, body, hashlib.sha256).hexdigest()
+    head = (
+        f"POST {parts.path} HTTP/1.1\r\nHost: {parts.netloc}\r\n"
+        f"Content-Type: application/json\r\nContent-Length: {len(body)}\r\n"
+        f"X-School-Code: {school}\r\nX-Signature: {sig}\r\nConnection: keep-alive\r\n\r\n"
+    )
+    return head.encode() + body
+
+async def _read_response(reader) -> int:
+    status_line = await reader.readline()
+    if not status_line:
+        raise ConnectionError("closed")
+    status = int(status_line.split()[1])
+    length, chunked = 0, False
+    while True:
+        line = await reader.readline()
+        if line in (b"\r\n", b""):
+            break
+        name, _, value = line.decode().partition(":")
+        if name.lower() == "content-length":
+            length = int(value)
+        elif name.lower() == "transfer-encoding" and "chunked" in value.lower():
+            chunked = True
+    if chunked:
+        while True:
+            size = int((await reader.readline()).strip(), 16)
+            await reader.readexactly(size + 2)
+            if size == 0:
+                break
+    elif length:
+        await reader.readexactly(length)
+    return status
+
+async def _worker(url, school, secret, counter, latencies, errors):
+    parts = urlsplit(url)
+    reader = writer = None
+    while counter[0] > 0:
+        counter[0] -= 1
+        request = _signed_request(url, school, secret)
+        started = time.perf_counter()
+        try:
+            if writer is None:
+                reader, writer = await asyncio.open_connection(parts.hostname, parts.port or 80)
+            writer.write(request)
+            await writer.drain()
+            status = await _read_response(reader)
+            if status != 200:
+                errors[status] = errors.get(status, 0) + 1
+        except Exception as exc:
+            errors[type(exc).__name__] = errors.get(type(exc).__name__, 0) + 1
+            if writer is not None:
+                writer.close()
+            reader = writer = None
+            continue
+        latencies.append(time.perf_counter() - started)
+    if writer is not None:
+        writer.close()
+
+def _percentile(sorted_values, pct):
+    if not sorted_values:
+        return float("nan")
+    idx = min(len(sorted_values) - 1, int(round(pct / 100 * (len(sorted_values) - 1))))
+    return sorted_values[idx]
+
+async def run(url, school, secret, concurrency, total) -> dict:
+    counter, latencies, errors = [total], [], {}
+    started = time.perf_counter()
+    await asyncio.gather(*(
+        _worker(url, school, secret, counter, latencies, errors) for _ in range(concurrency)
+    ))
+    elapsed = time.perf_counter() - started
+    latencies.sort()
+    return {
+        "ok": len(latencies),
+        "errors": errors,
+        "rps": len(latencies) / elapsed if elapsed else 0.0,
+        "p50_ms": _percentile(latencies, 50) * 1000,
+        "p99_ms": _percentile(latencies, 99) * 1000,
+    }
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--wsgi", help="URL of the sync view")
+    ap.add_argument("--asgi", help="URL of the async view")
+    ap.add_argument("--school", default="bench")
+    ap.add_argument("--secret", default="bench-secret")
+    ap.add_argument("--concurrency", type=int, default=1000)
+    ap.add_argument("--requests", type=int, default=20000)
+    args = ap.parse_args()
+
+    targets = [(name, url) for name, url in (("wsgi", args.wsgi), ("asgi", args.asgi)) if url]
+    if not targets:
+        ap.error("pass --wsgi and/or --asgi")
+    print(f"{'target':<6} {'ok':>8} {'req/s':>10} {'p50 ms':>9} {'p99 ms':>9}  errors")
+    for name, url in targets:
+        r = asyncio.run(run(url, args.school, args.secret.encode(), args.concurrency, args.requests))
+        print(f"{name:<6} {r['ok']:>8} {r['rps']:>10.1f} {r['p50_ms']:>9.1f} {r['p99_ms']:>9.1f}  {r['errors'] or '-'}")
+
+if __name__ == "__main__":
+    main()
@@ -1,6 +1,7 @@
 # config/celery.py
 import os
 from celery import Celery
+from kombu import Queue
 
 # Make sure Django settings are loaded when Celery starts
 os.environ.setdefault("DJANGO_SETTINGS_MODULE", "config.settings")
@@ -12,3 +13,31 @@ app.config_from_object("django.conf:settings", namespace="CELERY")
 
 # Auto-discover tasks.py in installed apps
 app.autodiscover_tasks()
+
+# Webhook processing is sharded per school (see CELERY_WEBHOOK_SHARDS); everything else is
+# routed by CELERY_TASK_ROUTES onto the queues in CELERY_QUEUE_NAMES.
+WEBHOOK_TASKS = {"payments.tasks.process_webhook_event_task", "payments.tasks.process_webhook_events_batch"}
+
+def webhook_queue(school_id: int | None) -> str:
+    from django.conf import settings
+    shards = int(getattr(settings, "CELERY_WEBHOOK_SHARDS", 1))
+    if school_id is None or shards <= 1:
+        return "webhooks.0"
+    return f"webhooks.{int(school_id) % shards}"
+
+def webhook_queues() -> list[str]:
+    from django.conf import settings
+    return [f"webhooks.{n}" for n in range(max(1, int(getattr(settings, "CELERY_WEBHOOK_SHARDS", 1))))]
+
+def route_task(name, args, kwargs, options, task=None, **kw):
+    if name in WEBHOOK_TASKS:
+        return {"queue": webhook_queue((kwargs or {}).get("school_id"))}
+    return None  # fall through to CELERY_TASK_ROUTES
+
+def _configure_queues():
+    from django.conf import settings
+    names = webhook_queues() + list(getattr(settings, "CELERY_QUEUE_NAMES", []))
+    app.conf.task_queues = [Queue(name) for name in dict.fromkeys(names + [app.conf.task_default_queue])]
+    app.conf.task_routes = (route_task, getattr(settings, "CELERY_TASK_ROUTES", {}))
+
+_configure_queues()
@@ -131,10 +131,159 @@ STATIC_URL = 'static/'
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 WEBHOOK_TIMESTAMP_TOLERANCE = 300 
 
+# Shared cache (Redis) used across web/worker processes; falls back to per-process memory
+CACHE_URL = os.getenv("CACHE_URL", default=None)
+CACHES = {
+    "default": (
+        {"BACKEND": "django.core.cache.backends.redis.RedisCache", "LOCATION": CACHE_URL}
+        if CACHE_URL else
+        {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}
+    ),
+}
+
+# AggregatorAccount lookup cache used by the webhook views
+WEBHOOK_ACCOUNT_CACHE_TTL = int(os.getenv("WEBHOOK_ACCOUNT_CACHE_TTL", "60"))
+WEBHOOK_ACCOUNT_CACHE_SIZE = int(os.getenv("WEBHOOK_ACCOUNT_CACHE_SIZE", "1024"))
+WEBHOOK_ACCOUNT_CACHE_SHARED = os.getenv("WEBHOOK_ACCOUNT_CACHE_SHARED", str(bool(CACHE_URL))).lower() in ("true", "1", "yes")
+
+# Filter of processed (account, event_id) pairs answering retried webhooks without the DB
+WEBHOOK_SEEN_EVENTS_SIZE = int(os.getenv("WEBHOOK_SEEN_EVENTS_SIZE", "100000"))
+WEBHOOK_SEEN_EVENTS_TTL = int(os.getenv("WEBHOOK_SEEN_EVENTS_TTL", str(7 * 86400)))
+WEBHOOK_SEEN_EVENTS_SHARED = os.getenv("WEBHOOK_SEEN_EVENTS_SHARED", str(bool(CACHE_URL))).lower() in ("true", "1", "yes")
+
+# Batch ingest endpoint (/api/webhooks/<provider>/batch)
+WEBHOOK_BATCH_MAX_ITEMS = int(os.getenv("WEBHOOK_BATCH_MAX_ITEMS", "10000"))
+WEBHOOK_BATCH_DISPATCH_SIZE = int(os.getenv("WEBHOOK_BATCH_DISPATCH_SIZE", "200"))
+
+# Durable local spool for webhook ingest: "off", "fallback" (only when the DB errors) or "always".
+# Spooled events are loaded by `manage.py drain_webhook_spool` running next to the web process.
+WEBHOOK_SPOOL_MODE = os.getenv("WEBHOOK_SPOOL_MODE", "off").lower()
+WEBHOOK_SPOOL_DIR = os.getenv("WEBHOOK_SPOOL_DIR", str(BASE_DIR / "var" / "webhook-spool"))
+WEBHOOK_SPOOL_SEGMENT_BYTES = int(os.getenv("WEBHOOK_SPOOL_SEGMENT_BYTES", str(16 * 1024 * 1024)))
+WEBHOOK_SPOOL_SEGMENT_SECONDS = float(os.getenv("WEBHOOK_SPOOL_SEGMENT_SECONDS", "2"))
+
+# Micro-batching of accepted events into process_webhook_events_batch (0 = publish per event, the default:
+# ids buffered by a process that dies wait for the stuck-event sweeper)
+WEBHOOK_DISPATCH_LINGER_MS = float(os.getenv("WEBHOOK_DISPATCH_LINGER_MS", "0"))
+WEBHOOK_DISPATCH_MAX_BATCH = int(os.getenv("WEBHOOK_DISPATCH_MAX_BATCH", "100"))
+
+# Async ingest view (/api/webhooks/<provider>/async): threads for blocking Celery publishes
+WEBHOOK_ASYNC_PUBLISH_THREADS = int(os.getenv("WEBHOOK_ASYNC_PUBLISH_THREADS", "16"))
+
+# Student resolution: in-process LRU, then StudentIdMap, then the school's directory
+STUDENT_RESOLVER_CACHE_TTL = int(os.getenv("STUDENT_RESOLVER_CACHE_TTL", "300"))
+STUDENT_RESOLVER_CACHE_SIZE = int(os.getenv("STUDENT_RESOLVER_CACHE_SIZE", "50000"))
+STUDENT_MAPPING_MAX_AGE = int(os.getenv("STUDENT_MAPPING_MAX_AGE", str(7 * 86400)))  # 0 = never re-check
+
+# School directory HTTP client (per-connection keep-alive pool)
+SCHOOL_API_POOL_SIZE = int(os.getenv("SCHOOL_API_POOL_SIZE", "10"))
+SCHOOL_API_RETRIES = int(os.getenv("SCHOOL_API_RETRIES", "2"))
+SCHOOL_API_MAX_CONCURRENCY = int(os.getenv("SCHOOL_API_MAX_CONCURRENCY", "8"))
+SCHOOL_API_BULK_CHUNK = int(os.getenv("SCHOOL_API_BULK_CHUNK", "200"))
+
+# Directory guard: cached "unknown student" answers, single-flight wait and per-school breaker
+SCHOOL_API_NEGATIVE_TTL = int(os.getenv("SCHOOL_API_NEGATIVE_TTL", "300"))
+SCHOOL_API_SINGLE_FLIGHT_WAIT = int(os.getenv("SCHOOL_API_SINGLE_FLIGHT_WAIT", "5"))
+SCHOOL_API_BREAKER_THRESHOLD = int(os.getenv("SCHOOL_API_BREAKER_THRESHOLD", "5"))
+SCHOOL_API_BREAKER_COOLDOWN = int(os.getenv("SCHOOL_API_BREAKER_COOLDOWN", "60"))
+
+# Celery queues (wired up in config/celery.py). Webhook processing goes to webhooks.<school_id % N>
+# so one school's backlog only holds up the schools sharing its shard; workers take one task at a
+# time so a deep shard can't hoard prefetched work. QBO, enrichment and maintenance run on their
+# own queues and workers so slow third parties never block webhook processing.
+CELERY_WEBHOOK_SHARDS = int(os.getenv("CELERY_WEBHOOK_SHARDS", "8"))
+CELERY_QUEUE_NAMES = ["enrichment", "qbo", "maintenance"]
+CELERY_TASK_DEFAULT_QUEUE = "maintenance"
+CELERY_TASK_ROUTES = {
+    "payments.tasks.reenrich_payments": {"queue": "enrichment"},
+    "qbo.tasks.*": {"queue": "qbo"},
+}
+CELERY_WORKER_PREFETCH_MULTIPLIER = int(os.getenv("CELERY_WORKER_PREFETCH_MULTIPLIER", "1"))
+# Redis priorities: 0 is served first within a queue. Live webhooks publish at 0; bulk work
+# (the stuck-event sweeper, spool drains, re-enrichment) publishes at CELERY_BULK_PRIORITY.
+CELERY_BROKER_TRANSPORT_OPTIONS = {"priority_steps": list(range(10)), "sep": ":", "queue_order_strategy": "round_robin"}
+CELERY_TASK_DEFAULT_PRIORITY = 0
+CELERY_BULK_PRIORITY = 9
+
+# Stuck-event sweeper: re-enqueue events still unprocessed after N minutes, backing off per row
+WEBHOOK_SWEEP_AFTER_MINUTES = int(os.getenv("WEBHOOK_SWEEP_AFTER_MINUTES", "10"))
+WEBHOOK_SWEEP_BATCH = int(os.getenv("WEBHOOK_SWEEP_BATCH", "5000"))
+WEBHOOK_SWEEP_MAX_ATTEMPTS = int(os.getenv("WEBHOOK_SWEEP_MAX_ATTEMPTS", "8"))
+WEBHOOK_SWEEP_BACKOFF_SECONDS = int(os.getenv("WEBHOOK_SWEEP_BACKOFF_SECONDS", "60"))
+WEBHOOK_SWEEP_BACKOFF_MAX_SECONDS = int(os.getenv("WEBHOOK_SWEEP_BACKOFF_MAX_SECONDS", str(6 * 3600)))
+
+# WebhookEvent monthly partitions (Postgres): created ahead by beat, archived after the retention window
+WEBHOOK_PARTITION_MONTHS_AHEAD = int(os.getenv("WEBHOOK_PARTITION_MONTHS_AHEAD", "3"))
+WEBHOOK_RETENTION_MONTHS = int(os.getenv("WEBHOOK_RETENTION_MONTHS", "13"))
+WEBHOOK_ARCHIVE_DIR = os.getenv("WEBHOOK_ARCHIVE_DIR", str(BASE_DIR / "var" / "webhook-archive"))
+
+# Unreferenced payload blobs are pruned once untouched for this long
+PAYLOAD_BLOB_GRACE_DAYS = int(os.getenv("PAYLOAD_BLOB_GRACE_DAYS", "7"))
+
+# Postgres: upsert a payment with one INSERT ... ON CONFLICT statement instead of a locked ORM read-modify-write
+# (ignored on other databases, which always take the ORM path)
+PAYMENT_UPSERT_SQL = os.getenv("PAYMENT_UPSERT_SQL", "True").lower() in ("true", "1", "yes")
+
+CELERY_BEAT_SCHEDULE = {
+    # payments recorded while a school's directory was unavailable
+    "reenrich-payments": {"task": "payments.tasks.reenrich_payments", "schedule": 60.0,
+                          "options": {"priority": CELERY_BULK_PRIORITY}},
+    "sweep-stuck-webhook-events": {"task": "payments.tasks.sweep_stuck_events", "schedule": 60.0},
+    "create-webhook-partitions": {"task": "payments.tasks.create_webhook_partitions", "schedule": 6 * 3600.0},
+    "prune-payload-blobs": {"task": "payments.tasks.prune_payload_blobs", "schedule": 24 * 3600.0},
+    "sync-pending-qbo": {"task": "qbo.tasks.sync_pending_to_qbo", "schedule": 60.0},
+    # QBO sync is dispatched from the payments outbox; processing kicks it too, this catches lost kicks
+    "relay-payment-outbox": {"task": "qbo.tasks.relay_payment_outbox",
+                             "schedule": float(os.getenv("QBO_OUTBOX_RELAY_SECONDS", "5"))},
+    "prune-payment-outbox": {"task": "qbo.tasks.prune_payment_outbox", "schedule": 24 * 3600.0},
+    # payments parked with qbo_sync_error go back in the outbox after QBO_PARKED_RETRY_SECONDS
+    "retry-parked-qbo-payments": {"task": "qbo.tasks.retry_parked_payments", "schedule": 3600.0,
+                                  "options": {"priority": CELERY_BULK_PRIORITY}},
+    "refresh-qbo-tokens": {"task": "qbo.tasks.refresh_qbo_tokens", "schedule": 60.0},
+    # QBO open-invoice cache, kept current through ChangeDataCapture
+    "sync-qbo-invoices": {"task": "qbo.tasks.sync_qbo_invoices",
+                          "schedule": float(os.getenv("QBO_INVOICE_CDC_SECONDS", "300"))},
+}
+
 
 QBO_SYNC_ENABLED = os.getenv("QBO_SYNC_ENABLED", "False").lower() in ("true", "1", "yes")
 QBO_CLIENT_ID = os.getenv("QBO_CLIENT_ID", default=None)
 QBO_CLIENT_SECRET = os.getenv("QBO_CLIENT_SECRET", default=None)
 QBO_REDIRECT_URI = os.getenv("QBO_REDIRECT_URI", default="http://localhost:8000/api/qbo/callback")
 QBO_WEBHOOK_SECRET = os.getenv("QBO_WEBHOOK_SECRET", default=None)
-QBO_IS_SANDBOX = os.getenv("QBO_IS_SANDBOX", "True").lower() in ("true", "1", "yes")
\ No newline at end of file
+QBO_IS_SANDBOX = os.getenv("QBO_IS_SANDBOX", "True").lower() in ("true", "1", "yes")
+
+# "task": one sync_payment_to_qbo per succeeded payment; "batch": they go through /batch per school
+QBO_SYNC_MODE = os.getenv("QBO_SYNC_MODE", "task")
+QBO_BATCH_MAX_PAYMENTS = int(os.getenv("QBO_BATCH_MAX_PAYMENTS", "3000"))
+QBO_BATCH_LOCK_SECONDS = int(os.getenv("QBO_BATCH_LOCK_SECONDS", "600"))
+QBO_SALES_ITEM_ID = os.getenv("QBO_SALES_ITEM_ID", "1")
+# entries per in-process student/name -> QBO customer map (qbo.customers)
+QBO_CUSTOMER_CACHE_SIZE = int(os.getenv("QBO_CUSTOMER_CACHE_SIZE", "20000"))
+
+# Access tokens: cached across workers, refreshed single-flight per realm and ahead of expiry by beat
+QBO_TOKEN_SKEW_SECONDS = int(os.getenv("QBO_TOKEN_SKEW_SECONDS", "60"))
+QBO_TOKEN_REFRESH_AHEAD = int(os.getenv("QBO_TOKEN_REFRESH_AHEAD", "300"))
+QBO_TOKEN_LOCK_SECONDS = int(os.getenv("QBO_TOKEN_LOCK_SECONDS", "30"))
+QBO_TOKEN_LOCK_WAIT = float(os.getenv("QBO_TOKEN_LOCK_WAIT", "10"))
+
+
+# Per-realm pacing of QBO calls (qbo.ratelimit): AIMD rate under QBO's ~500/min, in-flight cap, Retry-After pauses
+QBO_RATE_LIMIT_PER_MINUTE = int(os.getenv("QBO_RATE_LIMIT_PER_MINUTE", "450"))
+QBO_RATE_MIN_PER_MINUTE = int(os.getenv("QBO_RATE_MIN_PER_MINUTE", "60"))
+QBO_RATE_INCREASE = int(os.getenv("QBO_RATE_INCREASE", "10"))
+QBO_MAX_CONCURRENT = int(os.getenv("QBO_MAX_CONCURRENT", "10"))
+QBO_RATE_MAX_WAIT = float(os.getenv("QBO_RATE_MAX_WAIT", "10"))
+QBO_THROTTLE_MAX_RETRIES = int(os.getenv("QBO_THROTTLE_MAX_RETRIES", "20"))
+
+# QBO HTTP: pooled keep-alive session per realm, retries for connection errors and 5xx, gzip bodies from this size
+QBO_CONNECT_TIMEOUT = float(os.getenv("QBO_CONNECT_TIMEOUT", "5"))
+QBO_READ_TIMEOUT = float(os.getenv("QBO_READ_TIMEOUT", "60"))
+QBO_RETRIES = int(os.getenv("QBO_RETRIES", "2"))
+QBO_GZIP_MIN_BYTES = int(os.getenv("QBO_GZIP_MIN_BYTES", "1024"))
+
+# Payments outbox relayed to QBO sync (qbo.tasks.relay_payment_outbox)
+QBO_OUTBOX_BATCH_SIZE = int(os.getenv("QBO_OUTBOX_BATCH_SIZE", "500"))
+QBO_OUTBOX_RETENTION_DAYS = int(os.getenv("QBO_OUTBOX_RETENTION_DAYS", "7"))
+# how long a payment parked with qbo_sync_error waits before qbo.tasks.retry_parked_payments requeues it
+QBO_PARKED_RETRY_SECONDS = int(os.getenv("QBO_PARKED_RETRY_SECONDS", str(6 * 3600)))
\ No newline at end of file
@@ -17,6 +17,7 @@ Including another URLconf
 from django.contrib import admin
 from django.urls import path, include
 from django.http import JsonResponse
+from webhooks.views import webhook_metrics
 
 def health_check(request):
     return JsonResponse({"status": "ok"})
@@ -26,4 +27,5 @@ urlpatterns = [
     path("api/webhooks/", include("webhooks.urls")),
     path("api/qbo/", include("qbo.urls")),
     path('health/', health_check),
+    path('metrics/webhooks/', webhook_metrics),
 ]
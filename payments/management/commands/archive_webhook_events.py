@@ -0,0 +1,86 @@
+import gzip, json, os
+from datetime import datetime, timezone as dt_timezone
+from pathlib import Path
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.core.serializers.json import DjangoJSONEncoder
+from payments.models import PayloadBlob, WebhookEvent
+from payments.partitions import add_months, drop_partition, expired_partitions, is_partitioned, month_start, retention_cutoff
+
+def _utc(month) -> datetime:
+    return datetime(month.year, month.month, 1, tzinfo=dt_timezone.utc)
+
+class Command(BaseCommand):
+    help = ("Stream WebhookEvents older than the retention window to gzipped NDJSON, one file per month, "
+            "then drop them (detach + drop the month's partition on Postgres).")
+
+    def add_arguments(self, parser):
+        parser.add_argument("--retention-months", type=int, default=getattr(settings, "WEBHOOK_RETENTION_MONTHS", 13))
+        parser.add_argument("--dir", default=getattr(settings, "WEBHOOK_ARCHIVE_DIR",
+                                                     str(Path(settings.BASE_DIR) / "var" / "webhook-archive")))
+        parser.add_argument("--batch-size", type=int, default=2000)
+        parser.add_argument("--dry-run", action="store_true", help="Only list what would be archived.")
+
+    def handle(self, *args, **opts):
+        partitioned = is_partitioned()
+        if partitioned:
+            months = expired_partitions(opts["retention_months"])
+        else:
+            cutoff = _utc(retention_cutoff(opts["retention_months"]))
+            months = sorted({month_start(d) for d in WebhookEvent.objects.filter(received_at__lt=cutoff)
+                             .datetimes("received_at", "month", tzinfo=dt_timezone.utc)})
+        if not months:
+            self.stdout.write("nothing to archive")
+            return
+
+        out_dir = Path(opts["dir"])
+        for month in months:
+            qs = WebhookEvent.objects.filter(received_at__gte=_utc(month), received_at__lt=_utc(add_months(month, 1)))
+            path = out_dir / f"webhookevents-{month:%Y-%m}.ndjson.gz"
+            if opts["dry_run"]:
+                self.stdout.write(f"dry run: {month:%Y-%m}: {qs.count()} events -> {path}")
+                continue
+            written = self._export(qs, path, opts["batch_size"])
+            # rows that arrived during the export would be lost by the drop
+            if qs.count() != written:
+                raise CommandError(f"{month:%Y-%m} changed during export; re-run to archive it")
+            if partitioned:
+                drop_partition(month)
+            else:
+                self._delete(qs, opts["batch_size"])
+            self.stdout.write(f"{month:%Y-%m}: archived {written} events to {path}")
+
+    def _export(self, qs, path: Path, batch_size: int) -> int:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = path.with_name(path.name + ".part")
+        n = 0
+        with open(tmp, "wb") as raw:
+            with gzip.GzipFile(fileobj=raw, mode="wb") as gz:
+                # a server-side cursor on Postgres, so a month never sits in memory
+                rows = []
+                for row in qs.order_by("id").values().iterator(chunk_size=batch_size):
+                    rows.append(row)
+                    if len(rows) >= batch_size:
+                        n += self._write(gz, rows)
+                        rows = []
+                n += self._write(gz, rows)
+            raw.flush()
+            os.fsync(raw.fileno())
+        tmp.replace(path)
+        return n
+
+    def _write(self, gz, rows: list[dict]) -> int:
+        # archive files carry the payload itself, not a reference to a blob that may be pruned
+        blobs = PayloadBlob.objects.load_many(r["payload_blob_id"] for r in rows if r["payload_blob_id"])
+        for row in rows:
+            digest, legacy = row.pop("payload_blob_id"), row.pop("payload_json")
+            row["payload"] = blobs[digest] if digest else legacy
+            gz.write(json.dumps(row, cls=DjangoJSONEncoder).encode() + b"\n")
+        return len(rows)
+
+    def _delete(self, qs, batch_size: int):
+        while True:
+            ids = list(qs.values_list("id", flat=True)[:batch_size])
+            if not ids:
+                return
+            WebhookEvent.objects.filter(id__in=ids).delete()
@@ -0,0 +1,48 @@
+import time
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from payments.models import PayloadBlob, Payment, WebhookEvent, encode_payload
+
+# (model, blob foreign key, legacy JSON column)
+TARGETS = {
+    "events": (WebhookEvent, "payload_blob", "payload_json"),
+    "payments": (Payment, "raw_blob", "raw_json"),
+}
+
+class Command(BaseCommand):
+    help = ("Move WebhookEvent.payload and Payment.raw JSON columns into the content-addressed PayloadBlob "
+            "store, in id-ordered batches. Safe to interrupt and re-run.")
+
+    def add_arguments(self, parser):
+        parser.add_argument("--only", choices=sorted(TARGETS))
+        parser.add_argument("--batch-size", type=int, default=1000)
+        parser.add_argument("--dry-run", action="store_true", help="Only count the rows still to convert.")
+
+    def handle(self, *args, **opts):
+        for name, (model, fk, legacy) in TARGETS.items():
+            if opts["only"] and opts["only"] != name:
+                continue
+            qs = model.objects.filter(**{f"{fk}__isnull": True, f"{legacy}__isnull": False})
+            total = qs.count()
+            if opts["dry_run"]:
+                self.stdout.write(f"dry run: {total} {name} to convert")
+                continue
+            done, last_id, started = 0, 0, time.monotonic()
+            while True:
+                rows = list(qs.filter(id__gt=last_id).order_by("id").only("id", legacy)[:opts["batch_size"]])
+                if not rows:
+                    break
+                last_id = rows[-1].id
+                bodies = {}
+                for row in rows:
+                    digest, body = encode_payload(getattr(row, legacy))
+                    bodies[digest] = body
+                    setattr(row, f"{fk}_id", digest)
+                    setattr(row, legacy, None)
+                with transaction.atomic():
+                    PayloadBlob.objects.store(bodies)
+                    model.objects.bulk_update(rows, [fk, legacy], batch_size=500)
+                done += len(rows)
+                rate = done / max(time.monotonic() - started, 1e-9)
+                self.stdout.write(f"{name}: {done}/{total}, last id {last_id}, {rate:.0f} rows/s")
+            self.stdout.write(f"{name}: converted {done} rows")
@@ -0,0 +1,122 @@
+import json, multiprocessing, time
+from collections import deque
+from datetime import datetime, time as dtime
+from pathlib import Path
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
+from django.utils import timezone
+from django.utils.dateparse import parse_date, parse_datetime
+from payments.models import WebhookEvent
+from payments.replay import init_worker, replay_chunk
+
+def _parse_when(value: str | None, end: bool = False):
+    if not value:
+        return None
+    dt = parse_datetime(value)
+    if dt is None:
+        d = parse_date(value)
+        if d is None:
+            raise CommandError(f"not a date/datetime: {value}")
+        dt = datetime.combine(d, dtime.max if end else dtime.min)
+    return timezone.make_aware(dt) if timezone.is_naive(dt) else dt
+
+class Command(BaseCommand):
+    help = ("Reprocess unprocessed WebhookEvents in a pool of worker processes, walking ids in order. "
+            "Progress is checkpointed so an interrupted replay can --resume.")
+
+    def add_arguments(self, parser):
+        parser.add_argument("--school", help="School code.")
+        parser.add_argument("--provider", type=str.upper, help="Provider, in any case (stored upper-cased).")
+        parser.add_argument("--since", help="received_at >= this date/datetime.")
+        parser.add_argument("--until", help="received_at <= this date/datetime.")
+        parser.add_argument("--workers", type=int, default=multiprocessing.cpu_count(),
+                            help="Worker processes (0 = run in this process).")
+        parser.add_argument("--chunk-size", type=int, default=500)
+        parser.add_argument("--from-id", type=int, default=0, help="Start after this event id.")
+        parser.add_argument("--checkpoint", default=str(Path(settings.BASE_DIR) / "var" / "replay-webhook-events.json"))
+        parser.add_argument("--resume", action="store_true", help="Start after the checkpointed id.")
+        parser.add_argument("--dry-run", action="store_true", help="Only count what would be replayed.")
+
+    def handle(self, *args, **opts):
+        filters = {k: opts[k] for k in ("school", "provider", "since", "until")}
+        qs = WebhookEvent.objects.filter(processed=False)
+        if opts["school"]:
+            qs = qs.filter(aggregator_account__school__code=opts["school"])
+        if opts["provider"]:
+            qs = qs.filter(provider=opts["provider"])
+        if opts["since"]:
+            qs = qs.filter(received_at__gte=_parse_when(opts["since"]))
+        if opts["until"]:
+            qs = qs.filter(received_at__lte=_parse_when(opts["until"], end=True))
+
+        checkpoint = Path(opts["checkpoint"])
+        last_id = opts["from_id"]
+        if opts["resume"]:
+            saved = self._load_checkpoint(checkpoint)
+            if saved.get("filters") != filters:
+                raise CommandError(f"checkpoint {checkpoint} was written for {saved.get('filters')}, not {filters}")
+            last_id = max(last_id, saved["last_id"])
+        total = qs.filter(id__gt=last_id).count()
+        self.stdout.write(f"{total} unprocessed events after id {last_id} matching {filters}")
+
+        chunks = self._chunks(qs, last_id, opts["chunk_size"])
+        if opts["dry_run"]:
+            n = sum(1 for _ in chunks)
+            self.stdout.write(f"dry run: would replay {total} events in {n} chunks of up to {opts['chunk_size']}")
+            return
+
+        done = failed = 0
+        started = last_report = time.monotonic()
+        for chunk_last_id, (count, still_unprocessed) in self._run(chunks, opts["workers"]):
+            done += count
+            failed += still_unprocessed
+            # results arrive in id order, so everything up to chunk_last_id has been handled
+            self._save_checkpoint(checkpoint, chunk_last_id, filters)
+            now = time.monotonic()
+            if now - last_report >= 5 or done >= total:
+                rate = done / (now - started) if now > started else 0.0
+                self.stdout.write(f"{done}/{total} events ({failed} still unprocessed), last id {chunk_last_id}, {rate:.0f} events/s")
+                last_report = now
+        elapsed = time.monotonic() - started
+        self.stdout.write(f"replayed {done} events in {elapsed:.1f}s; {failed} still unprocessed (see processing_error)")
+
+    def _chunks(self, qs, last_id: int, size: int):
+        # keyset pagination over id: each query starts after the previous chunk's last id
+        while True:
+            ids = list(qs.filter(id__gt=last_id).order_by("id").values_list("id", flat=True)[:size])
+            if not ids:
+                return
+            last_id = ids[-1]
+            yield ids
+
+    def _run(self, chunks, workers: int):
+        """Yield (last id of chunk, chunk result) in chunk order, keeping the pool at most 2x busy."""
+        if workers <= 0:
+            for ids in chunks:
+                yield ids[-1], replay_chunk(ids)
+            return
+        connections.close_all()
+        ctx = multiprocessing.get_context("spawn")
+        with ctx.Pool(workers, initializer=init_worker) as pool:
+            pending = deque()
+            for ids in chunks:
+                pending.append((ids[-1], pool.apply_async(replay_chunk, (ids,))))
+                if len(pending) >= workers * 2:
+                    last, result = pending.popleft()
+                    yield last, result.get()
+            while pending:
+                last, result = pending.popleft()
+                yield last, result.get()
+
+    def _load_checkpoint(self, path: Path) -> dict:
+        try:
+            return json.loads(path.read_text())
+        except FileNotFoundError:
+            raise CommandError(f"no checkpoint at {path}")
+
+    def _save_checkpoint(self, path: Path, last_id: int, filters: dict):
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = path.with_suffix(".tmp")
+        tmp.write_text(json.dumps({"last_id": last_id, "filters": filters, "at": timezone.now().isoformat()}))
+        tmp.replace(path)
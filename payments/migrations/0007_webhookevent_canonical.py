@@ -0,0 +1,23 @@
+# Generated by Django 4.2.23 on 2026-10-18 19:12
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('payments', '0006_payment_narration'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='webhookevent',
+            name='adapter_version',
+            field=models.CharField(blank=True, default='', max_length=32),
+        ),
+        migrations.AddField(
+            model_name='webhookevent',
+            name='canonical',
+            field=models.JSONField(blank=True, null=True),
+        ),
+    ]
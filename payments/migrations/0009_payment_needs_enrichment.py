@@ -0,0 +1,22 @@
+# Generated by Django 4.2.23 on 2026-10-18 19:23
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('payments', '0008_webhookevent_received_at_default'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='payment',
+            name='needs_enrichment',
+            field=models.BooleanField(default=False),
+        ),
+        migrations.AddIndex(
+            model_name='payment',
+            index=models.Index(condition=models.Q(('needs_enrichment', True)), fields=['school'], name='payment_needs_enrichment'),
+        ),
+    ]
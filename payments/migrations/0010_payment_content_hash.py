@@ -0,0 +1,18 @@
+# Generated by Django 4.2.23 on 2026-10-18 19:25
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('payments', '0009_payment_needs_enrichment'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='payment',
+            name='content_hash',
+            field=models.CharField(blank=True, default='', max_length=64),
+        ),
+    ]
@@ -0,0 +1,33 @@
+# Generated by Django 4.2.23 on 2026-10-18 19:29
+
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('payments', '0010_payment_content_hash'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='payment',
+            name='status_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.CreateModel(
+            name='PaymentStatusRejection',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('from_status', models.CharField(max_length=20)),
+                ('to_status', models.CharField(max_length=20)),
+                ('reason', models.CharField(max_length=20)),
+                ('occurred_at', models.DateTimeField(blank=True, null=True)),
+                ('created_at', models.DateTimeField(default=django.utils.timezone.now)),
+                ('event', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='payments.webhookevent')),
+                ('payment', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='status_rejections', to='payments.payment')),
+            ],
+        ),
+    ]
@@ -0,0 +1,110 @@
+# Generated by Django 4.2.23 on 2026-10-18 19:40
+
+from datetime import date
+from django.db import migrations, models
+from django.db.migrations.exceptions import IrreversibleError
+import django.db.models.deletion
+
+TABLE = "payments_webhookevent"
+OLD = f"{TABLE}_unpartitioned"
+KEY_TABLE = "payments_webhookeventkey"
+MONTHS_AHEAD = 3
+
+
+def _add_months(d, n):
+    y, m = divmod(d.month - 1 + n, 12)
+    return date(d.year + y, m + 1, 1)
+
+
+def partition_webhookevent(apps, schema_editor):
+    """
+    Rebuild payments_webhookevent as a table range-partitioned by month of received_at.
+    Postgres only; other backends keep the plain table. Rows are copied under an exclusive
+    lock, so run it in a maintenance window on a large table.
+    """
+    if schema_editor.connection.vendor != "postgresql":
+        return
+    fk_index = schema_editor._create_index_name(TABLE, ["aggregator_account_id"], suffix="")
+    with schema_editor.connection.cursor() as cur:
+        cur.execute(f"LOCK TABLE {TABLE} IN ACCESS EXCLUSIVE MODE")
+        cur.execute(f"SELECT min(received_at), now() FROM {TABLE}")
+        oldest, now = cur.fetchone()
+        cur.execute(f"ALTER TABLE {TABLE} RENAME TO {OLD}")
+        # the rename keeps the old serial/identity sequence's name, which the new table needs
+        cur.execute("SELECT pg_get_serial_sequence(%s, 'id')", [OLD])
+        (old_seq,) = cur.fetchone()
+        if old_seq:
+            cur.execute(f"ALTER SEQUENCE {old_seq} RENAME TO {OLD}_id_seq")
+
+        # ids keep coming from a sequence (identity columns can't be partitioned before PG 17)
+        cur.execute(f"CREATE TABLE {TABLE} (LIKE {OLD} INCLUDING DEFAULTS) PARTITION BY RANGE (received_at)")
+        cur.execute(f"CREATE SEQUENCE {TABLE}_id_seq OWNED BY {TABLE}.id")
+        cur.execute(f"SELECT setval('{TABLE}_id_seq', COALESCE((SELECT max(id) FROM {OLD}), 0) + 1, false)")
+        cur.execute(f"ALTER TABLE {TABLE} ALTER COLUMN id SET DEFAULT nextval('{TABLE}_id_seq')")
+
+        month = _add_months(oldest or now, 0)
+        last = _add_months(now, MONTHS_AHEAD)
+        while month <= last:
+            nxt = _add_months(month, 1)
+            cur.execute(f"CREATE TABLE {TABLE}_p{month:%Y%m} PARTITION OF {TABLE} FOR VALUES FROM (%s) TO (%s)",
+                        [month, nxt])
+            month = nxt
+        cur.execute(f"CREATE TABLE {TABLE}_default PARTITION OF {TABLE} DEFAULT")
+
+        # (aggregator_account_id, event_id) can't be unique on the partitioned table itself
+        cur.execute(f"""
+            CREATE TABLE {KEY_TABLE} (
+                aggregator_account_id bigint NOT NULL,
+                event_id varchar(100) NOT NULL,
+                received_at timestamptz NOT NULL,
+                PRIMARY KEY (aggregator_account_id, event_id)
+            )""")
+        cur.execute(f"CREATE INDEX {KEY_TABLE}_received_at ON {KEY_TABLE} (received_at)")
+        cur.execute(f"""
+            CREATE FUNCTION {TABLE}_claim_key() RETURNS trigger LANGUAGE plpgsql AS $$
+            BEGIN
+                INSERT INTO {KEY_TABLE} (aggregator_account_id, event_id, received_at)
+                VALUES (NEW.aggregator_account_id, NEW.event_id, NEW.received_at);
+                RETURN NEW;
+            END $$""")
+        cur.execute(f"CREATE TRIGGER {TABLE}_claim_key BEFORE INSERT ON {TABLE} "
+                    f"FOR EACH ROW EXECUTE FUNCTION {TABLE}_claim_key()")
+
+        cur.execute(f"INSERT INTO {TABLE} SELECT * FROM {OLD}")
+        cur.execute(f"DROP TABLE {OLD} CASCADE")
+
+        cur.execute(f"ALTER TABLE {TABLE} ADD PRIMARY KEY (id, received_at)")
+        cur.execute(f"ALTER TABLE {TABLE} ADD CONSTRAINT {TABLE}_aggregator_account_fk "
+                    "FOREIGN KEY (aggregator_account_id) REFERENCES payments_aggregatoraccount (id) "
+                    "DEFERRABLE INITIALLY DEFERRED")
+        cur.execute(f"CREATE INDEX {fk_index} ON {TABLE} (aggregator_account_id, event_id)")
+        cur.execute(f"CREATE INDEX payments_we_provide_139ee0_idx ON {TABLE} (provider, event_id)")
+        cur.execute(f"CREATE INDEX webhookevent_unprocessed ON {TABLE} (received_at) WHERE NOT processed")
+
+
+def unpartition_webhookevent(apps, schema_editor):
+    if schema_editor.connection.vendor == "postgresql":
+        raise IrreversibleError(f"0013 partitioned {TABLE}; go back by restoring a backup taken before it")
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('payments', '0012_webhookevent_sweeper'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='paymentstatusrejection',
+            name='event',
+            field=models.ForeignKey(blank=True, db_constraint=False, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='payments.webhookevent'),
+        ),
+        migrations.RunPython(partition_webhookevent, unpartition_webhookevent),
+        # (event_id, aggregator_account) is enforced through payments_webhookeventkey on Postgres;
+        # other backends get their unique index back from payments.partitions.ensure_event_key.
+        migrations.SeparateDatabaseAndState(
+            state_operations=[
+                migrations.AlterUniqueTogether(name='webhookevent', unique_together=set()),
+            ],
+        ),
+    ]
@@ -0,0 +1,62 @@
+# Generated by Django 4.2.23 on 2026-10-18 20:05
+
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('payments', '0013_partition_webhookevent'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PayloadBlob',
+            fields=[
+                ('digest', models.CharField(max_length=64, primary_key=True, serialize=False)),
+                ('data', models.BinaryField()),
+                ('size', models.PositiveIntegerField()),
+                ('created_at', models.DateTimeField(default=django.utils.timezone.now)),
+                ('last_used_at', models.DateTimeField(default=django.utils.timezone.now)),
+            ],
+        ),
+        # the JSON columns stay where they are for rows not backfilled yet; only the Django names change
+        migrations.AlterField(
+            model_name='webhookevent',
+            name='payload',
+            field=models.JSONField(blank=True, null=True),
+        ),
+        migrations.AlterField(
+            model_name='payment',
+            name='raw',
+            field=models.JSONField(blank=True, null=True),
+        ),
+        migrations.SeparateDatabaseAndState(
+            state_operations=[
+                migrations.RenameField(model_name='webhookevent', old_name='payload', new_name='payload_json'),
+                migrations.AlterField(
+                    model_name='webhookevent',
+                    name='payload_json',
+                    field=models.JSONField(blank=True, db_column='payload', null=True),
+                ),
+                migrations.RenameField(model_name='payment', old_name='raw', new_name='raw_json'),
+                migrations.AlterField(
+                    model_name='payment',
+                    name='raw_json',
+                    field=models.JSONField(blank=True, db_column='raw', null=True),
+                ),
+            ],
+        ),
+        migrations.AddField(
+            model_name='webhookevent',
+            name='payload_blob',
+            field=models.ForeignKey(blank=True, db_constraint=False, null=True, on_delete=django.db.models.deletion.DO_NOTHING, related_name='+', to='payments.payloadblob'),
+        ),
+        migrations.AddField(
+            model_name='payment',
+            name='raw_blob',
+            field=models.ForeignKey(blank=True, db_constraint=False, null=True, on_delete=django.db.models.deletion.DO_NOTHING, related_name='+', to='payments.payloadblob'),
+        ),
+    ]
@@ -0,0 +1,22 @@
+# Generated by Django 4.2.23 on 2026-10-18 19:47
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('payments', '0014_payloadblob'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='payment',
+            name='qbo_sync_error',
+            field=models.TextField(blank=True, default=''),
+        ),
+        migrations.AddIndex(
+            model_name='payment',
+            index=models.Index(condition=models.Q(('qbo_txn_id__isnull', True), ('status', 'SUCCEEDED')), fields=['school'], name='payment_qbo_unsynced'),
+        ),
+    ]
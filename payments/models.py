@@ -1,4 +1,9 @@
-from django.db import models
+import hashlib, json, zlib
+from datetime import timedelta
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import connection, models
+from django.db.models import Exists, OuterRef
+from django.utils import timezone
 from schools.models import School, Student
 
 class AggregatorAccount(models.Model):
@@ -9,21 +14,145 @@ class AggregatorAccount(models.Model):
     class Meta:
         unique_together = ("school", "provider")
 
-class WebhookEvent(models.Model):
+def encode_payload(value) -> tuple[str, bytes]:
+    """(sha256 hex, canonical JSON bytes): equal documents always map to the same blob."""
+    body = json.dumps(value, sort_keys=True, separators=(",", ":"), cls=DjangoJSONEncoder).encode()
+    return hashlib.sha256(body).hexdigest(), body
+
+class PayloadBlobManager(models.Manager):
+    # a referencing write only bumps last_used_at once the tag is a day old
+    TOUCH_AFTER = timedelta(days=1)
+
+    def store(self, bodies: dict[str, bytes]):
+        """Insert {digest: JSON bytes} not stored yet and refresh the retention tag of the rest."""
+        if not bodies:
+            return
+        now = timezone.now()
+        digests = sorted(bodies)  # fixed lock order between concurrent writers
+        if connection.vendor == "postgresql":
+            table = connection.ops.quote_name(self.model._meta.db_table)
+            for i in range(0, len(digests), 500):
+                chunk = digests[i:i + 500]
+                params = []
+                for d in chunk:
+                    params += [d, zlib.compress(bodies[d]), len(bodies[d]), now, now]
+                with connection.cursor() as cur:
+                    # the conflict update takes the row lock prune() waits on, so a blob
+                    # being referenced again can't be deleted underneath the writer
+                    cur.execute(
+                        f"INSERT INTO {table} AS b (digest, data, size, created_at, last_used_at) VALUES "
+                        + ", ".join(["(%s, %s, %s, %s, %s)"] * len(chunk))
+                        + " ON CONFLICT (digest) DO UPDATE SET last_used_at = EXCLUDED.last_used_at"
+                        " WHERE b.last_used_at < %s", params + [now - self.TOUCH_AFTER])
+            return
+        self.bulk_create([self.model(digest=d, data=zlib.compress(bodies[d]), size=len(bodies[d]),
+                                     created_at=now, last_used_at=now) for d in digests],
+                         ignore_conflicts=True, batch_size=500)
+        self.filter(digest__in=digests, last_used_at__lt=now - self.TOUCH_AFTER).update(last_used_at=now)
+
+    def store_pending(self, objs):
+        """Store the blobs of payloads assigned to (not yet saved) model instances."""
+        bodies = {}
+        for obj in objs:
+            bodies.update(obj.__dict__.pop("_pending_blobs", None) or {})
+        self.store(bodies)
+
+    def load_many(self, digests) -> dict:
+        return {b.digest: b.decode() for b in self.filter(digest__in=set(digests))}
+
+    def prune(self, grace: timedelta, batch_size: int = 1000) -> int:
+        """Delete blobs no row references whose retention tag is older than `grace`."""
+        cutoff = timezone.now() - grace
+        unreferenced = self.filter(
+            ~Exists(WebhookEvent.objects.filter(payload_blob=OuterRef("pk"))),
+            ~Exists(Payment.objects.filter(raw_blob=OuterRef("pk"))),
+            last_used_at__lt=cutoff,
+        )
+        deleted = 0
+        while True:
+            digests = list(unreferenced.values_list("digest", flat=True)[:batch_size])
+            if not digests:
+                return deleted
+            deleted += self.filter(digest__in=digests, last_used_at__lt=cutoff)._raw_delete(self.db)
+
+class PayloadBlob(models.Model):
+    """A JSON document stored once, zlib-compressed, under the sha256 of its canonical encoding."""
+    digest = models.CharField(max_length=64, primary_key=True)
+    data = models.BinaryField()
+    size = models.PositiveIntegerField()
+    created_at = models.DateTimeField(default=timezone.now)
+    # retention tag, refreshed by referencing writes; see PayloadBlobManager.prune
+    last_used_at = models.DateTimeField(default=timezone.now)
+
+    objects = PayloadBlobManager()
+
+    def decode(self):
+        return json.loads(zlib.decompress(self.data))
+
+def _blob_property(fk: str, legacy: str) -> property:
+    """
+    JSON value kept in PayloadBlob behind `fk`, read lazily. Rows not backfilled yet (see the
+    backfill_payload_blobs command) still read the `legacy` column. Assigning a value stages
+    its blob; save() stores it, bulk writers call PayloadBlob.objects.store_pending first.
+    """
+    attname, cache = f"{fk}_id", f"_{fk}_value"
+    def fget(self):
+        digest = getattr(self, attname)
+        if digest is None:
+            return getattr(self, legacy)
+        cached = self.__dict__.get(cache)
+        if cached is None or cached[0] != digest:
+            cached = (digest, getattr(self, fk).decode())  # uses select_related when present
+            self.__dict__[cache] = cached
+        return cached[1]
+    def fset(self, value):
+        digest, body = encode_payload(value)
+        setattr(self, attname, digest)
+        setattr(self, legacy, None)
+        self.__dict__[cache] = (digest, value)
+        self.__dict__.setdefault("_pending_blobs", {})[digest] = body
+    return property(fget, fset)
+
+class BlobPayloadModel(models.Model):
+    class Meta:
+        abstract = True
+
+    def save(self, *args, **kwargs):
+        PayloadBlob.objects.store_pending([self])
+        super().save(*args, **kwargs)
+
+class WebhookEvent(BlobPayloadModel):
     aggregator_account = models.ForeignKey(AggregatorAccount, on_delete=models.CASCADE, related_name="events")
     provider = models.CharField(max_length=50)
     event_id = models.CharField(max_length=100)
-    payload = models.JSONField()
+    payload_blob = models.ForeignKey(PayloadBlob, on_delete=models.DO_NOTHING, db_constraint=False,
+                                     null=True, blank=True, related_name="+")
+    payload_json = models.JSONField(null=True, blank=True, db_column="payload")  # pre-blob rows
+    payload = _blob_property("payload_blob", "payload_json")
+    # Validated canonical fields (see aggregators.schemas.to_compact) written at ingest
+    canonical = models.JSONField(null=True, blank=True)
+    adapter_version = models.CharField(max_length=32, blank=True, default="")
     signature = models.CharField(max_length=255, blank=True, null=True)
-    received_at = models.DateTimeField(auto_now_add=True)
+    # not auto_now_add: events drained from the ingest spool keep their original receive time
+    received_at = models.DateTimeField(default=timezone.now)
     processed = models.BooleanField(default=False)
     processed_at = models.DateTimeField(null=True, blank=True)
     processing_error = models.TextField(blank=True, null=True)
+    # re-enqueues by the stuck-event sweeper (payments.tasks.sweep_stuck_events) and its backoff
+    attempts = models.PositiveIntegerField(default=0)
+    next_attempt_at = models.DateTimeField(null=True, blank=True)
     class Meta:
-        unique_together = ("event_id", "aggregator_account")
-        indexes = [models.Index(fields=["provider", "event_id"]),]
+        # (event_id, aggregator_account) is unique but not declared here: on Postgres the table is
+        # range-partitioned by month of received_at and the pair is enforced through
+        # payments_webhookeventkey (payments.partitions); other backends get a unique index from
+        # payments.partitions.ensure_event_key after every migrate.
+        indexes = [
+            models.Index(fields=["provider", "event_id"]),
+            # only the (small) unprocessed tail is indexed, so the sweep stays cheap on a huge table
+            models.Index(fields=["received_at"], condition=models.Q(processed=False), name="webhookevent_unprocessed"),
+        ]
 
-class Payment(models.Model):
+class Payment(BlobPayloadModel):
     school = models.ForeignKey(School, on_delete=models.CASCADE, related_name="payments")
     student = models.ForeignKey(Student, on_delete=models.SET_NULL, null=True, blank=True, related_name="payments")
 
@@ -35,14 +164,26 @@ class Payment(models.Model):
     amount = models.DecimalField(max_digits=18, decimal_places=2)
     currency = models.CharField(max_length=3)
     status = models.CharField(max_length=20)
+    # provider time of the event that set `status` (received_at when the provider sends none)
+    status_at = models.DateTimeField(null=True, blank=True)
     narration = models.CharField(max_length=50, default="Other")
-    raw = models.JSONField(default=dict, blank=True)
+    # usually the same blob as the WebhookEvent that last set the status
+    raw_blob = models.ForeignKey(PayloadBlob, on_delete=models.DO_NOTHING, db_constraint=False,
+                                 null=True, blank=True, related_name="+")
+    raw_json = models.JSONField(null=True, blank=True, db_column="raw")  # pre-blob rows
+    raw = _blob_property("raw_blob", "raw_json")
+    # recorded while the school's directory was unavailable; see payments.tasks.reenrich_payments
+    needs_enrichment = models.BooleanField(default=False)
+    # payments.processing.content_hash of the last applied event; unchanged re-deliveries skip the write
+    content_hash = models.CharField(max_length=64, blank=True, default="")
 
     # QBO fields (optional, used later)
     qbo_txn_id = models.CharField(max_length=128, null=True, blank=True)
     qbo_txn_type = models.CharField(max_length=64, null=True, blank=True)
     qbo_invoice_id = models.CharField(max_length=64, null=True, blank=True)
     qbo_customer_id = models.CharField(max_length=64, null=True, blank=True)
+    # last fault from a QBO batch sync; batch runs skip the payment until a per-payment sync clears it
+    qbo_sync_error = models.TextField(blank=True, default="")
 
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
@@ -52,4 +193,47 @@ class Payment(models.Model):
             models.Index(fields=["school", "created_at"]),
             models.Index(fields=["provider", "external_txn_id"]),
             models.Index(fields=["school", "provider_student_id"]),
-        ]
\ No newline at end of file
+            models.Index(fields=["school"], condition=models.Q(needs_enrichment=True), name="payment_needs_enrichment"),
+            models.Index(fields=["school"], condition=models.Q(status="SUCCEEDED", qbo_txn_id__isnull=True),
+                         name="payment_qbo_unsynced"),
+        ]
+
+class PaymentOutboxManager(models.Manager):
+    def add(self, payment_ids):
+        """Queue payments for QBO sync; call inside the transaction that made them SUCCEEDED."""
+        self.bulk_create([PaymentOutbox(payment_id=pk) for pk in payment_ids], ignore_conflicts=True, batch_size=500)
+
+    def requeue(self, payment_ids):
+        """Queue payments again, including those whose row was already dispatched."""
+        self.filter(payment_id__in=payment_ids, dispatched_at__isnull=False).update(dispatched_at=None)
+        self.add(payment_ids)
+
+class PaymentOutbox(models.Model):
+    """
+    Payments to hand to QBO sync, written with the Payment change and published by
+    qbo.tasks.relay_payment_outbox after commit. One row per payment: a dispatched row stays
+    (dispatched_at set) so re-deliveries don't dispatch again, until pruned.
+    """
+    payment = models.OneToOneField(Payment, on_delete=models.CASCADE, related_name="outbox")
+    created_at = models.DateTimeField(default=timezone.now)
+    dispatched_at = models.DateTimeField(null=True, blank=True)
+
+    objects = PaymentOutboxManager()
+
+    class Meta:
+        indexes = [
+            models.Index(fields=["id"], condition=models.Q(dispatched_at__isnull=True), name="paymentoutbox_pending"),
+            models.Index(fields=["dispatched_at"]),
+        ]
+
+class PaymentStatusRejection(models.Model):
+    """Append-only log of status events dropped by payments.transitions (written in bulk)."""
+    payment = models.ForeignKey(Payment, on_delete=models.CASCADE, related_name="status_rejections")
+    # no FK constraint: a partitioned table can't be referenced by id alone, and archived events go away
+    event = models.ForeignKey(WebhookEvent, on_delete=models.SET_NULL, null=True, blank=True, related_name="+",
+                              db_constraint=False)
+    from_status = models.CharField(max_length=20)
+    to_status = models.CharField(max_length=20)
+    reason = models.CharField(max_length=20)
+    occurred_at = models.DateTimeField(null=True, blank=True)
+    created_at = models.DateTimeField(default=timezone.now)
@@ -0,0 +1,134 @@
+# payments/partitions.py
+"""
+Monthly range partitions of payments_webhookevent on received_at (Postgres only; see
+migration 0013). Partitions are named payments_webhookevent_pYYYYMM; a DEFAULT partition
+catches anything outside them. Its rows are moved into a month's partition when that month is
+created, and archived with the other expired months. Primary and unique keys of a partitioned table must include
+the partition key, so (aggregator_account_id, event_id) idempotency is enforced by the
+unpartitioned payments_webhookeventkey table, filled by a BEFORE INSERT trigger. A duplicate
+insert raises IntegrityError exactly as the old unique constraint did, for as long as the
+key row is kept (keys are dropped together with their archived partition). The trigger also
+means ON CONFLICT DO NOTHING can't skip a duplicate, so webhooks.ingest.insert_events leaves
+out the events it already has before its bulk insert. Model state no
+longer declares the pair unique, so other backends get a plain unique index after every
+migrate instead (ensure_event_key).
+"""
+import re
+from datetime import date
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, connection, connections, transaction
+from django.utils import timezone
+
+TABLE = "payments_webhookevent"
+DEFAULT = f"{TABLE}_default"
+KEY_TABLE = "payments_webhookeventkey"
+_NAME = re.compile(rf"^{TABLE}_p(\d{{4}})(\d{{2}})$")
+
+def month_start(d) -> date:
+    return date(d.year, d.month, 1)
+
+def add_months(d: date, n: int) -> date:
+    y, m = divmod(d.month - 1 + n, 12)
+    return date(d.year + y, m + 1, 1)
+
+def partition_name(month: date) -> str:
+    return f"{TABLE}_p{month:%Y%m}"
+
+def is_partitioned() -> bool:
+    if connection.vendor != "postgresql":
+        return False
+    with connection.cursor() as cur:
+        cur.execute("SELECT 1 FROM pg_partitioned_table WHERE partrelid = %s::regclass", [TABLE])
+        return cur.fetchone() is not None
+
+def ensure_event_key(using=DEFAULT_DB_ALIAS, **kwargs):
+    """
+    post_migrate: outside Postgres, (aggregator_account_id, event_id) stays unique through an
+    index that migrations don't know about, so it is put back after any table rebuild.
+    """
+    conn = connections[using]
+    if conn.vendor == "postgresql":
+        return
+    with conn.cursor() as cur:
+        cur.execute(f"CREATE UNIQUE INDEX IF NOT EXISTS {TABLE}_event_key ON {TABLE} (aggregator_account_id, event_id)")
+
+def partitions() -> list[date]:
+    """Months that have their own partition, oldest first."""
+    with connection.cursor() as cur:
+        cur.execute("SELECT c.relname FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid "
+                    "WHERE i.inhparent = %s::regclass", [TABLE])
+        names = [row[0] for row in cur.fetchall()]
+    months = []
+    for name in names:
+        m = _NAME.match(name)
+        if m:
+            months.append(date(int(m.group(1)), int(m.group(2)), 1))
+    return sorted(months)
+
+def ensure_partitions(months_ahead: int | None = None) -> list[str]:
+    """Create this month's partition and the next N; returns the names created."""
+    if not is_partitioned():
+        return []
+    if months_ahead is None:
+        months_ahead = int(getattr(settings, "WEBHOOK_PARTITION_MONTHS_AHEAD", 3))
+    existing = set(partitions())
+    this_month = month_start(timezone.now())
+    created = []
+    for n in range(months_ahead + 1):
+        month = add_months(this_month, n)
+        if month not in existing:
+            create_partition(month)
+            created.append(partition_name(month))
+    return created
+
+def create_partition(month: date):
+    """
+    Add one month's partition. Rows the DEFAULT partition already holds for the month would make
+    PARTITION OF fail, so when there are any the partition is built beside the table, the rows
+    are moved into it and it is attached. Their idempotency keys stay as they are.
+    """
+    name, bounds = partition_name(month), [month, add_months(month, 1)]
+    with transaction.atomic(), connection.cursor() as cur:
+        cur.execute(f"SELECT EXISTS (SELECT 1 FROM {DEFAULT} WHERE received_at >= %s AND received_at < %s)", bounds)
+        if not cur.fetchone()[0]:
+            cur.execute(f"CREATE TABLE {name} PARTITION OF {TABLE} FOR VALUES FROM (%s) TO (%s)", bounds)
+            return
+        cur.execute(f"LOCK TABLE {DEFAULT} IN ACCESS EXCLUSIVE MODE")
+        cur.execute(f"CREATE TABLE {name} (LIKE {TABLE} INCLUDING DEFAULTS)")
+        cur.execute(f"SELECT * FROM {TABLE} LIMIT 0")
+        columns = ", ".join(connection.ops.quote_name(c[0]) for c in cur.description)
+        cur.execute(f"WITH moved AS (DELETE FROM {DEFAULT} WHERE received_at >= %s AND received_at < %s "
+                    f"RETURNING {columns}) INSERT INTO {name} ({columns}) SELECT {columns} FROM moved", bounds)
+        cur.execute(f"ALTER TABLE {TABLE} ATTACH PARTITION {name} FOR VALUES FROM (%s) TO (%s)", bounds)
+
+def default_months() -> list[date]:
+    """Months with rows in the DEFAULT partition, oldest first."""
+    with connection.cursor() as cur:
+        cur.execute(f"SELECT DISTINCT date_trunc('month', received_at AT TIME ZONE 'UTC') FROM {DEFAULT}")
+        return sorted(month_start(row[0]) for row in cur.fetchall())
+
+def retention_cutoff(retention_months: int | None = None) -> date:
+    """First month still inside the retention window; everything before it can be archived."""
+    if retention_months is None:
+        retention_months = int(getattr(settings, "WEBHOOK_RETENTION_MONTHS", 13))
+    return add_months(month_start(timezone.now()), -retention_months)
+
+def expired_partitions(retention_months: int | None = None) -> list[date]:
+    """Expired months, whether they have their own partition or only rows in the DEFAULT one."""
+    cutoff = retention_cutoff(retention_months)
+    return sorted({m for m in partitions() + default_months() if m < cutoff})
+
+def drop_partition(month: date):
+    """
+    Detach and drop one month's partition along with its idempotency keys; a month without its
+    own partition has its rows deleted from the DEFAULT one instead.
+    """
+    name, bounds = partition_name(month), [month, add_months(month, 1)]
+    own = month in partitions()
+    with transaction.atomic(), connection.cursor() as cur:
+        cur.execute(f"DELETE FROM {KEY_TABLE} WHERE received_at >= %s AND received_at < %s", bounds)
+        if own:
+            cur.execute(f"ALTER TABLE {TABLE} DETACH PARTITION {name}")
+            cur.execute(f"DROP TABLE {name}")
+        else:
+            cur.execute(f"DELETE FROM {DEFAULT} WHERE received_at >= %s AND received_at < %s", bounds)
@@ -0,0 +1,407 @@
+# payments/processing.py
+import hashlib
+from decimal import Decimal
+from collections import defaultdict
+from datetime import timedelta
+from django.conf import settings
+from django.core.cache import cache
+from django.db import connection, transaction
+from django.db.models import F, Q
+from django.utils import timezone
+from payments.models import PayloadBlob, WebhookEvent, Payment, PaymentOutbox, PaymentStatusRejection
+from payments.enums import PaymentStatus
+from payments.transitions import rank_sql, record_rejections, rejection
+from aggregators.factory import get_adapter_class
+from aggregators.schemas import from_compact
+from schools.models import Student
+from schools.resolution import student_resolver
+from school_api.guard import breaker_open
+from qbo.tasks import relay_payment_outbox
+from webhooks.dedupe import get_seen_events
+
+OUTBOX_KICK_KEY = "payments:outbox:kick"
+
+PAYMENT_UPDATE_FIELDS = ["status", "status_at", "amount", "currency", "narration", "raw_blob_id", "raw_json",
+                         "student", "school_student_id", "needs_enrichment", "content_hash", "updated_at"]
+PAYMENT_INSERT_FIELDS = ["school", "student", "provider_student_id", "school_student_id", "amount", "currency",
+                         "status", "status_at", "narration", "raw_blob_id", "raw_json", "needs_enrichment",
+                         "content_hash"]
+
+def load_canonical(event: WebhookEvent) -> dict:
+    # Reuse what the webhook view validated unless the adapter has changed since
+    adapter_cls = get_adapter_class(event.provider)
+    if event.canonical and event.adapter_version == adapter_cls.version:
+        return from_compact(event.canonical, event.payload)
+    return adapter_cls(event.aggregator_account).parse_webhook(event.payload)
+
+def enrich_student(school, prov_sid: str) -> tuple[Student | None, str, bool]:
+    """
+    Resolve provider_student_id to (Student, school_student_id, pending), local mapping first.
+    pending is True when the school's directory couldn't be asked (see school_api.guard).
+    """
+    if not prov_sid:
+        return None, "", False
+    resolved, unavailable = student_resolver.lookup(school, [prov_sid])
+    student, sch_sid = resolved.get(prov_sid, (None, ""))
+    return student, sch_sid, prov_sid in unavailable
+
+AMOUNT_PLACES = Decimal(1).scaleb(-Payment._meta.get_field("amount").decimal_places)
+
+def content_hash(canonical: dict) -> str:
+    """
+    Digest of the canonical payment fields. Equal digests mean a notification changes nothing;
+    `raw` (which carries the provider's event id) is then left as first stored.
+    """
+    # amounts as stored (2 places), so "500", "500.0" and "500.00" hash alike
+    amount = Decimal(str(canonical["amount"])).quantize(AMOUNT_PLACES)
+    data = [str(canonical["provider_student_id"]), str(canonical["status"]), str(amount), str(canonical["currency"])]
+    data.append(str(canonical.get("narration", "Other")))
+    return hashlib.sha256("\x1f".join(data).encode()).hexdigest()
+
+def _occurred_at(event: WebhookEvent, canonical: dict):
+    at = canonical.get("occurred_at")
+    if at is None:
+        return event.received_at
+    return timezone.make_aware(at, timezone.utc) if timezone.is_naive(at) else at
+
+def _rejected(p: Payment, event: WebhookEvent, canonical: dict, reason: str) -> PaymentStatusRejection:
+    return PaymentStatusRejection(payment=p, event=event, from_status=p.status, to_status=canonical["status"],
+                                  reason=reason, occurred_at=_occurred_at(event, canonical))
+
+def _set_raw(p: Payment, event: WebhookEvent, canonical: dict):
+    # point at the event's stored body rather than writing the same document a second time
+    if event.payload_blob_id and not event.__dict__.get("_pending_blobs"):
+        p.raw_blob_id, p.raw_json = event.payload_blob_id, None
+    else:
+        p.raw = canonical["raw"]
+
+def _state(p: Payment) -> tuple:
+    return p.content_hash, p.student_id, p.school_student_id, p.needs_enrichment
+
+def _apply(p: Payment, event: WebhookEvent, canonical: dict, student, sch_sid: str, pending: bool = False):
+    p.status = canonical["status"]
+    p.status_at = _occurred_at(event, canonical)
+    p.amount = canonical["amount"]
+    p.currency = canonical["currency"]
+    p.narration = canonical.get("narration", p.narration)
+    _set_raw(p, event, canonical)
+    if student and not p.student_id:
+        p.student = student
+    if sch_sid and not p.school_student_id:
+        p.school_student_id = sch_sid
+    p.needs_enrichment = pending and not p.student_id
+    p.content_hash = content_hash(canonical)
+
+def _new_payment(event: WebhookEvent, canonical: dict, student, sch_sid: str, pending: bool = False) -> Payment:
+    p = Payment(
+        school=event.aggregator_account.school,
+        student=student,
+        provider=event.provider,
+        external_txn_id=canonical["external_txn_id"],
+        provider_student_id=(canonical.get("provider_student_id") or "").strip(),
+        school_student_id=sch_sid,
+        amount=canonical["amount"],
+        currency=canonical["currency"],
+        status=canonical["status"],
+        status_at=_occurred_at(event, canonical),
+        narration=canonical.get("narration", "Other"),
+        needs_enrichment=pending and student is None,
+        content_hash=content_hash(canonical),
+    )
+    _set_raw(p, event, canonical)
+    return p
+
+def process_event(event: WebhookEvent):
+    canonical = load_canonical(event)
+    school = event.aggregator_account.school
+    prov_sid = (canonical.get("provider_student_id") or "").strip()
+    student, sch_sid, pending = enrich_student(school, prov_sid)
+
+    with transaction.atomic():
+        new = _new_payment(event, canonical, student, sch_sid, pending)
+        payment_id, status, changed, reason = upsert_payment(new)
+        if reason:
+            new.id, new.status = payment_id, status
+            record_rejections([_rejected(new, event, canonical, reason)])
+
+        event.processed = True
+        event.processed_at = timezone.now()
+        event.save(update_fields=["processed", "processed_at"])
+        transaction.on_commit(
+            lambda: get_seen_events().mark_processed(event.aggregator_account_id, event.event_id))
+
+        # Queue QBO sync if payment succeeded (an unchanged re-delivery was already handled); the
+        # outbox row commits with the payment, so no task can run ahead of it or outlive a rollback
+        if changed and status == PaymentStatus.SUCCEEDED.value:
+            PaymentOutbox.objects.add([payment_id])
+            transaction.on_commit(kick_outbox_relay)
+
+def upsert_payment(new: Payment) -> tuple[int | None, str | None, bool, str | None]:
+    """
+    Insert `new` or fold it onto the existing (provider, external_txn_id) row. Returns
+    (payment_id, status, changed, rejected). A status move refused by payments.transitions
+    writes nothing and returns the stored status with the reason. A re-delivery with the same
+    content hash that links nothing new writes no row, leaves updated_at alone and returns
+    changed=False.
+    """
+    PayloadBlob.objects.store_pending([new])
+    if connection.vendor == "postgresql" and getattr(settings, "PAYMENT_UPSERT_SQL", True):
+        return _upsert_postgres(new)
+    p, created = Payment.objects.select_for_update().get_or_create(
+        provider=new.provider, external_txn_id=new.external_txn_id,
+        defaults={f: getattr(new, f) for f in PAYMENT_INSERT_FIELDS},
+    )
+    if created:
+        return p.id, p.status, True, None
+    reason = rejection(p.status, p.status_at, new.status, new.status_at)
+    if reason:
+        return p.id, p.status, False, reason
+    before = _state(p)
+    p.status, p.status_at = new.status, new.status_at
+    p.amount, p.currency, p.narration = new.amount, new.currency, new.narration
+    p.raw_blob_id, p.raw_json = new.raw_blob_id, new.raw_json
+    p.student_id = p.student_id or new.student_id
+    p.school_student_id = p.school_student_id or new.school_student_id
+    p.needs_enrichment = new.needs_enrichment and not p.student_id
+    p.content_hash = new.content_hash
+    if _state(p) == before:
+        return p.id, p.status, False, None
+    p.save(update_fields=PAYMENT_UPDATE_FIELDS)
+    return p.id, p.status, True, None
+
+# One statement, no row lock held across round-trips. The WHERE clause mirrors upsert_payment's
+# ORM path: the status may only move forward (see payments.transitions), and the row is
+# rewritten only if the content changed or a student/school id can be filled in.
+_UPSERT_SQL = """
+INSERT INTO {table} AS p ({columns})
+VALUES ({values})
+ON CONFLICT (provider, external_txn_id) DO UPDATE SET
+    status = EXCLUDED.status, status_at = EXCLUDED.status_at, amount = EXCLUDED.amount,
+    currency = EXCLUDED.currency, narration = EXCLUDED.narration,
+    raw_blob_id = EXCLUDED.raw_blob_id, raw = EXCLUDED.raw,
+    content_hash = EXCLUDED.content_hash,
+    student_id = COALESCE(p.student_id, EXCLUDED.student_id),
+    school_student_id = CASE WHEN p.school_student_id = '' THEN EXCLUDED.school_student_id ELSE p.school_student_id END,
+    needs_enrichment = EXCLUDED.needs_enrichment AND COALESCE(p.student_id, EXCLUDED.student_id) IS NULL,
+    updated_at = EXCLUDED.updated_at
+WHERE ({new_rank} > {old_rank}
+       OR (EXCLUDED.status = p.status
+           AND (p.status_at IS NULL OR EXCLUDED.status_at IS NULL OR EXCLUDED.status_at >= p.status_at)))
+  AND (p.content_hash <> EXCLUDED.content_hash
+       OR (p.student_id IS NULL AND EXCLUDED.student_id IS NOT NULL)
+       OR (p.school_student_id = '' AND EXCLUDED.school_student_id <> '')
+       OR p.needs_enrichment <> (EXCLUDED.needs_enrichment AND COALESCE(p.student_id, EXCLUDED.student_id) IS NULL))
+RETURNING id, status
+"""
+
+def _upsert_fields():
+    # every column but the id, so a NOT NULL column added later (Django drops the DB default) is never left out
+    return [f for f in Payment._meta.concrete_fields if not f.primary_key]
+
+def _upsert_postgres(new: Payment) -> tuple[int | None, str | None, bool, str | None]:
+    # plain read first so refused transitions cost no write and no row lock
+    current = (Payment.objects.filter(provider=new.provider, external_txn_id=new.external_txn_id)
+               .values_list("id", "status", "status_at").first())
+    if current:
+        reason = rejection(current[1], current[2], new.status, new.status_at)
+        if reason:
+            return current[0], current[1], False, reason
+    fields = _upsert_fields()
+    sql = _UPSERT_SQL.format(table=connection.ops.quote_name(Payment._meta.db_table),
+                             columns=", ".join(connection.ops.quote_name(f.column) for f in fields),
+                             values=", ".join(["%s"] * len(fields)),
+                             new_rank=rank_sql("EXCLUDED.status"), old_rank=rank_sql("p.status"))
+    with connection.cursor() as cursor:
+        cursor.execute(sql, [f.get_db_prep_save(f.pre_save(new, True), connection) for f in fields])
+        row = cursor.fetchone()
+    if row:
+        return row[0], row[1], True, None
+    return (current[0], current[1], False, None) if current else (None, None, False, None)
+
+def record_error(event: WebhookEvent, exc: Exception):
+    WebhookEvent.objects.filter(id=event.id).update(processing_error=f"{type(exc).__name__}: {exc}")
+
+def claim_stuck_events(limit: int | None = None) -> dict[int, list[int]]:
+    """
+    Unprocessed events older than WEBHOOK_SWEEP_AFTER_MINUTES whose backoff has elapsed, grouped
+    by school for re-dispatch. Each claimed row gets attempts + 1 and next_attempt_at pushed out
+    by WEBHOOK_SWEEP_BACKOFF_SECONDS * 2**attempts (capped); rows past WEBHOOK_SWEEP_MAX_ATTEMPTS
+    are left for a human, with processing_error saying why.
+    """
+    now = timezone.now()
+    limit = limit or int(getattr(settings, "WEBHOOK_SWEEP_BATCH", 5000))
+    cutoff = now - timedelta(minutes=int(getattr(settings, "WEBHOOK_SWEEP_AFTER_MINUTES", 10)))
+    base = int(getattr(settings, "WEBHOOK_SWEEP_BACKOFF_SECONDS", 60))
+    cap = int(getattr(settings, "WEBHOOK_SWEEP_BACKOFF_MAX_SECONDS", 6 * 3600))
+    rows = list(WebhookEvent.objects
+                .filter(processed=False, received_at__lt=cutoff,
+                        attempts__lt=int(getattr(settings, "WEBHOOK_SWEEP_MAX_ATTEMPTS", 8)))
+                .filter(Q(next_attempt_at__isnull=True) | Q(next_attempt_at__lte=now))
+                .order_by("received_at")
+                .values_list("id", "attempts", "aggregator_account__school_id")[:limit])
+    by_attempts, schools = defaultdict(list), {}
+    for pk, attempts, school_id in rows:
+        by_attempts[attempts].append(pk)
+        schools[pk] = school_id
+    by_school = defaultdict(list)
+    for attempts, ids in by_attempts.items():
+        # conditional on what was read, so of two overlapping sweeps only one claims a row
+        next_at = now + timedelta(seconds=min(cap, base * 2 ** attempts))
+        claimed = (WebhookEvent.objects.filter(id__in=ids, attempts=attempts, processed=False)
+                   .update(attempts=F("attempts") + 1, next_attempt_at=next_at))
+        if claimed < len(ids):
+            ids = list(WebhookEvent.objects.filter(id__in=ids, attempts=attempts + 1, next_attempt_at=next_at)
+                       .values_list("id", flat=True))
+        for pk in ids:
+            by_school[schools[pk]].append(pk)
+    return {school_id: sorted(ids) for school_id, ids in by_school.items()}
+
+def process_events(events: list[WebhookEvent]):
+    """
+    Process many events with set-based writes: one Payment read, bulk insert/update and a
+    single UPDATE marking the events processed. Students are resolved once per distinct
+    (school, provider_student_id). If the bulk write fails, events are retried one by one so
+    a bad event only fails itself.
+    """
+    prepared = []
+    for event in events:
+        try:
+            prepared.append((event, load_canonical(event)))
+        except Exception as exc:
+            record_error(event, exc)
+    if not prepared:
+        return
+
+    by_school, schools = defaultdict(set), {}
+    for event, canonical in prepared:
+        school = event.aggregator_account.school
+        schools[school.id] = school
+        by_school[school.id].add((canonical.get("provider_student_id") or "").strip())
+    students, pending = defaultdict(lambda: (None, "")), set()
+    for school_id, prov_sids in by_school.items():
+        prov_sids.discard("")
+        try:
+            resolved, unavailable = student_resolver.lookup(schools[school_id], prov_sids)
+        except Exception:
+            # enrichment is best-effort; payments are still recorded and retried later
+            resolved, unavailable = {}, prov_sids
+        for prov_sid, value in resolved.items():
+            students[(school_id, prov_sid)] = value
+        pending.update((school_id, prov_sid) for prov_sid in unavailable)
+
+    try:
+        with transaction.atomic():
+            payments, rejected = _write_payments(prepared, students, pending)
+            record_rejections(rejected)
+            now = timezone.now()
+            WebhookEvent.objects.filter(id__in=[e.id for e, _ in prepared]).update(processed=True, processed_at=now)
+            marks = [(e.aggregator_account_id, e.event_id) for e, _ in prepared]
+            succeeded = [p.id for p in payments if p.status == PaymentStatus.SUCCEEDED.value]  # changed rows only
+            PaymentOutbox.objects.add(succeeded)
+            transaction.on_commit(lambda: _after_commit(marks, bool(succeeded)))
+    except Exception:
+        for event, _ in prepared:
+            try:
+                process_event(event)
+            except Exception as exc:
+                record_error(event, exc)
+
+def _write_payments(prepared, students, pending) -> tuple[list[Payment], list[PaymentStatusRejection]]:
+    # Fold the batch onto one final state per payment, applying events in id order and
+    # dropping those payments.transitions refuses
+    keys = {(e.provider, c["external_txn_id"]) for e, c in prepared}
+    existing = {}
+    for provider in {k[0] for k in keys}:
+        for p in (Payment.objects.select_for_update()
+                  .filter(provider=provider, external_txn_id__in=[k[1] for k in keys if k[0] == provider])):
+            existing[(p.provider, p.external_txn_id)] = p
+
+    before = {key: _state(p) for key, p in existing.items()}
+    new, touched, rejected = {}, {}, []
+    for event, canonical in prepared:
+        key = (event.provider, canonical["external_txn_id"])
+        student_key = (event.aggregator_account.school.id, (canonical.get("provider_student_id") or "").strip())
+        student, sch_sid = students[student_key]
+        unresolved = student_key in pending
+        p = existing.get(key) or new.get(key)
+        if p is None:
+            new[key] = _new_payment(event, canonical, student, sch_sid, unresolved)
+            continue
+        reason = rejection(p.status, p.status_at, canonical["status"], _occurred_at(event, canonical))
+        if reason:
+            rejected.append(_rejected(p, event, canonical, reason))
+            continue
+        _apply(p, event, canonical, student, sch_sid, unresolved)
+        if key in existing:
+            touched[key] = p
+
+    touched = {key: p for key, p in touched.items() if _state(p) != before[key]}  # skip no-op re-deliveries
+    PayloadBlob.objects.store_pending([*touched.values(), *new.values()])
+    if touched:
+        now = timezone.now()
+        for p in touched.values():
+            p.updated_at = now  # bulk_update skips auto_now
+        Payment.objects.bulk_update(list(touched.values()), PAYMENT_UPDATE_FIELDS, batch_size=500)
+    if new:
+        Payment.objects.bulk_create(list(new.values()), batch_size=500)
+        if any(p.id is None for p in new.values()):
+            ids = {}
+            for provider in {k[0] for k in new}:
+                ids.update({
+                    (provider, ext): pk for ext, pk in Payment.objects
+                    .filter(provider=provider, external_txn_id__in=[k[1] for k in new if k[0] == provider])
+                    .values_list("external_txn_id", "id")
+                })
+            for key, p in new.items():
+                p.id = ids[key]
+    return list(touched.values()) + list(new.values()), rejected
+
+def kick_outbox_relay():
+    """Relay the outbox now rather than at the next beat; one kick a second is plenty."""
+    if getattr(settings, "QBO_SYNC_ENABLED", False) and cache.add(OUTBOX_KICK_KEY, 1, 1):
+        relay_payment_outbox.delay()
+
+def _after_commit(marks, queued_sync: bool):
+    seen = get_seen_events()
+    for account_id, event_id in marks:
+        seen.mark_processed(account_id, event_id)
+    if queued_sync:
+        kick_outbox_relay()
+
+def reenrich_pending_payments(limit: int = 1000) -> int:
+    """
+    Link payments recorded while their school's directory was unavailable, up to `limit` per
+    school. Schools whose circuit breaker is still open are left out of the query (so their
+    backlog can't crowd out the others) until the next run. QBO sync skips these payments, so
+    the unsynced SUCCEEDED ones go back in the outbox. Returns payments linked.
+    """
+    flagged = Payment.objects.filter(needs_enrichment=True)
+    school_ids = sorted(set(flagged.values_list("school_id", flat=True).distinct()))
+    linked, queued = 0, False
+    for school_id in school_ids:
+        if breaker_open(school_id):
+            continue
+        payments = list(flagged.select_related("school").filter(school_id=school_id).order_by("id")[:limit])
+        if not payments:
+            continue
+        school = payments[0].school
+        resolved, unavailable = student_resolver.lookup(school, {p.provider_student_id for p in payments})
+        done = []
+        for p in payments:
+            if p.provider_student_id in unavailable:
+                continue
+            student, sch_sid = resolved.get(p.provider_student_id, (None, ""))
+            p.student = student
+            p.school_student_id = p.school_student_id or sch_sid
+            p.needs_enrichment = False
+            p.updated_at = timezone.now()
+            done.append(p)
+            linked += bool(student)
+        unsynced = [p.id for p in done if p.status == PaymentStatus.SUCCEEDED.value and not p.qbo_txn_id]
+        with transaction.atomic():
+            Payment.objects.bulk_update(done, ["student", "school_student_id", "needs_enrichment", "updated_at"])
+            PaymentOutbox.objects.requeue(unsynced)
+        queued = queued or bool(unsynced)
+    if queued:
+        kick_outbox_relay()
+    return linked
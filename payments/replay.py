@@ -0,0 +1,20 @@
+# payments/replay.py
+"""
+Pool-worker side of `manage.py replay_webhook_events`. Kept free of model imports at module
+level so spawned worker processes can unpickle these functions before django.setup().
+"""
+
+def init_worker():
+    import django
+    django.setup()
+    from django.db import connections
+    connections.close_all()  # never share the parent's sockets
+
+def replay_chunk(ids: list[int]) -> tuple[int, int]:
+    """Process one chunk through the Celery batch task's code path -> (ids, still unprocessed)."""
+    from django.db import close_old_connections
+    from payments.models import WebhookEvent
+    from payments.tasks import process_webhook_events_batch
+    close_old_connections()
+    process_webhook_events_batch(event_ids=ids)
+    return len(ids), WebhookEvent.objects.filter(id__in=ids, processed=False).count()
@@ -1,69 +1,53 @@
+from datetime import timedelta
 from celery import shared_task
-from django.db import transaction
-from django.utils import timezone
-from payments.models import WebhookEvent, Payment
-from payments.enums import PaymentStatus
-from aggregators.factory import get_adapter_class
-from schools.models import Student, StudentIdMap, SchoolDirectoryConnection
-from school_api.client import SchoolAPIClient
-from qbo.tasks import sync_payment_to_qbo
+from django.conf import settings
+from payments.models import PayloadBlob, WebhookEvent
+from payments.partitions import ensure_partitions
+from payments.processing import claim_stuck_events, process_event, process_events, record_error, reenrich_pending_payments
+
+# school_id is only read by config.celery.route_task to pick the school's webhooks.<n> queue
 
 @shared_task(bind=True)
-def process_webhook_event_task(self, event_id: int):
+def process_webhook_event_task(self, event_id: int, school_id: int | None = None):
     event = (WebhookEvent.objects
-             .select_related("aggregator_account", "aggregator_account__school")
+             .select_related("aggregator_account", "aggregator_account__school", "payload_blob")
              .get(id=event_id))
-    adapter = get_adapter_class(event.provider)(event.aggregator_account)
-    canonical = adapter.parse_webhook(event.payload)
+    try:
+        process_event(event)
+    except Exception as exc:
+        record_error(event, exc)
+        raise
 
-    # Enrich via School Directory if we don't have a mapping yet
-    school = event.aggregator_account.school
-    prov_sid = (canonical.get("provider_student_id") or "").strip()
-    sch_sid = ""
-    student = None
+@shared_task(bind=True)
+def process_webhook_events_batch(self, event_ids: list[int], school_id: int | None = None):
+    events = list(WebhookEvent.objects
+                  .select_related("aggregator_account", "aggregator_account__school", "payload_blob")
+                  .filter(id__in=event_ids, processed=False)
+                  .order_by("id"))
+    process_events(events)
 
-    conn = getattr(school, "directory", None)
-    if prov_sid and conn:
-        data = SchoolAPIClient(conn).get_by_provider_student_id(prov_sid)
-        if data:
-            sch_sid = (data.get("school_student_id") or "").strip()
-            full_name = (data.get("full_name") or "").strip()
-            if sch_sid:
-                student, _ = Student.objects.get_or_create(school=school, school_student_id=sch_sid, defaults={"full_name": full_name})
-                StudentIdMap.objects.get_or_create(school=school, provider_student_id=prov_sid, defaults={"student": student})
+@shared_task
+def reenrich_payments():
+    return reenrich_pending_payments()
 
-    with transaction.atomic():
-        p, created = Payment.objects.select_for_update().get_or_create(
-            provider=event.provider,
-            external_txn_id=canonical["external_txn_id"],
-            defaults={
-                "school": school,
-                "student": student,
-                "provider_student_id": prov_sid,
-                "school_student_id": sch_sid,
-                "amount": canonical["amount"],
-                "currency": canonical["currency"],
-                "status": canonical["status"],
-                "narration": canonical.get("narration", "Other"),
-                "raw": canonical["raw"],
-            },
-        )
-        if not created:
-            p.status = canonical["status"]
-            p.amount = canonical["amount"]
-            p.currency = canonical["currency"]
-            p.narration = canonical.get("narration", p.narration)
-            p.raw = canonical["raw"]
-            if student and not p.student:
-                p.student = student
-            if sch_sid and not p.school_student_id:
-                p.school_student_id = sch_sid
-            p.save(update_fields=["status","amount","currency","raw","student","school_student_id","updated_at"])
+@shared_task
+def sweep_stuck_events():
+    """Re-enqueue events whose processing task was lost (broker hiccup, worker OOM)."""
+    size = int(getattr(settings, "WEBHOOK_BATCH_DISPATCH_SIZE", 200))
+    priority = int(getattr(settings, "CELERY_BULK_PRIORITY", 9))  # behind live webhooks on the same shard
+    claimed = claim_stuck_events()
+    for school_id, ids in claimed.items():
+        for i in range(0, len(ids), size):
+            process_webhook_events_batch.apply_async(kwargs={"event_ids": ids[i:i + size], "school_id": school_id},
+                                                     priority=priority)
+    return sum(len(ids) for ids in claimed.values())
 
-        event.processed = True
-        event.processed_at = timezone.now()
-        event.save(update_fields=["processed", "processed_at"])
+@shared_task
+def create_webhook_partitions():
+    """Keep WEBHOOK_PARTITION_MONTHS_AHEAD monthly WebhookEvent partitions ready (no-op off Postgres)."""
+    return ensure_partitions()
 
-        # Trigger QBO sync if payment succeeded
-        if p.status == PaymentStatus.SUCCEEDED.value:
-            sync_payment_to_qbo.delay(payment_id=p.id)
\ No newline at end of file
+@shared_task
+def prune_payload_blobs():
+    """Drop payload blobs nothing references any more (archived events, superseded payment bodies)."""
+    return PayloadBlob.objects.prune(timedelta(days=int(getattr(settings, "PAYLOAD_BLOB_GRACE_DAYS", 7))))
@@ -0,0 +1,59 @@
+# payments/transitions.py
+"""
+Payment status state machine. Providers redeliver PENDING -> SUCCEEDED -> REFUNDED notifications
+out of order, so an event is only applied if it moves the payment forward:
+  - a lower-precedence status than the current one is a regression (SUCCEEDED -> PENDING),
+  - the same status reported at an earlier time than the stored one is stale.
+Rejected events never reach a row write or a QBO enqueue; they are counted in the shared cache
+and logged to PaymentStatusRejection in bulk.
+"""
+from django.core.cache import cache
+from payments.enums import PaymentStatus
+from payments.models import PaymentStatusRejection
+
+PRECEDENCE = {
+    PaymentStatus.PENDING.value: 0,
+    PaymentStatus.FAILED.value: 1,     # a retried charge can still succeed
+    PaymentStatus.SUCCEEDED.value: 2,
+    PaymentStatus.REFUNDED.value: 3,
+}
+REGRESSIVE = "regressive"
+STALE = "stale"
+COUNTER_KEY = "payments:transitions:rejected:{reason}"
+
+def rejection(current: str, current_at, new: str, new_at) -> str | None:
+    """Why moving from (current, current_at) to (new, new_at) is refused, or None to apply it."""
+    if PRECEDENCE.get(str(new), 0) < PRECEDENCE.get(str(current), 0):
+        return REGRESSIVE
+    if str(new) == str(current) and current_at and new_at and new_at < current_at:
+        return STALE
+    return None
+
+def rank_sql(column: str) -> str:
+    """SQL expression for PRECEDENCE, used by the Postgres upsert's WHERE clause."""
+    whens = " ".join(f"WHEN '{status}' THEN {rank}" for status, rank in PRECEDENCE.items())
+    return f"(CASE {column} {whens} ELSE 0 END)"
+
+def record_rejections(rejections: list):
+    """Bulk-insert PaymentStatusRejection rows and bump the per-reason counters."""
+    if not rejections:
+        return
+    PaymentStatusRejection.objects.bulk_create(rejections, batch_size=500)
+    counts = {}
+    for r in rejections:
+        counts[r.reason] = counts.get(r.reason, 0) + 1
+    for reason, n in counts.items():
+        key = COUNTER_KEY.format(reason=reason)
+        try:
+            cache.add(key, 0, None)
+            cache.incr(key, n)
+        except Exception:
+            pass  # counters are best-effort
+
+def stats() -> dict:
+    keys = {reason: COUNTER_KEY.format(reason=reason) for reason in (REGRESSIVE, STALE)}
+    try:
+        values = cache.get_many(list(keys.values()))
+    except Exception:
+        values = {}
+    return {reason: values.get(key, 0) for reason, key in keys.items()}
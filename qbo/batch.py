@@ -0,0 +1,182 @@
+# qbo/batch.py
+"""
+Month-end sync through the QBO /batch endpoint. A school's unsynced SUCCEEDED payments that
+are linked to their student (needs_enrichment unset) go out BATCH_LIMIT operations per
+request and the returned ids are written back with one bulk_update per request. Items QBO
+faults get qbo_sync_error set and are handed to the per-payment task; the flag keeps later
+batch runs off them until tasks.retry_parked_payments clears it. The same goes for payments
+whose customer could not be resolved, and for every payment of a request QBO rejected as a
+whole.
+
+A request that fails without an answer (timeout, connection error, 5xx) may still have been
+applied, so its payments are not resent one by one. They keep their customer and invoice and
+are flagged UNCONFIRMED with the request's requestid, and the next run resends the same chunk
+under that requestid first: QBO answers it with the original result if it applied it.
+"""
+import logging, requests
+from django.conf import settings
+from django.core.cache import cache
+from django.utils import timezone
+from payments.enums import PaymentStatus
+from payments.models import Payment
+from . import customers as qbo_customers
+from . import invoices as qbo_invoices
+from .ratelimit import Throttled
+from .client import (BATCH_LIMIT, QBOClient, QBOError, batch_requestid, match_invoice, payment_body,
+                     sales_receipt_body)
+
+logger = logging.getLogger(__name__)
+
+LOCK_KEY = "qbo:batch:{realm_id}"
+UPDATE_FIELDS = ["qbo_txn_id", "qbo_txn_type", "qbo_invoice_id", "qbo_customer_id", "qbo_sync_error", "updated_at"]
+UNCONFIRMED = "batch unconfirmed: "  # + the requestid the payment's chunk must be resent under
+
+def _unsynced():
+    return Payment.objects.filter(status=PaymentStatus.SUCCEEDED.value, qbo_txn_id__isnull=True,
+                                  school__qbo__isnull=False)
+
+def pending_payments():
+    return _unsynced().filter(qbo_sync_error="", needs_enrichment=False)
+
+def unconfirmed_payments():
+    return _unsynced().filter(qbo_sync_error__startswith=UNCONFIRMED)
+
+def sync_batch(school, limit: int | None = None) -> tuple[int, list[int]]:
+    """
+    Sync up to `limit` pending payments of one school. Returns (synced, failed payment ids).
+    One run per realm at a time; a run that finds the realm busy does nothing.
+    """
+    if not hasattr(school, "qbo"):
+        return 0, []
+    if limit is None:
+        limit = int(getattr(settings, "QBO_BATCH_MAX_PAYMENTS", 3000))
+    lock = LOCK_KEY.format(realm_id=school.qbo.realm_id)
+    if not cache.add(lock, 1, timeout=int(getattr(settings, "QBO_BATCH_LOCK_SECONDS", 600))):
+        return 0, []
+    try:
+        unconfirmed = {}
+        for p in unconfirmed_payments().filter(school=school).order_by("id"):
+            unconfirmed.setdefault(p.qbo_sync_error[len(UNCONFIRMED):], []).append(p)
+        payments = list(pending_payments().filter(school=school).order_by("id")[:limit])
+        if not payments and not unconfirmed:
+            return 0, []
+        client = QBOClient(school)
+        client.ensure_token()
+        synced, failed = 0, []
+        for request_id, chunk in unconfirmed.items():
+            done, faulted, go_on = _send(client, [_op(p, p.qbo_customer_id) for p in chunk], request_id)
+            synced, failed = synced + done, failed + faulted
+            if not go_on:
+                return synced, failed  # the new payments wait until the earlier chunks are confirmed
+        if not payments:
+            return synced, failed
+        ops, unresolved = _plan(client, payments)
+        failed += _park(unresolved, qbo_customers.UNRESOLVED)
+        for i in range(0, len(ops), BATCH_LIMIT):
+            done, faulted, go_on = _send(client, ops[i:i + BATCH_LIMIT])
+            synced, failed = synced + done, failed + faulted
+            if not go_on:
+                break  # the rest stay pending for the next run
+        return synced, failed
+    finally:
+        cache.delete(lock)
+
+def _send(client: QBOClient, ops: list[tuple[Payment, str, dict]], request_id: str | None = None
+          ) -> tuple[int, list[int], bool]:
+    """Submit one chunk. Returns (synced, failed payment ids, whether the run should go on)."""
+    request_id = request_id or batch_requestid(_items(ops))
+    try:
+        done, faulted = _submit(client, ops, request_id)
+    except Throttled:
+        return 0, [], False
+    except (QBOError, requests.RequestException) as exc:
+        if isinstance(exc, QBOError) and not exc.retryable:  # rejected as a whole, so nothing was applied
+            return 0, _park([p for p, _, _ in ops], f"batch failed: {exc}"), True
+        _hold([p for p, _, _ in ops], request_id, exc)
+        return 0, [], False
+    return done, faulted, True
+
+def _op(p: Payment, customer_id: str) -> tuple[Payment, str, dict]:
+    if p.qbo_invoice_id:
+        return p, "Payment", payment_body(p, customer_id, p.qbo_invoice_id)
+    return p, "SalesReceipt", sales_receipt_body(p, customer_id)
+
+def _plan(client: QBOClient, payments: list[Payment]) -> tuple[list[tuple[Payment, str, dict]], list[Payment]]:
+    """
+    (payment, entity type, entity body) per payment, mirroring sync_payment_to_qbo's choices,
+    and the payments whose customer could not be resolved.
+    """
+    open_invoices, ops = {}, []
+    cached = qbo_invoices.is_cached(payments[0].school_id)
+    customers = qbo_customers.resolve_payments(client, payments)
+    unresolved = [p for p in payments if p.id not in customers]
+    for p in payments:
+        customer_id = customers.get(p.id)
+        if customer_id is None:
+            continue
+        p.qbo_customer_id = customer_id
+        if not p.qbo_invoice_id and cached:
+            p.qbo_invoice_id = qbo_invoices.claim(p, customer_id)
+        elif not p.qbo_invoice_id:
+            if customer_id not in open_invoices:
+                open_invoices[customer_id] = list(client.find_open_invoices(customer_id))
+            inv = match_invoice(open_invoices[customer_id], p)
+            if inv:
+                open_invoices[customer_id].remove(inv)  # one invoice per payment within the run
+                p.qbo_invoice_id = str(inv["Id"])
+        ops.append(_op(p, customer_id))
+    return ops, unresolved
+
+def _fault(response: dict) -> str:
+    fault = response.get("Fault")
+    if not fault:
+        return "no result in batch response"
+    err = (fault.get("Error") or [{}])[0]
+    return f"{fault.get('type', 'Fault')}: {err.get('Message', '')} {err.get('Detail', '')}".strip()[:500]
+
+def _items(ops: list[tuple[Payment, str, dict]]) -> list[dict]:
+    return [{"bId": str(p.id), "operation": "create", txn_type: body} for p, txn_type, body in ops]
+
+def _submit(client: QBOClient, ops: list[tuple[Payment, str, dict]], request_id: str) -> tuple[int, list[int]]:
+    responses = {r.get("bId"): r for r in client.batch(_items(ops), request_id=request_id)}
+    now = timezone.now()
+    done, failed = [], []
+    for p, txn_type, _ in ops:
+        response = responses.get(str(p.id), {})
+        entity = response.get(txn_type) or {}
+        p.updated_at = now
+        if entity.get("Id"):
+            p.qbo_txn_id, p.qbo_txn_type, p.qbo_sync_error = str(entity["Id"]), txn_type, ""
+            done.append(p)
+        else:
+            p.qbo_sync_error = _fault(response)
+            if qbo_customers.INVALID_REFERENCE in p.qbo_sync_error:
+                qbo_customers.forget(client.realm_id, p.qbo_customer_id)
+            failed.append(p)
+    if done:
+        Payment.objects.bulk_update(done, UPDATE_FIELDS)
+    if failed:
+        # the invoice match is left for the per-payment retry to redo
+        qbo_invoices.release(failed)
+        Payment.objects.bulk_update(failed, ["qbo_sync_error", "updated_at"])
+    return len(done), [p.id for p in failed]
+
+def _park(payments: list[Payment], error: str) -> list[int]:
+    """Flag payments the batch could not send, for the per-payment task."""
+    if not payments:
+        return []
+    now = timezone.now()
+    for p in payments:
+        p.qbo_sync_error, p.updated_at = error[:500], now
+    qbo_invoices.release(payments)
+    Payment.objects.bulk_update(payments, ["qbo_sync_error", "updated_at"])
+    return [p.id for p in payments]
+
+def _hold(payments: list[Payment], request_id: str, exc: Exception):
+    """Flag a chunk QBO may have applied, keeping what it was built from, so the next run resends it as is."""
+    logger.warning("QBO batch %s for %d payments has no answer, resending it next run: %s",
+                   request_id, len(payments), exc)
+    now = timezone.now()
+    for p in payments:
+        p.qbo_sync_error, p.updated_at = f"{UNCONFIRMED}{request_id}", now
+    Payment.objects.bulk_update(payments, ["qbo_customer_id", "qbo_invoice_id", "qbo_sync_error", "updated_at"])
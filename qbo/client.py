@@ -1,46 +1,185 @@
 # qbo/client.py
-from django.utils import timezone
+import gzip, json, uuid
 from django.conf import settings
-from schools.models import QBOConnection
-import qbo.oauth as qbo_oauth 
+import qbo.customers as qbo_customers
+import qbo.ratelimit as qbo_ratelimit
+import qbo.sessions as qbo_sessions
+import qbo.tokens as qbo_tokens
 # Choose base by sandbox flag (optional for later)
 API_BASE = "https://sandbox-quickbooks.api.intuit.com" if getattr(settings, "QBO_IS_SANDBOX", True) \
           else "https://quickbooks.api.intuit.com"
+MINOR_VERSION = "65"
+BATCH_LIMIT = 30  # QBO rejects batch requests with more items
+
+class QBOError(Exception):
+    """An error answer from the QBO API. Outages (5xx) are retryable; requests QBO rejected are not."""
+    def __init__(self, status: int, message: str, fault_type: str = ""):
+        super().__init__(f"QBO {status} {fault_type or 'error'}: {message}")
+        self.status = status
+        self.fault_type = fault_type
+
+    @property
+    def retryable(self) -> bool:
+        return self.status >= 500
+
+def _error(r) -> QBOError:
+    try:
+        data = r.json()
+    except ValueError:
+        data = {}
+    fault = data.get("Fault") or data.get("fault") or {}
+    err = (fault.get("Error") or fault.get("error") or [{}])[0]
+    message = f"{err.get('Message', '')} {err.get('Detail', '')}".strip() or r.reason or ""
+    return QBOError(r.status_code, message[:400], fault.get("type", ""))
+
+def requestid_for(*parts) -> str:
+    """
+    Stable `requestid` for one logical QBO write. QBO answers a repeated requestid with the
+    original result, so a create resent after a lost response (by the session's retries or by
+    a later task run) can't book the payment twice.
+    """
+    return uuid.uuid5(uuid.NAMESPACE_URL, ":".join(str(p) for p in parts)).hex
+
+def batch_requestid(items: list[dict]) -> str:
+    return requestid_for("batch", json.dumps(items, sort_keys=True, default=str))
+
+def sales_receipt_body(payment, customer_id: str) -> dict:
+    return {
+        "CustomerRef": {"value": customer_id},
+        "TxnDate": payment.created_at.date().isoformat(),
+        "PrivateNote": f"{payment.provider} {payment.external_txn_id}",
+        "Line": [{
+            "Amount": float(payment.amount),
+            "Description": str(payment.narration),
+            "DetailType": "SalesItemLineDetail",
+            "SalesItemLineDetail": {"ItemRef": {"value": getattr(settings, "QBO_SALES_ITEM_ID", "1")}},
+        }],
+    }
+
+def payment_body(payment, customer_id: str, invoice_id: str) -> dict:
+    return {
+        "CustomerRef": {"value": customer_id},
+        "TotalAmt": float(payment.amount),
+        "TxnDate": payment.created_at.date().isoformat(),
+        "PaymentRefNum": payment.external_txn_id[:21],
+        "Line": [{"Amount": float(payment.amount), "LinkedTxn": [{"TxnId": invoice_id, "TxnType": "Invoice"}]}],
+    }
+
+def match_invoice(open_invoices: list, payment) -> dict | None:
+    """First open invoice for exactly this amount whose first line matches the narration."""
+    for inv in open_invoices:
+        if (inv.get("Balance", 0) == float(payment.amount) and
+            inv.get("Line", [{}])[0].get("Description", "").lower() == str(payment.narration).lower()):
+            return inv
+    return None
 
 class QBOClient:
+    batch_limit = BATCH_LIMIT
+
     def __init__(self, school):
-        self.conn: QBOConnection = school.qbo
+        self.school = school
+        self.realm_id: str | None = None
+        self.access_token: str | None = None
 
     def ensure_token(self):
-        if not self.conn:
+        """Load a valid access token (see qbo.tokens); False if the school has no QBO connection."""
+        token = qbo_tokens.get_token(self.school.id)
+        if token is None:
             return False
-        if self.conn.token_expires_at and self.conn.token_expires_at > timezone.now():
-            return True
-        data = qbo_oauth.refresh_access_token(self.conn.refresh_token)  
-        self.conn.access_token = data["access_token"]
-        self.conn.refresh_token = data.get("refresh_token", self.conn.refresh_token)
-        self.conn.token_expires_at = timezone.now() + timezone.timedelta(seconds=int(data.get("expires_in", 2500)))
-        self.conn.save(update_fields=["access_token", "refresh_token", "token_expires_at"])
+        self.realm_id, self.access_token = token
         return True
 
     def _headers(self):
         return {
-            "Authorization": f"Bearer {self.conn.access_token}",
+            "Authorization": f"Bearer {self.access_token}",
             "Accept": "application/json",
             "Content-Type": "application/json",
         }
 
+    def _url(self, path: str) -> str:
+        return f"{API_BASE}/v3/company/{self.realm_id}/{path}"
+
+    def _request(self, method: str, path: str, params=None, body=None, request_id: str | None = None) -> dict:
+        """
+        One API call on the realm's pooled session, paced by qbo.ratelimit. The session retries
+        connection failures and 5xx; a 401 refreshes the token and tries once more. Raises
+        ratelimit.Throttled on 429 and QBOError on any other error answer.
+        """
+        params = {**(params or {}), "minorversion": MINOR_VERSION}
+        if request_id:
+            params["requestid"] = request_id
+        data, extra = None, {}
+        if body is not None:
+            data = json.dumps(body, separators=(",", ":")).encode()
+            if len(data) >= int(getattr(settings, "QBO_GZIP_MIN_BYTES", 1024)):
+                data, extra["Content-Encoding"] = gzip.compress(data), "gzip"
+        timeout = qbo_sessions.timeout()
+        hold = int(sum(timeout) * (int(getattr(settings, "QBO_RETRIES", 2)) + 1))
+        for attempt in (1, 2):
+            with qbo_ratelimit.slot(self.realm_id, timeout=hold):
+                r = qbo_sessions.session_for(self.realm_id).request(
+                    method, self._url(path), params=params, data=data,
+                    headers={**self._headers(), **extra}, timeout=timeout)
+            if r.status_code != 401 or attempt == 2:
+                break
+            token = qbo_tokens.reject(self.school.id, self.access_token)
+            if token is None:
+                break
+            self.realm_id, self.access_token = token
+        if r.status_code == 429:
+            raise qbo_ratelimit.Throttled(self.realm_id, qbo_ratelimit.throttled(self.realm_id, r.headers.get("Retry-After")))
+        if r.status_code >= 400:
+            raise _error(r)
+        return r.json()
+
+    def _get(self, path: str, **params) -> dict:
+        return self._request("GET", path, params=params)
+
+    def batch(self, items: list[dict], request_id: str | None = None) -> list[dict]:
+        """
+        POST up to BATCH_LIMIT {"bId", "operation", <Entity>} items to /batch and return the
+        BatchItemResponse list; each response carries the bId and either the entity or a Fault.
+        The requestid defaults to one derived from the items; qbo.batch passes the original one
+        when it resends a chunk whose first answer was lost.
+        """
+        body = {"BatchItemRequest": items}
+        return self._request("POST", "batch", body=body, request_id=request_id or batch_requestid(items)
+                             ).get("BatchItemResponse", [])
+
+    def query(self, statement: str) -> dict:
+        """Run a QBO SQL-like query; returns the QueryResponse object."""
+        return self._get("query", query=statement).get("QueryResponse", {})
+
+    def change_data_capture(self, entities: list[str], since) -> dict:
+        """{entity name: [changed objects]} since `since` (QBO looks back at most 30 days)."""
+        data = self._get("cdc", entities=",".join(entities), changedSince=since.isoformat())
+        changed = {}
+        for block in data.get("CDCResponse", []):
+            for response in block.get("QueryResponse", []):
+                for name in entities:
+                    changed.setdefault(name, []).extend(response.get(name, []))
+        return changed
+
     def find_or_create_customer(self, payment) -> dict:
-        return {"Id": getattr(payment, "qbo_customer_id", None) or "1"}
+        """{"Id": customer id}, or {} if QBO has no such customer and refused to create it."""
+        customer_id = qbo_customers.resolve_payments(self, [payment]).get(payment.id)
+        return {"Id": customer_id} if customer_id else {}
 
     def create_sales_receipt(self, payment, customer_id: str) -> dict:
-        # Tests monkeypatch this. Keep raising by default.
-        raise NotImplementedError()
+        return self._request("POST", "salesreceipt", body=sales_receipt_body(payment, customer_id),
+                             request_id=requestid_for("SalesReceipt", payment.provider, payment.external_txn_id)
+                             ).get("SalesReceipt", {})
 
     def create_payment(self, payment, customer_id: str, invoice_id: str) -> dict:
-        # Create a payment against an invoice
-        raise NotImplementedError()
+        """
+        Create a payment against an invoice. The requestid is the payment's alone: a retry that
+        matched a different invoice still gets the original Payment back, not a second one.
+        """
+        return self._request("POST", "payment", body=payment_body(payment, customer_id, invoice_id),
+                             request_id=requestid_for("Payment", payment.provider, payment.external_txn_id)
+                             ).get("Payment", {})
 
     def find_open_invoices(self, customer_id: str) -> list:
-        # Return list of open invoices for customer
-        raise NotImplementedError()
+        customer = str(customer_id).replace("'", "")
+        return self.query(f"SELECT * FROM Invoice WHERE CustomerRef = '{customer}' AND Balance > '0' "
+                          "MAXRESULTS 1000").get("Invoice", [])
@@ -0,0 +1,139 @@
+# qbo/customers.py
+"""
+Student -> QBO customer resolution. A student's customer id is remembered per realm in
+StudentQBOCustomer and in this process; unknown students are resolved in bulk: one
+`SELECT ... WHERE DisplayName IN (...)` per QUERY_CHUNK names, then the missing customers
+are created through /batch. Payments with no linked student are booked to a customer named
+after their provider_student_id, cached in process only. A name QBO neither has nor accepts
+(e.g. it belongs to a vendor or employee) is left out of the results; callers park those
+payments with qbo_sync_error instead of failing the rest of the batch.
+
+The in-process maps are LRUs of QBO_CUSTOMER_CACHE_SIZE entries each. A customer merged or
+deleted in QBO shows up as an "Invalid Reference Id" answer; callers then `forget` it, so the
+retry resolves the student or name afresh.
+"""
+from collections import OrderedDict
+from django.conf import settings
+from schools.models import Student, StudentQBOCustomer
+
+QUERY_CHUNK = 50    # names per IN (...), keeps the query URL short
+PAGE_SIZE = 1000
+NAME_MAX = 100      # QBO's DisplayName limit
+UNRESOLVED = "QBO customer could not be found or created"
+INVALID_REFERENCE = "Invalid Reference Id"  # QBO's message for a ref to an entity it no longer has
+
+# (realm_id, student_id) -> customer id
+_by_student: OrderedDict[tuple[str, int], str] = OrderedDict()
+# (realm_id, display name lower-cased) -> customer id
+_by_name: OrderedDict[tuple[str, str], str] = OrderedDict()
+
+def clear():
+    _by_student.clear()
+    _by_name.clear()
+
+def _get(memo: OrderedDict, key):
+    customer_id = memo.get(key)
+    if customer_id is not None:
+        memo.move_to_end(key)
+    return customer_id
+
+def _put(memo: OrderedDict, key, customer_id: str) -> str:
+    memo[key] = customer_id
+    memo.move_to_end(key)
+    while len(memo) > int(getattr(settings, "QBO_CUSTOMER_CACHE_SIZE", 20000)):
+        memo.popitem(last=False)
+    return customer_id
+
+def forget(realm_id: str, customer_id: str):
+    """Drop a customer QBO no longer accepts from memory and StudentQBOCustomer."""
+    if not customer_id:
+        return
+    for memo in (_by_student, _by_name):
+        for key in [k for k, v in memo.items() if k[0] == realm_id and v == customer_id]:
+            del memo[key]
+    StudentQBOCustomer.objects.filter(realm_id=realm_id, customer_id=customer_id).delete()
+
+def _display_name(name: str, suffix: str) -> str:
+    """`name suffix` within QBO's limit; the suffix keeps names unique, so the free text is what gets cut."""
+    return f"{name[:max(NAME_MAX - len(suffix) - 1, 0)].rstrip()} {suffix}"[:NAME_MAX]
+
+def student_display_name(student: Student) -> str:
+    name = student.full_name.strip()
+    return _display_name(name, f"({student.school_student_id})") if name else student.school_student_id[:NAME_MAX]
+
+def payment_display_name(payment) -> str:
+    return _display_name(payment.provider_student_id, f"({payment.provider})")
+
+def _quote(name: str) -> str:
+    return "'" + name.replace("\\", "\\\\").replace("'", "\\'") + "'"
+
+def _find(client, names: list[str]) -> dict[str, str]:
+    """{lower-cased display name: customer id} for the names that exist in QBO."""
+    found = {}
+    for i in range(0, len(names), QUERY_CHUNK):
+        in_list = ", ".join(_quote(n) for n in names[i:i + QUERY_CHUNK])
+        position = 1
+        while True:
+            page = client.query(f"SELECT Id, DisplayName FROM Customer WHERE DisplayName IN ({in_list}) "
+                                f"STARTPOSITION {position} MAXRESULTS {PAGE_SIZE}").get("Customer", [])
+            found.update({c["DisplayName"].lower(): str(c["Id"]) for c in page})
+            if len(page) < PAGE_SIZE:
+                break
+            position += PAGE_SIZE
+    return found
+
+def resolve_names(client, names) -> dict[str, str]:
+    """{display name: customer id}, creating the customers QBO doesn't have yet; names it can't resolve are left out."""
+    names = list(dict.fromkeys(names))
+    known = {n: c for n in names if (c := _get(_by_name, (client.realm_id, n.lower())))}
+    todo = [n for n in names if n not in known]
+    if todo:
+        found = _find(client, todo)
+        missing = [n for n in todo if n.lower() not in found]
+        for i in range(0, len(missing), client.batch_limit):
+            chunk = missing[i:i + client.batch_limit]
+            items = [{"bId": str(j), "operation": "create", "Customer": {"DisplayName": n}} for j, n in enumerate(chunk)]
+            for r in client.batch(items):
+                if r.get("Customer", {}).get("Id"):
+                    found[chunk[int(r["bId"])].lower()] = str(r["Customer"]["Id"])
+        if any(n.lower() not in found for n in missing):
+            # lost a create race (duplicate name) or the create faulted: whatever exists now wins
+            found.update(_find(client, [n for n in missing if n.lower() not in found]))
+        for n in todo:
+            if n.lower() in found:
+                known[n] = _put(_by_name, (client.realm_id, n.lower()), found[n.lower()])
+    return known
+
+def resolve_students(client, students: list[Student]) -> dict[int, str]:
+    """{student id: customer id}, from memory, then StudentQBOCustomer, then QBO (in bulk); unresolved students are left out."""
+    realm = client.realm_id
+    out = {s.id: c for s in students if (c := _get(_by_student, (realm, s.id)))}
+    todo = [s for s in students if s.id not in out]
+    if todo:
+        for student_id, customer_id in (StudentQBOCustomer.objects
+                                        .filter(realm_id=realm, student_id__in=[s.id for s in todo])
+                                        .values_list("student_id", "customer_id")):
+            out[student_id] = _put(_by_student, (realm, student_id), customer_id)
+        todo = [s for s in todo if s.id not in out]
+    if todo:
+        found = resolve_names(client, [student_display_name(s) for s in todo])
+        names = {s.id: student_display_name(s) for s in todo if student_display_name(s) in found}
+        StudentQBOCustomer.objects.bulk_create(
+            [StudentQBOCustomer(student_id=sid, realm_id=realm, customer_id=found[name], display_name=name)
+             for sid, name in names.items()], ignore_conflicts=True, batch_size=500)
+        for sid, name in names.items():
+            out[sid] = _put(_by_student, (realm, sid), found[name])
+    return out
+
+def resolve_payments(client, payments) -> dict[int, str]:
+    """{payment id: customer id}; a payment already booked to a customer keeps it, unresolved ones are left out."""
+    out = {p.id: p.qbo_customer_id for p in payments if p.qbo_customer_id}
+    todo = [p for p in payments if p.id not in out]
+    students = {s.id: s for s in Student.objects.filter(id__in={p.student_id for p in todo if p.student_id})}
+    by_student = resolve_students(client, list(students.values())) if students else {}
+    names = resolve_names(client, [payment_display_name(p) for p in todo if p.student_id not in students])
+    for p in todo:
+        customer_id = by_student.get(p.student_id) if p.student_id in students else names.get(payment_display_name(p))
+        if customer_id:
+            out[p.id] = customer_id
+    return out
@@ -0,0 +1,159 @@
+# qbo/invoices.py
+"""
+Open-invoice matching without a QBO round-trip per payment. Each realm's invoices are copied
+into QBOInvoice (a full load, then ChangeDataCapture polls from the sync_qbo_invoices beat
+task), and every worker keeps an in-memory index of the open ones keyed by
+(customer_id, open balance in minor units, narration).
+
+The index is only a hint. claim() takes an invoice with a conditional UPDATE on open_minor,
+so two concurrent syncs can't apply payments to the same invoice. The claim (QBOInvoiceClaim)
+stays until QBO's copy of the invoice lists the payment in LinkedTxn, so a CDC poll that
+lands before QBO has applied the payment doesn't reopen the invoice. Workers rebuild their
+index when the realm's version key in the shared cache moves (after a poll or a release).
+"""
+from collections import defaultdict
+from datetime import timedelta
+from decimal import Decimal
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import F
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+from schools.models import QBOConnection, QBOInvoice, QBOInvoiceClaim
+from .client import match_invoice
+
+VERSION_KEY = "qbo:invoices:version:{school_id}"
+CDC_LOOKBACK = timedelta(days=29)  # QBO keeps 30 days of changes
+CDC_OVERLAP = timedelta(minutes=1)
+PAGE_SIZE = 1000
+
+def minor_units(amount) -> int:
+    return int((Decimal(str(amount)) * 100).quantize(Decimal(1)))
+
+def _narration(inv: dict) -> str:
+    lines = inv.get("Line") or [{}]
+    return (lines[0].get("Description") or "").strip().lower()[:255]
+
+class _Index:
+    def __init__(self, version, ready: bool):
+        self.version = version
+        self.ready = ready
+        self.by_key: dict[tuple[str, int, str], list[int]] = defaultdict(list)
+
+# school_id -> index of that realm's open invoices
+_indexes: dict[int, _Index] = {}
+
+def _version(school_id: int):
+    return cache.get(VERSION_KEY.format(school_id=school_id)) or 0
+
+def _bump(school_id: int):
+    key = VERSION_KEY.format(school_id=school_id)
+    cache.add(key, 0, None)
+    try:
+        cache.incr(key)
+    except ValueError:
+        cache.set(key, 1, None)
+
+def _index(school_id: int) -> _Index:
+    version = _version(school_id)
+    idx = _indexes.get(school_id)
+    if idx is None or idx.version != version:
+        ready = QBOConnection.objects.filter(school_id=school_id, invoices_synced_at__isnull=False).exists()
+        idx = _Index(version, ready)
+        for pk, customer_id, open_minor, narration in (QBOInvoice.objects
+                .filter(connection__school_id=school_id, open_minor__gt=0).order_by("id")
+                .values_list("id", "customer_id", "open_minor", "narration")):
+            idx.by_key[(customer_id, open_minor, narration)].append(pk)
+        _indexes[school_id] = idx
+    return idx
+
+def is_cached(school_id: int) -> bool:
+    """Whether the school's invoices have been loaded; until then callers query QBO live."""
+    return _index(school_id).ready
+
+def claim(payment, customer_id: str) -> str | None:
+    """
+    Reserve the open invoice whose balance equals payment.amount and whose first line matches
+    the narration; returns its QBO id. A payment keeps the invoice it already claimed.
+    """
+    existing = (QBOInvoiceClaim.objects.filter(payment_id=payment.id)
+                .values_list("invoice__invoice_id", flat=True).first())
+    if existing:
+        return existing
+    amount = minor_units(payment.amount)
+    candidates = _index(payment.school_id).by_key.get((customer_id, amount, str(payment.narration).strip().lower()))
+    while candidates:
+        pk = candidates.pop(0)  # claimed here or (stale hint) by someone else: gone either way
+        with transaction.atomic():
+            if QBOInvoice.objects.filter(pk=pk, open_minor=amount).update(open_minor=F("open_minor") - amount):
+                QBOInvoiceClaim.objects.create(invoice_id=pk, payment_id=payment.id, amount_minor=amount)
+                return QBOInvoice.objects.values_list("invoice_id", flat=True).get(pk=pk)
+    return None
+
+def match(client, payment, customer_id: str) -> str | None:
+    """QBO id of the open invoice to apply `payment` to: claimed locally once loaded, else matched live."""
+    if is_cached(payment.school_id):
+        return claim(payment, customer_id)
+    inv = match_invoice(client.find_open_invoices(customer_id), payment)
+    return str(inv["Id"]) if inv else None
+
+def release(payments):
+    """Give back invoices claimed for payments whose QBO Payment was not created."""
+    claims = list(QBOInvoiceClaim.objects.filter(payment_id__in=[p.id for p in payments]))
+    if not claims:
+        return
+    with transaction.atomic():
+        for c in claims:
+            QBOInvoice.objects.filter(pk=c.invoice_id).update(open_minor=F("open_minor") + c.amount_minor)
+        QBOInvoiceClaim.objects.filter(pk__in=[c.pk for c in claims]).delete()
+    for school_id in {p.school_id for p in payments}:
+        _bump(school_id)
+
+def apply_invoices(conn: QBOConnection, invoices: list[dict], now=None) -> int:
+    """Upsert QBO invoice objects (query or CDC results); settled claims are dropped."""
+    now = now or timezone.now()
+    for inv in invoices:
+        if inv.get("status") == "Deleted":
+            QBOInvoice.objects.filter(connection=conn, invoice_id=str(inv["Id"])).delete()
+            continue
+        balance = minor_units(inv.get("Balance", 0))
+        linked = {str(t.get("TxnId")) for t in inv.get("LinkedTxn", []) if t.get("TxnType") == "Payment"}
+        with transaction.atomic():
+            row, _ = QBOInvoice.objects.select_for_update().update_or_create(
+                connection=conn, invoice_id=str(inv["Id"]),
+                defaults={"customer_id": str((inv.get("CustomerRef") or {}).get("value", "")),
+                          "narration": _narration(inv), "balance_minor": balance, "open_minor": balance,
+                          "qbo_updated_at": parse_datetime((inv.get("MetaData") or {}).get("LastUpdatedTime") or ""),
+                          "synced_at": now},
+            )
+            pending = 0
+            for c in row.claims.select_related("payment"):
+                if c.payment.qbo_txn_id and c.payment.qbo_txn_id in linked:
+                    c.delete()  # QBO's balance already includes it
+                else:
+                    pending += c.amount_minor
+            if pending:
+                QBOInvoice.objects.filter(pk=row.pk).update(open_minor=max(balance - pending, 0))
+    return len(invoices)
+
+def refresh_invoices(conn: QBOConnection, client) -> int:
+    """Full load of open invoices on first use (or past the CDC window), else a CDC poll."""
+    started = timezone.now()
+    if conn.invoices_synced_at is None or started - conn.invoices_synced_at > CDC_LOOKBACK:
+        changed, position = 0, 1
+        while True:
+            page = client.query(f"SELECT * FROM Invoice WHERE Balance > '0' "
+                                f"STARTPOSITION {position} MAXRESULTS {PAGE_SIZE}").get("Invoice", [])
+            changed += apply_invoices(conn, page, started)
+            if len(page) < PAGE_SIZE:
+                break
+            position += PAGE_SIZE
+        # whatever the load didn't return is closed (or deleted) in QBO
+        QBOInvoice.objects.filter(connection=conn, synced_at__lt=started).delete()
+    else:
+        changed = apply_invoices(
+            conn, client.change_data_capture(["Invoice"], conn.invoices_synced_at - CDC_OVERLAP).get("Invoice", []), started)
+    conn.invoices_synced_at = started
+    conn.save(update_fields=["invoices_synced_at"])
+    _bump(conn.school_id)
+    return changed
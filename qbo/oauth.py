@@ -1,6 +1,6 @@
 # qbo/oauth.py
-import requests
 from django.conf import settings
+from .sessions import OAUTH, session_for, timeout
 
 TOKEN_URL = "https://oauth.platform.intuit.com/oauth2/v1/tokens/bearer"
 
@@ -15,7 +15,7 @@ def exchange_code_for_tokens(code: str) -> dict:
         "code": code,
         "redirect_uri": settings.QBO_REDIRECT_URI,
     }
-    r = requests.post(TOKEN_URL, data=data, auth=auth, timeout=20)
+    r = session_for(OAUTH).post(TOKEN_URL, data=data, auth=auth, timeout=timeout(read=20))
     r.raise_for_status()
     return r.json()
 
@@ -25,6 +25,6 @@ def refresh_access_token(refresh_token: str) -> dict:
     """
     auth = (settings.QBO_CLIENT_ID, settings.QBO_CLIENT_SECRET)
     data = {"grant_type": "refresh_token", "refresh_token": refresh_token}
-    r = requests.post(TOKEN_URL, data=data, auth=auth, timeout=20)
+    r = session_for(OAUTH).post(TOKEN_URL, data=data, auth=auth, timeout=timeout(read=20))
     r.raise_for_status()
     return r.json()
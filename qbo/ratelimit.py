@@ -0,0 +1,110 @@
+# qbo/ratelimit.py
+"""
+Per-realm pacing of QBO API calls, shared by every worker through the cache (Redis in
+production). QBO throttles a realm at about 500 requests a minute and a handful in flight.
+  - rate: each wall-clock second a realm may start its share of the per-minute rate, counted
+    with cache.incr on a per-second key, so the allowance refills evenly instead of in
+    minute-sized bursts. The rate adapts (AIMD): it grows by QBO_RATE_INCREASE every second
+    up to QBO_RATE_LIMIT_PER_MINUTE and is halved when QBO answers 429.
+  - concurrency: QBO_MAX_CONCURRENT slots per realm, taken with cache.add and given back when
+    the response arrives (or when the slot's TTL runs out, if the worker died).
+  - Retry-After: a 429 pauses the whole realm for as long as QBO asks.
+A caller that would have to wait longer than QBO_RATE_MAX_WAIT seconds gets Throttled with the
+delay, so tasks retry later instead of holding a worker.
+"""
+import math, random, time, uuid
+from contextlib import contextmanager
+from django.conf import settings
+from django.core.cache import cache
+
+KEY_PREFIX = "qbo:rate"
+DEFAULT_PAUSE = 5.0  # seconds, for a 429 without Retry-After
+
+class Throttled(Exception):
+    def __init__(self, realm_id: str, retry_after: float):
+        super().__init__(f"QBO realm {realm_id} throttled, retry in {retry_after:.1f}s")
+        self.realm_id = realm_id
+        self.retry_after = retry_after
+
+def _key(kind: str, realm_id: str, suffix="") -> str:
+    return f"{KEY_PREFIX}:{kind}:{realm_id}:{suffix}"
+
+def _ceiling() -> int:
+    return int(getattr(settings, "QBO_RATE_LIMIT_PER_MINUTE", 450))
+
+def current_rate(realm_id: str) -> int:
+    """Requests per minute the realm is paced at right now."""
+    rate = cache.get(_key("rpm", realm_id))
+    return min(rate, _ceiling()) if rate else _ceiling()
+
+def allowance(rate: int, second: int) -> int:
+    """Requests that may start during one epoch second; any 60 consecutive seconds add up to `rate`."""
+    return rate * (second + 1) // 60 - rate * second // 60
+
+def _wait_until(realm_id: str, until: float, deadline: float):
+    if until > deadline:
+        raise Throttled(realm_id, until - time.time())
+    time.sleep(max(until - time.time(), 0))
+
+def _take_rate(realm_id: str, deadline: float):
+    while True:
+        now = time.time()
+        paused = cache.get(_key("pause", realm_id))
+        if paused and paused > now:
+            _wait_until(realm_id, paused, deadline)
+            continue
+        second = int(now)
+        key = _key("count", realm_id, second)
+        cache.add(key, 0, 5)
+        try:
+            n = cache.incr(key)
+        except ValueError:  # expired between add and incr
+            continue
+        rate = current_rate(realm_id)
+        if n == 1 and rate < _ceiling():
+            # first request of the second: additive increase, at most once a second per realm
+            rate = min(rate + int(getattr(settings, "QBO_RATE_INCREASE", 10)), _ceiling())
+            cache.set(_key("rpm", realm_id), rate, None)
+        if n <= allowance(rate, second):
+            return
+        _wait_until(realm_id, second + 1, deadline)
+
+def _take_slot(realm_id: str, token: str, ttl: int, deadline: float) -> str:
+    n = int(getattr(settings, "QBO_MAX_CONCURRENT", 10))
+    while True:
+        start = random.randrange(n)
+        for i in range(n):
+            key = _key("slot", realm_id, (start + i) % n)
+            if cache.add(key, token, ttl):
+                return key
+        _wait_until(realm_id, time.time() + 0.05, deadline)
+
+@contextmanager
+def slot(realm_id: str, max_wait: float | None = None, timeout: int = 60):
+    """Hold one of the realm's concurrent-request slots and a rate token for the duration of one call."""
+    if max_wait is None:
+        max_wait = float(getattr(settings, "QBO_RATE_MAX_WAIT", 10))
+    deadline = time.time() + max_wait
+    token = uuid.uuid4().hex
+    key = _take_slot(realm_id, token, int(max_wait + timeout) + 5, deadline)
+    try:
+        _take_rate(realm_id, deadline)
+        yield
+    finally:
+        if cache.get(key) == token:
+            cache.delete(key)
+
+def throttled(realm_id: str, retry_after=None) -> float:
+    """Record a 429 for the realm: pause it for Retry-After seconds and halve its rate. Returns the seconds until it resumes."""
+    try:
+        pause = max(float(retry_after), 0.0)
+    except (TypeError, ValueError):
+        pause = DEFAULT_PAUSE  # missing, or an HTTP date QBO doesn't send
+    now = time.time()
+    until = max(now + pause, cache.get(_key("pause", realm_id)) or 0)
+    cache.set(_key("pause", realm_id), until, math.ceil(until - now) + 1)
+    # the other in-flight requests of the same burst get 429s too; cut the rate once per burst
+    if cache.add(_key("cut", realm_id), 1, max(math.ceil(pause), 1)):
+        floor = int(getattr(settings, "QBO_RATE_MIN_PER_MINUTE", 60))
+        cache.set(_key("rpm", realm_id), max(current_rate(realm_id) // 2, floor), None)
+    return until - now
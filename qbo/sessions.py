@@ -0,0 +1,59 @@
+# qbo/sessions.py
+"""
+Keep-alive HTTP sessions for Intuit: one per realm for the accounting API (sized to the realm's
+concurrency limit) and one for the OAuth token endpoint, shared by all threads of the process.
+urllib3 retries connection failures and 5xx answers; QBOClient makes creates safe to resend
+with a `requestid`. OAuth calls only retry failed connects, since a refresh token rotates as
+soon as Intuit reads the request.
+"""
+import threading
+import requests
+from django.conf import settings
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+OAUTH = "oauth"
+
+_sessions: dict[str, requests.Session] = {}
+_sessions_lock = threading.Lock()
+
+def timeout(read: float | None = None) -> tuple[float, float]:
+    return (float(getattr(settings, "QBO_CONNECT_TIMEOUT", 5)),
+            read if read is not None else float(getattr(settings, "QBO_READ_TIMEOUT", 60)))
+
+def _retry(key: str) -> Retry:
+    retries = int(getattr(settings, "QBO_RETRIES", 2))
+    if key == OAUTH:
+        return Retry(total=retries, connect=retries, read=0, status=0, other=0, raise_on_status=False)
+    return Retry(
+        total=retries,
+        backoff_factor=0.5,
+        backoff_jitter=0.25,
+        status_forcelist=(500, 502, 503, 504),
+        allowed_methods=frozenset({"GET", "POST"}),
+        respect_retry_after_header=False,  # 429s go to qbo.ratelimit, not a sleep in here
+        raise_on_status=False,
+    )
+
+def session_for(key: str) -> requests.Session:
+    """The shared session for a realm id (or OAUTH)."""
+    with _sessions_lock:
+        session = _sessions.get(key)
+        if session is None:
+            adapter = HTTPAdapter(
+                pool_connections=1,
+                pool_maxsize=int(getattr(settings, "QBO_MAX_CONCURRENT", 10)),
+                max_retries=_retry(key),
+            )
+            session = requests.Session()
+            session.headers.update({"Accept": "application/json", "Accept-Encoding": "gzip"})
+            session.mount("http://", adapter)
+            session.mount("https://", adapter)
+            _sessions[key] = session
+        return session
+
+def close_sessions():
+    with _sessions_lock:
+        for session in _sessions.values():
+            session.close()
+        _sessions.clear()
@@ -1,8 +1,20 @@
+import logging, math, random
+from datetime import timedelta
 from celery import shared_task
 from django.conf import settings
-from payments.models import Payment
+from django.db import transaction
+from django.utils import timezone
+from payments.models import Payment, PaymentOutbox
 from payments.enums import PaymentStatus
-from .client import QBOClient
+from schools.models import QBOConnection, School
+from .batch import UNCONFIRMED, pending_payments, sync_batch, unconfirmed_payments
+from . import customers as qbo_customers
+from . import invoices as qbo_invoices
+from .client import QBOClient, QBOError
+from .ratelimit import Throttled
+from .tokens import refresh
+
+logger = logging.getLogger(__name__)
 
 @shared_task(bind=True, autoretry_for=(Exception,), retry_backoff=True, max_retries=3)
 def sync_payment_to_qbo(self, payment_id: int):
@@ -11,36 +23,171 @@ def sync_payment_to_qbo(self, payment_id: int):
     p = Payment.objects.select_related("school").get(id=payment_id)
     if p.qbo_txn_id or p.status != PaymentStatus.SUCCEEDED.value:
         return
-    if not hasattr(p.school, "qbo"):
-        return
+    if p.qbo_sync_error.startswith(UNCONFIRMED):
+        return  # QBO may already have it from a batch; only that batch's resend may book it
+    if p.needs_enrichment:
+        return  # not under a placeholder customer: reenrich_pending_payments queues it again once linked
 
     client = QBOClient(p.school)
-    client.ensure_token()
-    cust = client.find_or_create_customer(p)
-    customer_id = str(cust.get("Id"))
-
-    if p.qbo_invoice_id:
-        # Pay existing invoice
-        result = client.create_payment(p, customer_id, p.qbo_invoice_id)
-        p.qbo_txn_type = "Payment"
-    else:
-        # Check for matching open invoice
-        open_invoices = client.find_open_invoices(customer_id)
-        matching_invoice = None
-        for inv in open_invoices:
-            if (inv.get("Balance", 0) == float(p.amount) and
-                inv.get("Line", [{}])[0].get("Description", "").lower() == p.narration.lower()):
-                matching_invoice = inv
-                break
-        if matching_invoice:
-            p.qbo_invoice_id = str(matching_invoice["Id"])
+    if not client.ensure_token():
+        return  # school not connected to QBO
+    customer_id = ""
+    try:
+        cust = client.find_or_create_customer(p)
+        if not cust:
+            p.qbo_sync_error = qbo_customers.UNRESOLVED
+            p.save(update_fields=["qbo_sync_error", "updated_at"])
+            return
+        customer_id = str(cust.get("Id"))
+
+        if p.qbo_invoice_id:
+            # Pay existing invoice
             result = client.create_payment(p, customer_id, p.qbo_invoice_id)
             p.qbo_txn_type = "Payment"
         else:
-            # Create sales receipt
-            result = client.create_sales_receipt(p, customer_id)
-            p.qbo_txn_type = "SalesReceipt"
+            # Check for matching open invoice
+            invoice_id = qbo_invoices.match(client, p, customer_id)
+            if invoice_id:
+                p.qbo_invoice_id = invoice_id
+                try:
+                    result = client.create_payment(p, customer_id, p.qbo_invoice_id)
+                except Exception:
+                    qbo_invoices.release([p])
+                    raise
+                p.qbo_txn_type = "Payment"
+            else:
+                # Create sales receipt
+                result = client.create_sales_receipt(p, customer_id)
+                p.qbo_txn_type = "SalesReceipt"
+    except Throttled as exc:
+        # QBO asked the realm to back off: come back when it says, with a bigger budget than errors get
+        raise self.retry(exc=exc, countdown=math.ceil(exc.retry_after) + random.randint(0, 5),
+                         max_retries=int(getattr(settings, "QBO_THROTTLE_MAX_RETRIES", 20)))
+    except QBOError as exc:
+        if exc.retryable:
+            raise
+        # QBO rejected the request itself; resending it won't help, so park it like a batch fault
+        if qbo_customers.INVALID_REFERENCE in str(exc):
+            qbo_customers.forget(client.realm_id, customer_id)  # merged or deleted: the retry resolves it afresh
+            p.qbo_customer_id = None
+        p.qbo_sync_error = str(exc)[:500]
+        p.save(update_fields=["qbo_customer_id", "qbo_sync_error", "updated_at"])
+        return
 
     p.qbo_txn_id = str(result.get("Id")) if isinstance(result, dict) else p.qbo_txn_id
     p.qbo_customer_id = customer_id
-    p.save(update_fields=["qbo_txn_id","qbo_txn_type","qbo_invoice_id","qbo_customer_id","updated_at"])
\ No newline at end of file
+    p.qbo_sync_error = ""
+    p.save(update_fields=["qbo_txn_id","qbo_txn_type","qbo_invoice_id","qbo_customer_id","qbo_sync_error","updated_at"])
+
+@shared_task
+def relay_payment_outbox():
+    """
+    Publish committed PaymentOutbox rows, QBO_OUTBOX_BATCH_SIZE at a time: one sync_payment_to_qbo
+    each, or in batch mode one sync_school_batch per school. Rows are claimed with FOR UPDATE
+    SKIP LOCKED and marked dispatched in one transaction, so concurrent relays split the work,
+    and published only after it commits, so the broker never holds the row locks. A publish that
+    fails puts the rows it didn't get to back for the next relay.
+    """
+    if not getattr(settings, "QBO_SYNC_ENABLED", False):
+        return 0  # keep the rows until sync is switched on
+    size = int(getattr(settings, "QBO_OUTBOX_BATCH_SIZE", 500))
+    relayed = 0
+    while True:
+        with transaction.atomic():
+            rows = list(PaymentOutbox.objects.select_for_update(skip_locked=True, of=("self",))
+                        .filter(dispatched_at__isnull=True).order_by("id")
+                        .values_list("id", "payment_id", "payment__school_id")[:size])
+            PaymentOutbox.objects.filter(id__in=[pk for pk, _, _ in rows]).update(dispatched_at=timezone.now())
+        if getattr(settings, "QBO_SYNC_MODE", "task") == "batch":
+            by_school = {}
+            for pk, _, school_id in rows:
+                by_school.setdefault(school_id, []).append(pk)
+            messages = [(sync_school_batch, {"school_id": school_id}, pks) for school_id, pks in by_school.items()]
+        else:
+            messages = [(sync_payment_to_qbo, {"payment_id": payment_id}, [pk]) for pk, payment_id, _ in rows]
+        for i, (task, kwargs, _) in enumerate(messages):
+            try:
+                task.delay(**kwargs)
+            except Exception:
+                unsent = [pk for _, _, pks in messages[i:] for pk in pks]
+                PaymentOutbox.objects.filter(id__in=unsent).update(dispatched_at=None)
+                raise
+        relayed += len(rows)
+        if len(rows) < size:
+            return relayed
+
+@shared_task
+def prune_payment_outbox():
+    """Drop outbox rows dispatched more than QBO_OUTBOX_RETENTION_DAYS ago."""
+    cutoff = timezone.now() - timedelta(days=int(getattr(settings, "QBO_OUTBOX_RETENTION_DAYS", 7)))
+    return PaymentOutbox.objects.filter(dispatched_at__lt=cutoff).delete()[0]
+
+@shared_task
+def retry_parked_payments():
+    """
+    Put payments parked with qbo_sync_error (customer unresolved, rejected by QBO) back in the
+    outbox once QBO_PARKED_RETRY_SECONDS have passed since they were parked. Batches QBO may
+    have applied (UNCONFIRMED) are left to sync_batch's resend.
+    """
+    cutoff = timezone.now() - timedelta(seconds=int(getattr(settings, "QBO_PARKED_RETRY_SECONDS", 6 * 3600)))
+    size = int(getattr(settings, "QBO_OUTBOX_BATCH_SIZE", 500))
+    retried = 0
+    while True:
+        with transaction.atomic():
+            ids = list(Payment.objects.select_for_update(skip_locked=True)
+                       .filter(status=PaymentStatus.SUCCEEDED.value, qbo_txn_id__isnull=True, updated_at__lt=cutoff)
+                       .exclude(qbo_sync_error="").exclude(qbo_sync_error__startswith=UNCONFIRMED)
+                       .order_by("id").values_list("id", flat=True)[:size])
+            Payment.objects.filter(id__in=ids).update(qbo_sync_error="", updated_at=timezone.now())
+            PaymentOutbox.objects.requeue(ids)
+        retried += len(ids)
+        if len(ids) < size:
+            return retried
+
+@shared_task
+def sync_pending_to_qbo():
+    """Beat entry for QBO_SYNC_MODE=batch: one sync_school_batch per connected school with work."""
+    if not getattr(settings, "QBO_SYNC_ENABLED", False) or getattr(settings, "QBO_SYNC_MODE", "task") != "batch":
+        return 0
+    school_ids = sorted(set(pending_payments().values_list("school_id", flat=True).distinct()) |
+                        set(unconfirmed_payments().values_list("school_id", flat=True).distinct()))
+    for school_id in school_ids:
+        sync_school_batch.delay(school_id=school_id)
+    return len(school_ids)
+
+@shared_task
+def sync_school_batch(school_id: int):
+    if not getattr(settings, "QBO_SYNC_ENABLED", False):
+        return
+    school = School.objects.select_related("qbo").get(id=school_id)
+    synced, failed = sync_batch(school)
+    for payment_id in failed:
+        sync_payment_to_qbo.delay(payment_id=payment_id)
+    return synced
+
+@shared_task
+def refresh_qbo_tokens():
+    """Refresh tokens expiring within QBO_TOKEN_REFRESH_AHEAD seconds, ahead of the sync tasks."""
+    ahead = int(getattr(settings, "QBO_TOKEN_REFRESH_AHEAD", 300))
+    refreshed = 0
+    for conn in QBOConnection.objects.filter(token_expires_at__lt=timezone.now() + timedelta(seconds=ahead)):
+        try:
+            refresh(conn, ahead)
+            refreshed += 1
+        except Exception:
+            logger.exception("QBO token refresh failed for realm %s", conn.realm_id)
+    return refreshed
+
+
+@shared_task
+def sync_qbo_invoices():
+    """Pull invoice changes (ChangeDataCapture) into each realm's local open-invoice cache."""
+    changed = 0
+    for conn in QBOConnection.objects.select_related("school"):
+        client = QBOClient(conn.school)
+        try:
+            if client.ensure_token():
+                changed += qbo_invoices.refresh_invoices(conn, client)
+        except Exception:
+            logger.exception("QBO invoice sync failed for realm %s", conn.realm_id)
+    return changed
@@ -0,0 +1,106 @@
+# qbo/tokens.py
+"""
+QBO access tokens shared across workers. A valid token is served from process memory, then
+from the shared cache, and only then from the QBOConnection row. Refreshing is single-flight
+per realm: the worker holding the cache.add lock re-reads the row under select_for_update
+(so it always sends the latest rotated refresh token), refreshes, saves and publishes the new
+token; the others wait up to QBO_TOKEN_LOCK_WAIT seconds for it instead of calling Intuit.
+The refresh_qbo_tokens beat task refreshes QBO_TOKEN_REFRESH_AHEAD seconds before expiry,
+so sync tasks normally never wait on OAuth.
+"""
+import time, uuid
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from django.utils import timezone
+from schools.models import QBOConnection
+import qbo.oauth as qbo_oauth
+
+CACHE_KEY = "qbo:token:{school_id}"
+LOCK_KEY = "qbo:token:lock:{realm_id}"
+
+# school_id -> (realm_id, access_token, expires_at as epoch seconds)
+_local: dict[int, tuple[str, str, float]] = {}
+
+def _skew() -> int:
+    return int(getattr(settings, "QBO_TOKEN_SKEW_SECONDS", 60))
+
+def _fresh(entry, margin: int) -> bool:
+    return bool(entry) and entry[2] - margin > time.time()
+
+def _entry(conn: QBOConnection) -> tuple[str, str, float]:
+    return conn.realm_id, conn.access_token, conn.token_expires_at.timestamp() if conn.token_expires_at else 0.0
+
+def _publish(school_id: int, entry):
+    _local[school_id] = entry
+    ttl = int(entry[2] - time.time()) - _skew()
+    if ttl > 0:
+        cache.set(CACHE_KEY.format(school_id=school_id), entry, ttl)
+
+def get_token(school_id: int) -> tuple[str, str] | None:
+    """(realm_id, access_token) valid for at least QBO_TOKEN_SKEW_SECONDS, or None if the school isn't connected."""
+    skew = _skew()
+    entry = _local.get(school_id)
+    if not _fresh(entry, skew):
+        entry = cache.get(CACHE_KEY.format(school_id=school_id))
+        if _fresh(entry, skew):
+            _local[school_id] = entry
+        else:
+            conn = QBOConnection.objects.filter(school_id=school_id).first()
+            if conn is None:
+                return None
+            entry = _entry(conn)
+            if _fresh(entry, skew):
+                _publish(school_id, entry)
+            else:
+                entry = refresh(conn, skew)
+    return entry[0], entry[1]
+
+def invalidate(school_id: int):
+    """Forget a token QBO rejected (revoked or rotated elsewhere)."""
+    _local.pop(school_id, None)
+    cache.delete(CACHE_KEY.format(school_id=school_id))
+
+def reject(school_id: int, access_token: str) -> tuple[str, str] | None:
+    """QBO answered 401 to access_token: forget it and get a new one (one refresh across workers)."""
+    invalidate(school_id)
+    conn = QBOConnection.objects.filter(school_id=school_id).first()
+    if conn is None:
+        return None
+    entry = refresh(conn, rejected=access_token)
+    return entry[0], entry[1]
+
+def refresh(conn: QBOConnection, margin: int | None = None, rejected: str | None = None) -> tuple[str, str, float]:
+    """
+    Make sure conn's token is valid for `margin` more seconds (and isn't `rejected`), refreshing
+    at most once across workers.
+    """
+    if margin is None:
+        margin = _skew()
+    lock = LOCK_KEY.format(realm_id=conn.realm_id)
+    token = uuid.uuid4().hex
+    mine = cache.add(lock, token, int(getattr(settings, "QBO_TOKEN_LOCK_SECONDS", 30)))
+    if not mine:
+        deadline = time.monotonic() + float(getattr(settings, "QBO_TOKEN_LOCK_WAIT", 10))
+        while time.monotonic() < deadline:
+            entry = cache.get(CACHE_KEY.format(school_id=conn.school_id))
+            if _fresh(entry, margin) and entry[1] != rejected:
+                _local[conn.school_id] = entry
+                return entry
+            time.sleep(0.05)
+        # holder died or is slow: fall through, the row lock below still keeps this to one refresh
+    try:
+        with transaction.atomic():
+            conn = QBOConnection.objects.select_for_update().get(pk=conn.pk)
+            if not _fresh(_entry(conn), margin) or conn.access_token == rejected:
+                data = qbo_oauth.refresh_access_token(conn.refresh_token)
+                conn.access_token = data["access_token"]
+                conn.refresh_token = data.get("refresh_token", conn.refresh_token)
+                conn.token_expires_at = timezone.now() + timezone.timedelta(seconds=int(data.get("expires_in", 2500)))
+                conn.save(update_fields=["access_token", "refresh_token", "token_expires_at"])
+        entry = _entry(conn)
+        _publish(conn.school_id, entry)
+        return entry
+    finally:
+        if mine and cache.get(lock) == token:
+            cache.delete(lock)
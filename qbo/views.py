@@ -5,6 +5,7 @@ from django.core import signing
 from django.utils import timezone
 from schools.models import School, QBOConnection
 import qbo.oauth as qbo_oauth
+import qbo.tokens as qbo_tokens
 
 SCOPES = ["com.intuit.quickbooks.accounting"]
 AUTH_URL = "https://appcenter.intuit.com/connect/oauth2"
@@ -51,4 +52,5 @@ def qbo_callback(request):
             "token_expires_at": expires,
         },
     )
+    qbo_tokens.invalidate(school.id)
     return JsonResponse({"detail": "connected", "school": school.code, "realm_id": conn.realm_id})
\ No newline at end of file
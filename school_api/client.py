@@ -1,10 +1,118 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
 import requests
+from django.conf import settings
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+# One keep-alive session per directory connection, shared by all threads of the process
+_sessions: dict[tuple, requests.Session] = {}
+_sessions_lock = threading.Lock()
+
+def _session_for(conn) -> requests.Session:
+    key = (conn.pk, conn.base_url)
+    with _sessions_lock:
+        session = _sessions.get(key)
+        if session is None:
+            retry = Retry(
+                total=int(getattr(settings, "SCHOOL_API_RETRIES", 2)),
+                backoff_factor=0.2,
+                backoff_jitter=0.2,
+                status_forcelist=(502, 503, 504),
+                allowed_methods=frozenset({"GET", "POST"}),
+                raise_on_status=False,
+            )
+            adapter = HTTPAdapter(
+                pool_connections=1,
+                pool_maxsize=int(getattr(settings, "SCHOOL_API_POOL_SIZE", 10)),
+                max_retries=retry,
+            )
+            session = requests.Session()
+            session.mount("http://", adapter)
+            session.mount("https://", adapter)
+            _sessions[key] = session
+        return session
+
+def close_sessions():
+    with _sessions_lock:
+        for session in _sessions.values():
+            session.close()
+        _sessions.clear()
+
 class SchoolAPIClient:
     def __init__(self, conn):
         self.conn = conn
+        self.session = _session_for(conn)
+        self.failed_calls = 0  # requests of get_many that got no answer
     def _headers(self):
         return {"Authorization": f"Bearer {self.conn.api_key}", "Accept": "application/json"}
+    def _timeout(self):
+        return (self.conn.connect_timeout_seconds, self.conn.timeout_seconds)
     def get_by_provider_student_id(self, provider_student_id: str) -> dict | None:
         url = self.conn.base_url.rstrip("/") + self.conn.student_by_provider_id_path.format(provider_student_id=provider_student_id)
-        r = requests.get(url, headers=self._headers(), timeout=self.conn.timeout_seconds)
-        return r.json() if r.status_code == 200 else None
\ No newline at end of file
+        r = self.session.get(url, headers=self._headers(), timeout=self._timeout())
+        if r.status_code >= 500:
+            r.raise_for_status()  # an outage, not an unknown student
+        return r.json() if r.status_code == 200 else None
+    def get_many(self, provider_student_ids) -> dict[str, dict | None]:
+        """
+        Look up many ids. Unknown students map to None; ids whose lookup failed (timeout,
+        connection error, 5xx) are left out, and the failed requests are counted in failed_calls.
+        Uses the directory's bulk endpoint in chunks of SCHOOL_API_BULK_CHUNK when the connection
+        has one, else (or when the bulk endpoint rejects the call) concurrent single lookups
+        bounded by SCHOOL_API_MAX_CONCURRENCY.
+        """
+        ids = list(dict.fromkeys(provider_student_ids))
+        if not ids:
+            return {}
+        if not self.conn.students_by_provider_ids_path:
+            return self._get_many_single(ids)
+        out = {}
+        chunk = int(getattr(settings, "SCHOOL_API_BULK_CHUNK", 200))
+        for i in range(0, len(ids), chunk):
+            part = ids[i:i + chunk]
+            try:
+                found = self._get_bulk(part)
+            except requests.RequestException:
+                self.failed_calls += 1
+                continue  # directory unreachable; don't repeat the timeout once per student
+            out.update(found if found is not None else self._get_many_single(part))
+        return out
+    def _get_bulk(self, ids: list[str]) -> dict[str, dict | None] | None:
+        url = self.conn.base_url.rstrip("/") + self.conn.students_by_provider_ids_path
+        r = self.session.post(url, json={"provider_student_ids": ids}, headers=self._headers(), timeout=self._timeout())
+        if r.status_code >= 500:
+            r.raise_for_status()
+        if r.status_code != 200:
+            return None
+        try:
+            data = r.json()
+        except ValueError:
+            return None
+        if isinstance(data, dict):
+            data = data.get("results", data.get("students", []))
+        if not isinstance(data, list):
+            return None
+        out = dict.fromkeys(ids)
+        for item in data:
+            if not isinstance(item, dict):
+                continue  # malformed element: its id stays unresolved
+            pid = str(item.get("provider_student_id") or "")
+            if pid in out:
+                out[pid] = item
+        return out
+    def _get_many_single(self, ids: list[str]) -> dict[str, dict | None]:
+        failed = object()
+        def lookup(pid):
+            try:
+                return self.get_by_provider_student_id(pid)
+            except requests.RequestException:
+                return failed
+        workers = min(len(ids), int(getattr(settings, "SCHOOL_API_MAX_CONCURRENCY", 8)))
+        if workers <= 1:
+            found = [lookup(pid) for pid in ids]
+        else:
+            with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="school-api") as pool:
+                found = list(pool.map(lookup, ids))
+        self.failed_calls += sum(data is failed for data in found)
+        return {pid: data for pid, data in zip(ids, found) if data is not failed}
@@ -0,0 +1,105 @@
+# school_api/guard.py
+"""
+Protects workers from slow or dead school directories. Wraps SchoolAPIClient.get_many with:
+  - a negative cache: "unknown student" answers are remembered for SCHOOL_API_NEGATIVE_TTL,
+  - single-flight: one lookup per (school, provider_student_id) at a time across all workers
+    (a cache.add lock); the others wait up to SCHOOL_API_SINGLE_FLIGHT_WAIT for its answer,
+  - a per-school circuit breaker: SCHOOL_API_BREAKER_THRESHOLD failed requests in a row open it
+    for SCHOOL_API_BREAKER_COOLDOWN seconds, during which the directory isn't called at all.
+State lives in the shared cache so every worker sees the same breaker and locks.
+"""
+import time, uuid
+from django.conf import settings
+from django.core.cache import cache
+from school_api.client import SchoolAPIClient
+
+KEY_PREFIX = "school_api"
+MISS = "__miss__"
+
+def _key(kind: str, school_id: int, prov_sid: str = "") -> str:
+    return f"{KEY_PREFIX}:{kind}:{school_id}:{prov_sid}"
+
+def breaker_open(school_id: int) -> bool:
+    return cache.get(_key("breaker", school_id)) is not None
+
+def breaker_cooldown() -> int:
+    return int(getattr(settings, "SCHOOL_API_BREAKER_COOLDOWN", 60))
+
+class DirectoryGuard:
+    def get_many(self, conn, provider_student_ids) -> dict[str, dict | None]:
+        """
+        Same contract as SchoolAPIClient.get_many: unknown students map to None and ids that
+        could not be looked up (breaker open, failures, another worker's lookup still running)
+        are left out, so callers can tell "unknown" from "try again later".
+        """
+        school_id = conn.school_id
+        ids = list(dict.fromkeys(provider_student_ids))
+        out = {}
+        misses = cache.get_many([_key("miss", school_id, pid) for pid in ids])
+        for pid in ids:
+            if _key("miss", school_id, pid) in misses:
+                out[pid] = None
+        todo = [pid for pid in ids if pid not in out]
+        if not todo or breaker_open(school_id):
+            return out
+
+        token = uuid.uuid4().hex
+        lock_ttl = int(getattr(settings, "SCHOOL_API_SINGLE_FLIGHT_WAIT", 5)) + conn.connect_timeout_seconds + conn.timeout_seconds
+        mine = {pid for pid in todo if cache.add(_key("lock", school_id, pid), token, lock_ttl)}
+        waiting = [pid for pid in todo if pid not in mine]
+        if mine:
+            try:
+                client = SchoolAPIClient(conn)
+                found = client.get_many([pid for pid in todo if pid in mine])
+                self._record(conn, found, client.failed_calls)
+                out.update(found)
+            finally:
+                for pid in mine:
+                    if cache.get(_key("lock", school_id, pid)) == token:
+                        cache.delete(_key("lock", school_id, pid))
+        if waiting:
+            out.update(self._wait_for(school_id, waiting))
+        return out
+
+    def _record(self, conn, found: dict, failed: int):
+        """Share the answers; failed requests, not ids, count toward the breaker (a failed bulk call is one)."""
+        school_id = conn.school_id
+        negative_ttl = int(getattr(settings, "SCHOOL_API_NEGATIVE_TTL", 300))
+        # answers are shared briefly so single-flight waiters can pick them up
+        cache.set_many({_key("result", school_id, pid): (MISS if data is None else data) for pid, data in found.items()}, 30)
+        cache.set_many({_key("miss", school_id, pid): 1 for pid, data in found.items() if data is None}, negative_ttl)
+
+        failures_key = _key("failures", school_id)
+        if found:
+            cache.delete(failures_key)
+        if not failed:
+            return
+        cache.add(failures_key, 0, breaker_cooldown())
+        try:
+            count = cache.incr(failures_key, failed)
+        except ValueError:  # expired between add and incr
+            count = failed
+            cache.set(failures_key, count, breaker_cooldown())
+        if count >= int(getattr(settings, "SCHOOL_API_BREAKER_THRESHOLD", 5)):
+            cache.set(_key("breaker", school_id), 1, breaker_cooldown())
+            cache.delete(failures_key)
+
+    def _wait_for(self, school_id: int, ids: list[str]) -> dict[str, dict | None]:
+        out, pending = {}, list(ids)
+        deadline = time.monotonic() + float(getattr(settings, "SCHOOL_API_SINGLE_FLIGHT_WAIT", 5))
+        while pending:
+            results = cache.get_many([_key("result", school_id, pid) for pid in pending])
+            for pid in list(pending):
+                data = results.get(_key("result", school_id, pid))
+                if data is not None:
+                    out[pid] = None if data == MISS else data
+                    pending.remove(pid)
+            if not pending or time.monotonic() >= deadline:
+                break
+            locks = cache.get_many([_key("lock", school_id, pid) for pid in pending])
+            if not locks and not cache.get_many([_key("result", school_id, pid) for pid in pending]):
+                break  # the other lookup finished without an answer (it failed)
+            time.sleep(0.05)
+        return out
+
+directory_guard = DirectoryGuard()
@@ -0,0 +1,35 @@
+from django.core.management.base import BaseCommand, CommandError
+from schools.models import School, Student
+from qbo import customers as qbo_customers
+from qbo.client import QBOClient
+
+class Command(BaseCommand):
+    help = ("Map a school's students to QuickBooks customers in bulk (found by display name, created if missing). "
+            "Run once when a school connects QuickBooks; already-mapped students are skipped.")
+
+    def add_arguments(self, parser):
+        parser.add_argument("--school", required=True, help="School code.")
+        parser.add_argument("--batch-size", type=int, default=500)
+
+    def handle(self, *args, **opts):
+        school = School.objects.filter(code=opts["school"]).first()
+        if school is None:
+            raise CommandError(f"unknown school {opts['school']!r}")
+        client = QBOClient(school)
+        if not client.ensure_token():
+            raise CommandError(f"{school.code} is not connected to QuickBooks")
+        students = (Student.objects.filter(school=school)
+                    .exclude(qbo_customers__realm_id=client.realm_id).order_by("id"))
+        done, skipped, last_id = 0, 0, 0
+        while True:
+            batch = list(students.filter(id__gt=last_id)[:opts["batch_size"]])
+            if not batch:
+                break
+            last_id = batch[-1].id
+            mapped = qbo_customers.resolve_students(client, batch)
+            done += len(mapped)
+            skipped += len(batch) - len(mapped)
+            self.stdout.write(f"{done} students mapped")
+        if skipped:
+            self.stderr.write(f"{skipped} students could not be matched to or created as QuickBooks customers")
+        self.stdout.write(self.style.SUCCESS(f"{school.code}: {done} students mapped to QuickBooks customers"))
@@ -0,0 +1,19 @@
+# Generated by Django 4.2.23 on 2026-10-18 19:19
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('schools', '0004_qboconnection'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='studentidmap',
+            name='resolved_at',
+            field=models.DateTimeField(default=django.utils.timezone.now),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 4.2.23 on 2026-10-18 19:20
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('schools', '0005_studentidmap_resolved_at'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='schooldirectoryconnection',
+            name='connect_timeout_seconds',
+            field=models.IntegerField(default=3),
+        ),
+    ]
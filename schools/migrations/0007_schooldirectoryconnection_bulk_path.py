@@ -0,0 +1,18 @@
+# Generated by Django 4.2.23 on 2026-10-18 19:21
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('schools', '0006_schooldirectoryconnection_connect_timeout'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='schooldirectoryconnection',
+            name='students_by_provider_ids_path',
+            field=models.CharField(blank=True, default='', max_length=200),
+        ),
+    ]
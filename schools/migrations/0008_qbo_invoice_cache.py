@@ -0,0 +1,57 @@
+# Generated by Django 4.2.23 on 2026-10-18 19:50
+
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('payments', '0015_payment_qbo_sync_error'),
+        ('schools', '0007_schooldirectoryconnection_bulk_path'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='QBOInvoice',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('invoice_id', models.CharField(max_length=64)),
+                ('customer_id', models.CharField(max_length=64)),
+                ('narration', models.CharField(blank=True, default='', max_length=255)),
+                ('balance_minor', models.BigIntegerField()),
+                ('open_minor', models.BigIntegerField()),
+                ('qbo_updated_at', models.DateTimeField(blank=True, null=True)),
+                ('synced_at', models.DateTimeField(default=django.utils.timezone.now)),
+            ],
+        ),
+        migrations.AddField(
+            model_name='qboconnection',
+            name='invoices_synced_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.CreateModel(
+            name='QBOInvoiceClaim',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('amount_minor', models.BigIntegerField()),
+                ('created_at', models.DateTimeField(default=django.utils.timezone.now)),
+                ('invoice', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='claims', to='schools.qboinvoice')),
+                ('payment', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='qbo_invoice_claim', to='payments.payment')),
+            ],
+        ),
+        migrations.AddField(
+            model_name='qboinvoice',
+            name='connection',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='invoices', to='schools.qboconnection'),
+        ),
+        migrations.AddIndex(
+            model_name='qboinvoice',
+            index=models.Index(condition=models.Q(('open_minor__gt', 0)), fields=['connection', 'customer_id', 'open_minor'], name='qboinvoice_open'),
+        ),
+        migrations.AlterUniqueTogether(
+            name='qboinvoice',
+            unique_together={('connection', 'invoice_id')},
+        ),
+    ]
@@ -0,0 +1,29 @@
+# Generated by Django 4.2.23 on 2026-10-18 19:52
+
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('schools', '0008_qbo_invoice_cache'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='StudentQBOCustomer',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('realm_id', models.CharField(max_length=32)),
+                ('customer_id', models.CharField(max_length=64)),
+                ('display_name', models.CharField(max_length=500)),
+                ('created_at', models.DateTimeField(default=django.utils.timezone.now)),
+                ('student', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='qbo_customers', to='schools.student')),
+            ],
+            options={
+                'unique_together': {('realm_id', 'student')},
+            },
+        ),
+    ]
@@ -1,4 +1,5 @@
 from django.db import models
+from django.utils import timezone
 
 class School(models.Model):
     name = models.CharField(max_length=200)
@@ -18,6 +19,8 @@ class StudentIdMap(models.Model):
     # provider dimension not required if provider_student_id is unique per school
     provider_student_id = models.CharField(max_length=128)
     student = models.ForeignKey(Student, on_delete=models.CASCADE, related_name="provider_ids")
+    # last time the directory confirmed this mapping (see STUDENT_MAPPING_MAX_AGE)
+    resolved_at = models.DateTimeField(default=timezone.now)
     class Meta:
         unique_together = ("school", "provider_student_id")
 
@@ -25,9 +28,13 @@ class SchoolDirectoryConnection(models.Model):
     school = models.OneToOneField(School, on_delete=models.CASCADE, related_name="directory")
     base_url = models.URLField()
     api_key = models.TextField()
-    timeout_seconds = models.IntegerField(default=10)
+    timeout_seconds = models.IntegerField(default=10)  # read timeout
+    connect_timeout_seconds = models.IntegerField(default=3)
     # Directory resolves canonical student by provider_student_id alone
     student_by_provider_id_path = models.CharField(max_length=200, default="/students/by-provider-id/{provider_student_id}")
+    # Optional bulk endpoint, e.g. "/students/by-provider-ids": POST {"provider_student_ids": [...]}
+    # -> {"results": [{"provider_student_id", "school_student_id", "full_name"}, ...]}. Blank = unsupported.
+    students_by_provider_ids_path = models.CharField(max_length=200, blank=True, default="")
 
 
 class QBOConnection(models.Model):
@@ -36,4 +43,41 @@ class QBOConnection(models.Model):
     access_token = models.TextField()
     refresh_token = models.TextField()
     token_expires_at = models.DateTimeField()
-    company_currency = models.CharField(max_length=3, default="USD")
\ No newline at end of file
+    company_currency = models.CharField(max_length=3, default="USD")
+    # last ChangeDataCapture poll of invoices (qbo.invoices); null until the first full load
+    invoices_synced_at = models.DateTimeField(null=True, blank=True)
+
+class StudentQBOCustomer(models.Model):
+    """The QBO customer a student's payments are booked to, per realm (see qbo.customers)."""
+    student = models.ForeignKey(Student, on_delete=models.CASCADE, related_name="qbo_customers")
+    realm_id = models.CharField(max_length=32)
+    customer_id = models.CharField(max_length=64)
+    display_name = models.CharField(max_length=500)
+    created_at = models.DateTimeField(default=timezone.now)
+    class Meta:
+        unique_together = ("realm_id", "student")
+
+class QBOInvoice(models.Model):
+    """Local copy of a realm's invoice, kept current by qbo.invoices.refresh_invoices."""
+    connection = models.ForeignKey(QBOConnection, on_delete=models.CASCADE, related_name="invoices")
+    invoice_id = models.CharField(max_length=64)
+    customer_id = models.CharField(max_length=64)
+    # first line's description, lower-cased, as payment narrations are matched against it
+    narration = models.CharField(max_length=255, blank=True, default="")
+    balance_minor = models.BigIntegerField()  # QBO's Balance, in minor units
+    open_minor = models.BigIntegerField()     # balance less claims QBO hasn't reflected yet
+    qbo_updated_at = models.DateTimeField(null=True, blank=True)
+    synced_at = models.DateTimeField(default=timezone.now)
+    class Meta:
+        unique_together = ("connection", "invoice_id")
+        indexes = [
+            models.Index(fields=["connection", "customer_id", "open_minor"], condition=models.Q(open_minor__gt=0),
+                         name="qboinvoice_open"),
+        ]
+
+class QBOInvoiceClaim(models.Model):
+    """A payment applied (or being applied) to an invoice, until QBO's invoice lists it in LinkedTxn."""
+    invoice = models.ForeignKey(QBOInvoice, on_delete=models.CASCADE, related_name="claims")
+    payment = models.OneToOneField("payments.Payment", on_delete=models.CASCADE, related_name="qbo_invoice_claim")
+    amount_minor = models.BigIntegerField()
+    created_at = models.DateTimeField(default=timezone.now)
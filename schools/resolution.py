@@ -0,0 +1,140 @@
+# schools/resolution.py
+import threading, time
+from collections import OrderedDict
+from datetime import timedelta
+from django.conf import settings
+from django.utils import timezone
+from schools.models import Student, StudentIdMap
+from school_api.guard import directory_guard
+
+class StudentResolver:
+    """
+    provider_student_id -> (Student, school_student_id), local first:
+      1. in-process LRU,
+      2. StudentIdMap joined to Student,
+      3. the school's directory, only on a true miss or when the mapping is older than
+         STUDENT_MAPPING_MAX_AGE seconds (0 disables refreshing).
+    Directory answers are written back to the table and the LRU. If a refresh fails or the
+    directory no longer knows the id, the stale mapping is still used and is held in the LRU
+    as freshly checked, so the next refresh waits for STUDENT_RESOLVER_CACHE_TTL instead of
+    being tried on every payment. Directory calls go through school_api.guard (negative cache,
+    single-flight, circuit breaker).
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._entries: OrderedDict = OrderedDict()
+        self.hits = 0
+        self.db_hits = 0
+        self.directory_calls = 0
+
+    def resolve(self, school, provider_student_id: str) -> tuple[Student | None, str]:
+        return self.resolve_many(school, [provider_student_id]).get(provider_student_id, (None, ""))
+
+    def resolve_many(self, school, provider_student_ids) -> dict[str, tuple[Student | None, str]]:
+        return self.lookup(school, provider_student_ids)[0]
+
+    def lookup(self, school, provider_student_ids) -> tuple[dict[str, tuple[Student, str]], set[str]]:
+        """
+        (resolved, unavailable): the ids that resolved, and the ids with no mapping that the
+        directory couldn't be asked about right now (breaker open, timeouts), which are worth
+        retrying later. Ids in neither are unknown to the school.
+        """
+        ids = list(dict.fromkeys(p.strip() for p in provider_student_ids if p and p.strip()))
+        results, known = {}, {}
+        pending = []
+        for prov_sid in ids:
+            entry = self._cached(school.id, prov_sid)
+            if entry is not None and not _is_stale(entry[1]):
+                results[prov_sid] = (entry[0], entry[0].school_student_id)
+            else:
+                pending.append(prov_sid)
+        if not pending:
+            return results, set()
+
+        for m in (StudentIdMap.objects.select_related("student")
+                  .filter(school=school, provider_student_id__in=pending)):
+            known[m.provider_student_id] = m
+        with self._lock:
+            self.db_hits += len(known)
+
+        refresh = []
+        for prov_sid in pending:
+            m = known.get(prov_sid)
+            if m is not None:
+                self._remember(school.id, prov_sid, m.student, m.resolved_at)
+                results[prov_sid] = (m.student, m.student.school_student_id)
+                if not _is_stale(m.resolved_at):
+                    continue
+            refresh.append(prov_sid)
+
+        if not refresh:
+            return results, set()
+        conn = getattr(school, "directory", None)
+        found = self._lookup_directory(conn, refresh) if conn else {}
+        stored = set()
+        for prov_sid, data in found.items():
+            resolved = self._store(school, prov_sid, data, known.get(prov_sid))
+            if resolved:
+                results[prov_sid] = resolved
+                stored.add(prov_sid)
+        now = timezone.now()
+        for prov_sid in refresh:
+            if prov_sid in known and prov_sid not in stored:
+                self._remember(school.id, prov_sid, known[prov_sid].student, now)  # checked now, not re-resolved
+        if not conn:
+            return results, set()
+        return results, {p for p in refresh if p not in found and p not in results}
+
+    def _lookup_directory(self, conn, provider_student_ids: list[str]) -> dict[str, dict | None]:
+        with self._lock:
+            self.directory_calls += len(provider_student_ids)
+        return directory_guard.get_many(conn, provider_student_ids)
+
+    def _store(self, school, prov_sid: str, data: dict | None, mapping: StudentIdMap | None):
+        sch_sid = ((data or {}).get("school_student_id") or "").strip()
+        if not sch_sid:
+            return None
+        full_name = ((data or {}).get("full_name") or "").strip()
+        student, _ = Student.objects.get_or_create(school=school, school_student_id=sch_sid, defaults={"full_name": full_name})
+        now = timezone.now()
+        if mapping is None:
+            StudentIdMap.objects.update_or_create(
+                school=school, provider_student_id=prov_sid, defaults={"student": student, "resolved_at": now})
+        else:
+            StudentIdMap.objects.filter(id=mapping.id).update(student=student, resolved_at=now)
+        self._remember(school.id, prov_sid, student, now)
+        return student, sch_sid
+
+    def _cached(self, school_id: int, prov_sid: str):
+        ttl = float(getattr(settings, "STUDENT_RESOLVER_CACHE_TTL", 300))
+        with self._lock:
+            entry = self._entries.get((school_id, prov_sid))
+            if entry is None or entry[2] < time.monotonic() - ttl:
+                return None
+            self._entries.move_to_end((school_id, prov_sid))
+            self.hits += 1
+            return entry
+
+    def _remember(self, school_id: int, prov_sid: str, student: Student, resolved_at):
+        size = int(getattr(settings, "STUDENT_RESOLVER_CACHE_SIZE", 50_000))
+        with self._lock:
+            self._entries[(school_id, prov_sid)] = (student, resolved_at, time.monotonic())
+            self._entries.move_to_end((school_id, prov_sid))
+            while len(self._entries) > size:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.hits = self.db_hits = self.directory_calls = 0
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"size": len(self._entries), "hits": self.hits,
+                    "db_hits": self.db_hits, "directory_calls": self.directory_calls}
+
+def _is_stale(resolved_at) -> bool:
+    max_age = int(getattr(settings, "STUDENT_MAPPING_MAX_AGE", 7 * 86400))
+    return bool(max_age) and resolved_at is not None and resolved_at < timezone.now() - timedelta(seconds=max_age)
+
+student_resolver = StudentResolver()
@@ -1,4 +1,10 @@
-import pytest
+import os, pytest
+from django.core.cache import cache
+from django.db import connection
+from qbo import customers, invoices, tokens
+from schools.resolution import student_resolver
+from webhooks.cache import account_cache
+from webhooks.dedupe import get_seen_events
 
 @pytest.fixture(autouse=True)
 def _celery_eager(settings):
@@ -7,4 +13,27 @@ def _celery_eager(settings):
     settings.CELERY_BROKER_URL = "memory://"
     settings.CELERY_RESULT_BACKEND = "cache+memory://"
     settings.WEBHOOK_TIMESTAMP_TOLERANCE = 300
-    settings.QBO_SYNC_ENABLED = False
\ No newline at end of file
+    settings.QBO_SYNC_ENABLED = False
+    settings.WEBHOOK_DISPATCH_LINGER_MS = 0
+
+@pytest.fixture(autouse=True)
+def _reset_caches():
+    # process-level caches outlive the per-test DB rollback
+    cache.clear()
+    account_cache.clear()
+    get_seen_events().clear()
+    student_resolver.clear()
+    tokens._local.clear()
+    invoices._indexes.clear()
+    customers.clear()
+    yield
+
+@pytest.fixture(params=["orm", "sql"])
+def upsert_path(request, settings):
+    """Run a test against both payment upsert paths; the INSERT ... ON CONFLICT one needs Postgres."""
+    if request.param == "sql" and connection.vendor != "postgresql":
+        if os.environ.get("CI"):
+            pytest.fail("CI must run the SQL upsert path against Postgres")
+        pytest.skip("PAYMENT_UPSERT_SQL is Postgres only")
+    settings.PAYMENT_UPSERT_SQL = request.param == "sql"
+    return request.param
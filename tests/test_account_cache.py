@@ -0,0 +1,71 @@
+import json, hmac, hashlib, pytest
+from django.urls import reverse
+from django.test.utils import CaptureQueriesContext
+from django.db import connection, transaction
+from schools.models import School
+from payments.models import AggregatorAccount
+from webhooks.cache import account_cache, get_account
+
+def _post(client, school_code, event_id):
+    payload = {"event_id":event_id,"transaction_id":"t-"+event_id,"amount":1000,"currency":"UGX","status":"PENDING","student_id":"prov-001"}
+    body = json.dumps(payload).encode()
+    sig = hmac.new(b"sek", body, hashlib.sha256).hexdigest()
+    url = reverse("payment-webhook", kwargs={"provider":"SUREPAY"})
+    return client.post(url, data=body, content_type="application/json",
+                       HTTP_X_SIGNATURE=sig, HTTP_X_SCHOOL_CODE=school_code)
+
+@pytest.mark.django_db
+def test_account_lookup_is_cached_between_webhooks(client):
+    school = School.objects.create(name="Northgreen", code="ng")
+    AggregatorAccount.objects.create(school=school, provider="SUREPAY", webhook_secret="sek", is_active=True)
+
+    assert _post(client, "ng", "e1").status_code == 200
+    assert _post(client, "ng", "e2").status_code == 200
+    stats = account_cache.stats()
+    assert stats["misses"] == 1
+    assert stats["hits"] == 1
+
+@pytest.mark.django_db
+def test_negative_result_cached_and_invalidated_on_save(django_capture_on_commit_callbacks):
+    school = School.objects.create(name="Northgreen", code="ng")
+    assert get_account("ng", "surepay") is None
+    with CaptureQueriesContext(connection) as ctx:
+        assert get_account("ng", "SUREPAY") is None
+    assert len(ctx.captured_queries) == 0
+
+    with django_capture_on_commit_callbacks(execute=True):
+        acct = AggregatorAccount.objects.create(school=school, provider="SUREPAY", webhook_secret="sek", is_active=True)
+    assert get_account("ng", "SUREPAY").id == acct.id
+
+    with transaction.atomic(), django_capture_on_commit_callbacks() as callbacks:
+        acct.is_active = False
+        acct.save()
+        assert get_account("ng", "SUREPAY") is not None     # not dropped before the write commits
+    for callback in callbacks:
+        callback()
+    assert get_account("ng", "SUREPAY") is None
+
+@pytest.mark.django_db
+def test_school_code_change_invalidates(django_capture_on_commit_callbacks):
+    school = School.objects.create(name="Northgreen", code="ng")
+    AggregatorAccount.objects.create(school=school, provider="SUREPAY", webhook_secret="sek", is_active=True)
+    assert get_account("ng", "SUREPAY") is not None
+    school.code = "ng2"
+    with django_capture_on_commit_callbacks(execute=True):
+        school.save()
+    assert get_account("ng", "SUREPAY") is None
+    assert get_account("ng2", "SUREPAY") is not None
+
+@pytest.mark.django_db
+def test_shared_generation_clears_other_workers(settings):
+    from django.core.cache import cache
+    from webhooks.cache import GENERATION_KEY
+    settings.WEBHOOK_ACCOUNT_CACHE_SHARED = True
+    school = School.objects.create(name="Northgreen", code="ng")
+    AggregatorAccount.objects.create(school=school, provider="SUREPAY", webhook_secret="sek", is_active=True)
+    assert get_account("ng", "SUREPAY") is not None
+
+    # another worker invalidated: the row is gone from our view only via the shared counter
+    AggregatorAccount.objects.filter(school=school).update(is_active=False)
+    cache.set(GENERATION_KEY, 99, None)
+    assert get_account("ng", "SUREPAY") is None
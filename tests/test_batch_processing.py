@@ -0,0 +1,89 @@
+import time, pytest
+from schools.models import School
+from payments.models import AggregatorAccount, WebhookEvent, Payment
+from payments.tasks import process_webhook_events_batch
+
+def _event(acct, n, txn, status, **over):
+    payload = {"event_id":f"e{n}","transaction_id":txn,"amount":500,"currency":"UGX","status":status,"student_id":"prov-001"}
+    payload.update(over)
+    return WebhookEvent.objects.create(aggregator_account=acct, provider="SUREPAY", event_id=f"e{n}", payload=payload)
+
+@pytest.mark.django_db
+def test_batch_task_folds_events_and_isolates_failures(django_assert_max_num_queries):
+    school = School.objects.create(name="Northgreen", code="ng")
+    acct = AggregatorAccount.objects.create(school=school, provider="SUREPAY", webhook_secret="sek", is_active=True)
+    Payment.objects.create(school=school, provider="SUREPAY", external_txn_id="t-old", provider_student_id="prov-001",
+                           amount="1.00", currency="UGX", status="PENDING")
+    events = [
+        _event(acct, 1, "t1", "PENDING"),
+        _event(acct, 2, "t1", "SUCCESS"),
+        _event(acct, 3, "t-old", "FAILED"),
+        _event(acct, 4, "t2", "SUCCESS", amount="not-a-number"),
+    ]
+    with django_assert_max_num_queries(11):  # incl. the PaymentOutbox insert
+        process_webhook_events_batch(event_ids=[e.id for e in events])
+
+    assert Payment.objects.get(external_txn_id="t1").status == "SUCCEEDED"
+    old = Payment.objects.get(external_txn_id="t-old")
+    assert old.status == "FAILED" and old.amount == 500
+    assert not Payment.objects.filter(external_txn_id="t2").exists()
+    assert set(WebhookEvent.objects.filter(processed=True).values_list("event_id", flat=True)) == {"e1", "e2", "e3"}
+    bad = WebhookEvent.objects.get(event_id="e4")
+    assert not bad.processed and "ValidationError" in bad.processing_error
+
+def test_dispatcher_publishes_full_batches_and_lingering_ids(settings, monkeypatch):
+    from webhooks.ingest import EventDispatcher
+    settings.WEBHOOK_DISPATCH_LINGER_MS = 30
+    settings.WEBHOOK_DISPATCH_MAX_BATCH = 3
+    published = []
+    monkeypatch.setattr(process_webhook_events_batch, "delay", lambda event_ids, school_id=None: published.append(event_ids))
+
+    d = EventDispatcher()
+    for i in (1, 2, 3):
+        d.add(i)
+    assert published == [[1, 2, 3]]
+    d.add(4)
+    d.add(5)
+    deadline = time.monotonic() + 2
+    while len(published) < 2 and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert published == [[1, 2, 3], [4, 5]]
+
+def test_dispatcher_batches_per_school_and_routes_to_shards(settings, monkeypatch):
+    from config.celery import app, route_task
+    from webhooks.ingest import EventDispatcher
+    settings.WEBHOOK_DISPATCH_LINGER_MS = 1000
+    settings.WEBHOOK_DISPATCH_MAX_BATCH = 4
+    settings.CELERY_WEBHOOK_SHARDS = 4
+    published = []
+    monkeypatch.setattr(process_webhook_events_batch, "delay",
+                        lambda event_ids, school_id=None: published.append((school_id, event_ids)))
+
+    d = EventDispatcher()
+    for event_id, school_id in [(1, 7), (2, 9), (3, 7), (4, 9)]:
+        d.add(event_id, school_id)
+    assert published == [(7, [1, 3]), (9, [2, 4])]
+
+    name = process_webhook_events_batch.name
+    assert route_task(name, (), {"event_ids": [1], "school_id": 7}, {}) == {"queue": "webhooks.3"}
+    assert route_task(name, (), {"event_ids": [1], "school_id": 9}, {}) == {"queue": "webhooks.1"}
+    assert app.amqp.router.route({}, "qbo.tasks.sync_payment_to_qbo")["queue"].name == "qbo"
+
+def test_dispatcher_logs_ids_it_could_not_publish(settings, monkeypatch, caplog):
+    from webhooks.ingest import EventDispatcher
+    settings.WEBHOOK_DISPATCH_LINGER_MS = 10
+    published = []
+    def delay(event_ids, school_id=None):
+        if school_id == 9:
+            raise ConnectionError("broker down")
+        published.append(event_ids)
+    monkeypatch.setattr(process_webhook_events_batch, "delay", delay)
+
+    d = EventDispatcher()
+    for event_id, school_id in [(1, 7), (2, 9), (3, 9)]:
+        d.add(event_id, school_id)
+    deadline = time.monotonic() + 2
+    while not caplog.records and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert published == [[1]]
+    assert "event ids [2, 3]" in caplog.records[0].getMessage()
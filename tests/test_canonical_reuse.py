@@ -0,0 +1,54 @@
+import json, hmac, hashlib, pytest
+from decimal import Decimal
+from django.urls import reverse
+from schools.models import School
+from payments.models import AggregatorAccount, WebhookEvent, Payment
+from aggregators.surepay import SurepayAdapter
+
+def _post(client, payload):
+    body = json.dumps(payload).encode()
+    sig = hmac.new(b"sek", body, hashlib.sha256).hexdigest()
+    url = reverse("payment-webhook", kwargs={"provider":"SUREPAY"})
+    return client.post(url, data=body, content_type="application/json",
+                       HTTP_X_SIGNATURE=sig, HTTP_X_SCHOOL_CODE="ng")
+
+@pytest.mark.django_db
+def test_task_reuses_canonical_parsed_at_ingest(client, monkeypatch):
+    school = School.objects.create(name="Northgreen", code="ng")
+    AggregatorAccount.objects.create(school=school, provider="SUREPAY", webhook_secret="sek", is_active=True)
+
+    calls = []
+    original = SurepayAdapter.parse_webhook
+    def counting_parse(self, payload):
+        calls.append(payload["event_id"])
+        return original(self, payload)
+    monkeypatch.setattr(SurepayAdapter, "parse_webhook", counting_parse)
+
+    payload = {"event_id":"e1","transaction_id":"t1","amount":"2500.50","currency":"ugx","status":"SUCCESS","student_id":"prov-001","narration":"fees"}
+    assert _post(client, payload).status_code == 200
+    assert calls == ["e1"]  # the Celery task did not parse again
+
+    ev = WebhookEvent.objects.get(event_id="e1")
+    assert ev.adapter_version == SurepayAdapter.version
+    assert ev.canonical["amount"] == "2500.50"
+    assert "raw" not in ev.canonical
+    p = Payment.objects.get(external_txn_id="t1")
+    assert p.amount == Decimal("2500.50")
+    assert p.currency == "UGX"
+    assert p.narration == "Fees"
+
+@pytest.mark.django_db
+def test_task_reparses_when_adapter_version_changed(client, monkeypatch):
+    school = School.objects.create(name="Northgreen", code="ng")
+    acct = AggregatorAccount.objects.create(school=school, provider="SUREPAY", webhook_secret="sek", is_active=True)
+    payload = {"event_id":"e1","transaction_id":"t1","amount":100,"currency":"UGX","status":"PENDING","student_id":"prov-001"}
+    ev = WebhookEvent.objects.create(
+        aggregator_account=acct, provider="SUREPAY", event_id="e1", payload=payload,
+        canonical={"event_id":"e1","external_txn_id":"stale","provider_student_id":"prov-001","amount":"1",
+                   "currency":"UGX","status":"PENDING","narration":"Other"},
+        adapter_version="0",
+    )
+    from payments.tasks import process_webhook_event_task
+    process_webhook_event_task(event_id=ev.id)
+    assert Payment.objects.filter(external_txn_id="t1").exists()
+    assert not Payment.objects.filter(external_txn_id="stale").exists()
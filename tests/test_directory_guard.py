@@ -0,0 +1,115 @@
+import threading, time, pytest, requests
+from schools.models import School, SchoolDirectoryConnection, StudentIdMap
+from schools.resolution import student_resolver
+from payments.models import AggregatorAccount, WebhookEvent, Payment, PaymentOutbox
+from payments.tasks import process_webhook_events_batch, reenrich_payments
+from school_api import client as dir_client
+from school_api.guard import directory_guard, breaker_open
+
+@pytest.fixture
+def directory(monkeypatch):
+    state = {"calls": [], "down": False, "delay": 0.0}
+    def fake(self, provider_student_id):
+        state["calls"].append(provider_student_id)
+        time.sleep(state["delay"])
+        if state["down"]:
+            raise requests.ConnectTimeout("directory down")
+        if provider_student_id.startswith("prov-"):
+            return {"school_student_id": "SCH-" + provider_student_id[5:], "full_name": "Jane"}
+        return None
+    monkeypatch.setattr(dir_client.SchoolAPIClient, "get_by_provider_student_id", fake)
+    return state
+
+@pytest.fixture
+def school(db):
+    school = School.objects.create(name="Northgreen", code="ng")
+    SchoolDirectoryConnection.objects.create(school=school, base_url="https://dir.example.com", api_key="k")
+    return school
+
+def test_unknown_students_are_cached(school, directory):
+    assert student_resolver.lookup(school, ["nobody"]) == ({}, set())
+    student_resolver.clear()
+    assert student_resolver.lookup(school, ["nobody"]) == ({}, set())
+    assert directory["calls"] == ["nobody"]
+
+def test_concurrent_lookups_share_one_request(school, directory, settings):
+    settings.SCHOOL_API_MAX_CONCURRENCY = 1
+    directory["delay"] = 0.2
+    conn = school.directory
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(directory_guard.get_many(conn, ["prov-001"])))
+               for _ in range(4)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert directory["calls"] == ["prov-001"]
+    assert [r["prov-001"]["school_student_id"] for r in results] == ["SCH-001"] * 4
+
+def test_breaker_records_payments_unenriched_and_reenriches_later(school, directory, settings):
+    settings.SCHOOL_API_BREAKER_THRESHOLD = 2
+    directory["down"] = True
+    acct = AggregatorAccount.objects.create(school=school, provider="SUREPAY", webhook_secret="sek", is_active=True)
+    events = [WebhookEvent.objects.create(
+        aggregator_account=acct, provider="SUREPAY", event_id=f"e{n}",
+        payload={"event_id":f"e{n}","transaction_id":f"t{n}","amount":500,"currency":"UGX","status":"SUCCESS","student_id":f"prov-00{n}"})
+        for n in range(1, 4)]
+    process_webhook_events_batch(event_ids=[e.id for e in events])
+    assert breaker_open(school.id)
+    assert Payment.objects.filter(needs_enrichment=True, student__isnull=True).count() == 3
+
+    # open breaker: no directory calls, payments still recorded
+    calls = len(directory["calls"])
+    student_resolver.clear()
+    assert student_resolver.lookup(school, ["prov-009"]) == ({}, {"prov-009"})
+    assert len(directory["calls"]) == calls
+    reenrich_payments()
+    assert Payment.objects.filter(needs_enrichment=True).count() == 3
+
+    from django.core.cache import cache
+    from django.utils import timezone
+    cache.clear()  # cooldown elapsed
+    directory["down"] = False
+    PaymentOutbox.objects.update(dispatched_at=timezone.now())  # QBO sync skipped them while unlinked
+    assert reenrich_payments() == 3
+    p = Payment.objects.get(external_txn_id="t2")
+    assert not p.needs_enrichment and p.school_student_id == "SCH-002" and p.student
+    assert PaymentOutbox.objects.filter(dispatched_at__isnull=True).count() == 3
+    assert StudentIdMap.objects.filter(school=school).count() == 3
+
+def test_reenrichment_is_not_starved_by_a_school_with_an_open_breaker(school, directory):
+    from django.core.cache import cache
+    from payments.processing import reenrich_pending_payments
+    from school_api.guard import _key
+    other = School.objects.create(name="Eastfield", code="ef")
+    SchoolDirectoryConnection.objects.create(school=other, base_url="https://dir2.example.com", api_key="k")
+    base = dict(provider="SUREPAY", amount=500, currency="UGX", status="SUCCEEDED", needs_enrichment=True)
+    for n in range(5):   # the oldest flagged rows all belong to the school whose directory is down
+        Payment.objects.create(school=school, external_txn_id=f"a{n}", provider_student_id=f"prov-10{n}", **base)
+    Payment.objects.create(school=other, external_txn_id="b1", provider_student_id="prov-201", **base)
+    cache.set(_key("breaker", school.id), 1, 60)
+
+    assert reenrich_pending_payments(limit=2) == 1
+    assert not Payment.objects.get(external_txn_id="b1").needs_enrichment
+    assert Payment.objects.filter(school=school, needs_enrichment=True).count() == 5
+
+def test_breaker_counts_failed_requests_not_ids(school, directory, settings, monkeypatch):
+    settings.SCHOOL_API_BREAKER_THRESHOLD = 2
+    conn = school.directory
+    conn.students_by_provider_ids_path = "/students/by-provider-ids"
+    def bulk(self, ids):
+        if directory["down"]:
+            raise requests.ConnectTimeout("directory down")
+        return {pid: None for pid in ids}   # a 200 that knows none of them
+    monkeypatch.setattr(dir_client.SchoolAPIClient, "_get_bulk", bulk)
+
+    directory["down"] = True
+    assert directory_guard.get_many(conn, [f"prov-{n}" for n in range(50)]) == {}
+    assert not breaker_open(school.id)                          # one failed call, not 50
+    directory["down"] = False
+    assert directory_guard.get_many(conn, ["other-1"]) == {"other-1": None}
+    directory["down"] = True
+    directory_guard.get_many(conn, ["prov-1"])
+    assert not breaker_open(school.id)                          # the answer in between reset the count
+    directory_guard.get_many(conn, ["prov-2"])
+    assert breaker_open(school.id)
@@ -0,0 +1,67 @@
+import pytest, zlib
+from datetime import timedelta
+from io import StringIO
+from django.core.management import call_command
+from django.utils import timezone
+from schools.models import School
+from payments.models import AggregatorAccount, PayloadBlob, Payment, WebhookEvent
+from payments.tasks import process_webhook_event_task, prune_payload_blobs
+
+@pytest.fixture
+def acct(db):
+    school = School.objects.create(name="Northgreen", code="ng")
+    return AggregatorAccount.objects.create(school=school, provider="SUREPAY", webhook_secret="sek")
+
+def _payload(n, status="SUCCESS"):
+    return {"event_id": f"e{n}", "transaction_id": "t1", "amount": 500, "currency": "UGX", "status": status,
+            "student_id": "p1", "meta": {"note": "x" * 200}}
+
+def test_event_and_payment_share_one_compressed_blob(acct):
+    ev = WebhookEvent.objects.create(aggregator_account=acct, provider="SUREPAY", event_id="e1", payload=_payload(1))
+    process_webhook_event_task(event_id=ev.id)
+
+    p = Payment.objects.get(external_txn_id="t1")
+    blob = PayloadBlob.objects.get()
+    assert p.raw_blob_id == WebhookEvent.objects.get(id=ev.id).payload_blob_id == blob.digest
+    assert p.raw == _payload(1) and p.raw_json is None
+    assert len(blob.data) < blob.size and zlib.decompress(blob.data)
+
+    # a second delivery of the same body re-uses the blob
+    WebhookEvent.objects.create(aggregator_account=acct, provider="SUREPAY", event_id="e1-again",
+                                payload=_payload(1))
+    assert PayloadBlob.objects.count() == 1
+
+    refund = WebhookEvent.objects.create(aggregator_account=acct, provider="SUREPAY", event_id="e2",
+                                         payload=_payload(2, "REFUNDED"))
+    process_webhook_event_task(event_id=refund.id)
+    p.refresh_from_db()
+    assert p.raw_blob_id == refund.payload_blob_id and p.raw["status"] == "REFUNDED"
+
+def test_backfill_moves_legacy_columns(acct):
+    ev = WebhookEvent.objects.create(aggregator_account=acct, provider="SUREPAY", event_id="e1",
+                                     payload_json=_payload(1))
+    p = Payment.objects.create(school=acct.school, provider="SUREPAY", external_txn_id="t1", provider_student_id="p1",
+                               amount=500, currency="UGX", status="SUCCEEDED", raw_json=_payload(1))
+    assert ev.payload == _payload(1) and PayloadBlob.objects.count() == 0
+
+    out = StringIO()
+    call_command("backfill_payload_blobs", "--batch-size", "1", stdout=out)
+    assert "events: converted 1 rows" in out.getvalue() and "payments: converted 1 rows" in out.getvalue()
+    ev, p = WebhookEvent.objects.get(id=ev.id), Payment.objects.get(id=p.id)
+    assert ev.payload_json is None and p.raw_json is None
+    assert ev.payload_blob_id == p.raw_blob_id and ev.payload == p.raw == _payload(1)
+
+def test_prune_keeps_referenced_and_recent_blobs(acct):
+    old = timezone.now() - timedelta(days=30)
+    ev = WebhookEvent.objects.create(aggregator_account=acct, provider="SUREPAY", event_id="e1", payload=_payload(1))
+    orphan = WebhookEvent.objects.create(aggregator_account=acct, provider="SUREPAY", event_id="e2", payload=_payload(2))
+    fresh = WebhookEvent.objects.create(aggregator_account=acct, provider="SUREPAY", event_id="e3", payload=_payload(3))
+    PayloadBlob.objects.exclude(digest=fresh.payload_blob_id).update(last_used_at=old)
+    WebhookEvent.objects.filter(id__in=[orphan.id, fresh.id]).delete()
+
+    assert prune_payload_blobs() == 1
+    assert set(PayloadBlob.objects.values_list("digest", flat=True)) == {ev.payload_blob_id, fresh.payload_blob_id}
+
+    # storing a body again refreshes its retention tag
+    WebhookEvent.objects.create(aggregator_account=acct, provider="SUREPAY", event_id="e1b", payload=_payload(1))
+    assert PayloadBlob.objects.get(digest=ev.payload_blob_id).last_used_at > old
@@ -0,0 +1,104 @@
+import pytest
+from datetime import timedelta
+from django.db import transaction
+from django.utils import timezone
+from schools.models import School
+from payments.models import AggregatorAccount, WebhookEvent, Payment, PaymentOutbox
+from payments.processing import process_event
+from payments.tasks import process_webhook_events_batch
+from qbo import customers as qbo_customers, tasks as qbo_tasks
+from qbo.batch import UNCONFIRMED, pending_payments
+
+@pytest.fixture
+def acct(db, settings):
+    settings.QBO_SYNC_ENABLED = True
+    school = School.objects.create(name="Northgreen", code="ng")
+    return AggregatorAccount.objects.create(school=school, provider="SUREPAY", webhook_secret="sek", is_active=True)
+
+@pytest.fixture
+def published(monkeypatch):
+    calls = []
+    monkeypatch.setattr(qbo_tasks.sync_payment_to_qbo, "delay", lambda payment_id: calls.append(("payment", payment_id)))
+    monkeypatch.setattr(qbo_tasks.sync_school_batch, "delay", lambda school_id: calls.append(("school", school_id)))
+    return calls
+
+def _event(acct, n, status="SUCCESS", txn=None, **over):
+    payload = {"event_id": f"e{n}", "transaction_id": txn or f"t{n}", "amount": 500, "currency": "UGX",
+               "status": status, "student_id": "prov-001", **over}
+    return (WebhookEvent.objects.select_related("aggregator_account__school")
+            .get(pk=WebhookEvent.objects.create(aggregator_account=acct, provider="SUREPAY", event_id=f"e{n}",
+                                                payload=payload).pk))
+
+def test_sync_is_dispatched_once_after_commit(acct, published):
+    process_event(_event(acct, 1))
+    p = Payment.objects.get(external_txn_id="t1")
+    assert published == []                                      # nothing leaves before the relay
+    assert qbo_tasks.relay_payment_outbox() == 1
+    assert published == [("payment", p.id)]
+
+    process_event(_event(acct, 2, txn="t1", amount=750))        # changed re-delivery
+    assert qbo_tasks.relay_payment_outbox() == 0
+    assert published == [("payment", p.id)]
+
+def test_rolled_back_payment_leaves_no_task(acct, published):
+    with pytest.raises(RuntimeError):
+        with transaction.atomic():
+            process_event(_event(acct, 1))
+            raise RuntimeError("later step failed")
+    assert not PaymentOutbox.objects.exists()
+    assert qbo_tasks.relay_payment_outbox() == 0 and published == []
+
+def test_batch_mode_relays_one_batch_sync_per_school(acct, published, settings):
+    settings.QBO_SYNC_MODE = "batch"
+    settings.QBO_OUTBOX_BATCH_SIZE = 2
+    process_webhook_events_batch(event_ids=[_event(acct, n, "PENDING" if n == 3 else "SUCCESS").id for n in range(1, 6)])
+    assert PaymentOutbox.objects.count() == 4
+    assert qbo_tasks.relay_payment_outbox() == 4
+    assert published == [("school", acct.school_id)] * 2        # one per claimed chunk
+    assert not PaymentOutbox.objects.filter(dispatched_at__isnull=True).exists()
+
+def test_outbox_waits_while_sync_is_disabled(acct, published, settings):
+    process_event(_event(acct, 1))
+    settings.QBO_SYNC_ENABLED = False
+    assert qbo_tasks.relay_payment_outbox() == 0
+    settings.QBO_SYNC_ENABLED = True
+    assert qbo_tasks.relay_payment_outbox() == 1 and len(published) == 1
+
+def test_unlinked_payment_is_not_synced_under_a_placeholder_customer(acct, monkeypatch, settings):
+    monkeypatch.setattr(qbo_tasks, "QBOClient", lambda school: pytest.fail("QBO was called"))
+    p = Payment.objects.create(school=acct.school, provider="SUREPAY", external_txn_id="t1", provider_student_id="p1",
+                               amount=500, currency="UGX", status="SUCCEEDED", needs_enrichment=True)
+    qbo_tasks.sync_payment_to_qbo(payment_id=p.id)
+    settings.QBO_SYNC_MODE = "batch"
+    assert not pending_payments().filter(id=p.id).exists()
+
+def test_parked_payments_go_back_to_the_outbox(acct, published, settings):
+    settings.QBO_OUTBOX_BATCH_SIZE = 2
+    base = dict(school=acct.school, provider="SUREPAY", amount=500, currency="UGX", status="SUCCEEDED")
+    errors = [qbo_customers.UNRESOLVED, "QBO 400 ValidationFault: bad", "QBO 400 error: x", f"{UNCONFIRMED}rq", ""]
+    payments = [Payment.objects.create(external_txn_id=f"t{i}", qbo_sync_error=e, **base) for i, e in enumerate(errors)]
+    PaymentOutbox.objects.add([p.id for p in payments])
+    PaymentOutbox.objects.update(dispatched_at=timezone.now())
+    assert qbo_tasks.retry_parked_payments() == 0               # parked too recently
+
+    Payment.objects.update(updated_at=timezone.now() - timedelta(hours=7))
+    assert qbo_tasks.retry_parked_payments() == 3
+    assert set(Payment.objects.filter(qbo_sync_error="").values_list("id", flat=True)) == {p.id for p in payments[:3]} | {payments[4].id}
+    assert qbo_tasks.relay_payment_outbox() == 3
+    assert sorted(published) == [("payment", p.id) for p in payments[:3]]
+
+def test_relay_publishes_after_claiming_and_puts_back_what_it_could_not_send(acct, monkeypatch):
+    for n in range(1, 4):
+        process_event(_event(acct, n))
+    sent = []
+    def delay(payment_id):
+        assert PaymentOutbox.objects.get(payment_id=payment_id).dispatched_at   # claim committed first
+        if len(sent) == 1:
+            raise ConnectionError("broker down")
+        sent.append(payment_id)
+    monkeypatch.setattr(qbo_tasks.sync_payment_to_qbo, "delay", delay)
+    with pytest.raises(ConnectionError):
+        qbo_tasks.relay_payment_outbox()
+    assert PaymentOutbox.objects.filter(dispatched_at__isnull=True).count() == 2
+    monkeypatch.setattr(qbo_tasks.sync_payment_to_qbo, "delay", lambda payment_id: sent.append(payment_id))
+    assert qbo_tasks.relay_payment_outbox() == 2 and len(set(sent)) == 3
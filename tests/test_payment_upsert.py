@@ -0,0 +1,32 @@
+import pytest
+from schools.models import School
+from payments.models import AggregatorAccount, WebhookEvent, Payment, PaymentOutbox
+from payments.tasks import process_webhook_event_task
+
+def _deliver(acct, n, status, **over):
+    payload = {"event_id":f"e{n}","transaction_id":"t1","amount":500,"currency":"UGX","status":status,"student_id":"prov-001"}
+    payload.update(over)
+    event = WebhookEvent.objects.create(aggregator_account=acct, provider="SUREPAY", event_id=f"e{n}", payload=payload)
+    process_webhook_event_task(event_id=event.id)
+
+def _queued():
+    return list(PaymentOutbox.objects.values_list("payment_id", flat=True))
+
+@pytest.mark.django_db
+def test_identical_redelivery_skips_write_and_qbo(upsert_path):
+    school = School.objects.create(name="Northgreen", code="ng")
+    acct = AggregatorAccount.objects.create(school=school, provider="SUREPAY", webhook_secret="sek", is_active=True)
+
+    _deliver(acct, 1, "SUCCESS")
+    p = Payment.objects.get(external_txn_id="t1")
+    assert p.content_hash and _queued() == [p.id]
+
+    _deliver(acct, 2, "SUCCESS", amount="500.00")  # same content (amount written differently), new event id
+    again = Payment.objects.get(id=p.id)
+    assert again.updated_at == p.updated_at and _queued() == [p.id]
+    assert WebhookEvent.objects.get(event_id="e2").processed
+
+    _deliver(acct, 3, "SUCCESS", amount=750)
+    changed = Payment.objects.get(id=p.id)
+    assert changed.amount == 750 and changed.updated_at > p.updated_at
+    assert changed.content_hash != p.content_hash and _queued() == [p.id]   # one QBO dispatch per payment
@@ -0,0 +1,123 @@
+import pytest, requests
+from django.utils import timezone
+from schools.models import School, QBOConnection
+from payments.models import Payment
+from qbo import customers as qbo_customers, tasks
+from qbo.batch import UNCONFIRMED
+from qbo.client import QBOClient, QBOError
+
+@pytest.fixture
+def school(db, settings, monkeypatch):
+    settings.QBO_SYNC_ENABLED = True
+    settings.QBO_SYNC_MODE = "batch"
+    school = School.objects.create(name="Northgreen", code="ng")
+    QBOConnection.objects.create(school=school, realm_id="r1", access_token="at", refresh_token="rt",
+                                 token_expires_at=timezone.now())
+    monkeypatch.setattr(QBOClient, "ensure_token", lambda self: True)
+    monkeypatch.setattr(qbo_customers, "resolve_payments", lambda client, payments: {p.id: "1" for p in payments})
+    monkeypatch.setattr(QBOClient, "find_open_invoices",
+                        lambda self, customer_id: [{"Id": "INV-1", "Balance": 300.0, "Line": [{"Description": "Fees"}]}])
+    return school
+
+def _payment(school, n, amount=100, status="SUCCEEDED"):
+    return Payment.objects.create(school=school, provider="SUREPAY", external_txn_id=f"t{n}", provider_student_id="p1",
+                                  amount=amount, currency="UGX", status=status, narration="Fees")
+
+def test_batch_sync_maps_results_and_retries_faults(school, monkeypatch):
+    payments = [_payment(school, n) for n in range(31)]
+    invoiced = _payment(school, 31, amount=300)
+    _payment(school, 99, status="PENDING")
+    faulted = payments[5]
+
+    batches = []
+    def fake_batch(self, items, request_id=None):
+        batches.append(items)
+        out = []
+        for item in items:
+            if item["bId"] == str(faulted.id):
+                out.append({"bId": item["bId"], "Fault": {"type": "ValidationFault", "Error": [{"Message": "Bad amount"}]}})
+            else:
+                kind = "Payment" if "Payment" in item else "SalesReceipt"
+                out.append({"bId": item["bId"], kind: {"Id": f"Q{item['bId']}"}})
+        return out
+    monkeypatch.setattr(QBOClient, "batch", fake_batch)
+    retried = []
+    monkeypatch.setattr(tasks.sync_payment_to_qbo, "delay", lambda payment_id: retried.append(payment_id))
+
+    assert tasks.sync_pending_to_qbo() == 1
+    assert [len(b) for b in batches] == [30, 2]
+    assert retried == [faulted.id]
+
+    p = Payment.objects.get(id=payments[0].id)
+    assert (p.qbo_txn_id, p.qbo_txn_type, p.qbo_customer_id) == (f"Q{p.id}", "SalesReceipt", "1")
+    inv = Payment.objects.get(id=invoiced.id)
+    assert (inv.qbo_txn_type, inv.qbo_invoice_id) == ("Payment", "INV-1")
+    bad = Payment.objects.get(id=faulted.id)
+    assert bad.qbo_txn_id is None and bad.qbo_sync_error == "ValidationFault: Bad amount"
+
+    # nothing left for the next run: synced rows have ids, the faulted one belongs to its retry
+    assert tasks.sync_pending_to_qbo() == 0
+
+def test_rejected_batch_request_is_parked_and_resent_per_payment(school, monkeypatch):
+    payments = [_payment(school, n) for n in range(35)]
+    batches = []
+    def failing_batch(self, items, request_id=None):
+        batches.append(items)
+        raise QBOError(400, "Request has invalid or unsupported property", "ValidationFault")
+    monkeypatch.setattr(QBOClient, "batch", failing_batch)
+    retried = []
+    monkeypatch.setattr(tasks.sync_payment_to_qbo, "delay", lambda payment_id: retried.append(payment_id))
+
+    tasks.sync_pending_to_qbo()
+    assert len(batches) == 2         # a rejected chunk doesn't stop the run
+    assert retried == [p.id for p in payments]
+    assert all(e.startswith("batch failed: ") for e in Payment.objects.values_list("qbo_sync_error", flat=True))
+    assert not tasks.pending_payments().exists()
+
+@pytest.mark.parametrize("error", [requests.ReadTimeout("read timed out"), QBOError(503, "Service unavailable")])
+def test_unanswered_batch_is_resent_as_is_under_its_requestid(school, monkeypatch, error):
+    invoiced = _payment(school, 0, amount=300)
+    payments = [_payment(school, n) for n in range(1, 36)]
+    sent, applied = [], {}
+    def batch(self, items, request_id=None):
+        sent.append((request_id, items))
+        if request_id not in applied:  # QBO answers a repeated requestid with the first result
+            applied[request_id] = [{"bId": i["bId"], k: {"Id": f"Q{i['bId']}"}} for i in items
+                                   for k in ("Payment", "SalesReceipt") if k in i]
+        if len(sent) == 1:
+            raise error                  # applied, but the answer is lost
+        return applied[request_id]
+    monkeypatch.setattr(QBOClient, "batch", batch)
+    retried = []
+    monkeypatch.setattr(tasks.sync_payment_to_qbo, "delay", lambda payment_id: retried.append(payment_id))
+
+    tasks.sync_pending_to_qbo()
+    held = Payment.objects.filter(qbo_sync_error__startswith=UNCONFIRMED)
+    assert len(sent) == 1 and retried == [] and held.count() == 30
+    assert held.get(id=invoiced.id).qbo_invoice_id == "INV-1"   # keeps its invoice for the resend
+    assert set(tasks.pending_payments().values_list("id", flat=True)) == {p.id for p in payments[29:]}
+    tasks.sync_payment_to_qbo(payment_id=payments[0].id)   # e.g. a stray per-payment run: never books it
+    assert len(sent) == 1
+
+    tasks.sync_pending_to_qbo()
+    assert sent[1] == sent[0]                               # same items, same requestid
+    assert len(sent) == 3 and len(applied) == 2
+    assert not Payment.objects.filter(qbo_txn_id__isnull=True).exists()
+    assert Payment.objects.get(id=payments[0].id).qbo_sync_error == ""
+    assert Payment.objects.get(id=invoiced.id).qbo_txn_type == "Payment"
+    assert Payment.objects.filter(qbo_invoice_id="INV-1").count() == 1
+
+def test_payments_without_a_customer_are_parked_not_batched(school, monkeypatch):
+    payments = [_payment(school, n) for n in range(3)]
+    monkeypatch.setattr(qbo_customers, "resolve_payments",
+                        lambda client, ps: {p.id: "1" for p in ps if p.id != payments[1].id})
+    batches = []
+    monkeypatch.setattr(QBOClient, "batch", lambda self, items, request_id=None: batches.append(items) or
+                        [{"bId": i["bId"], "SalesReceipt": {"Id": f"Q{i['bId']}"}} for i in items])
+    retried = []
+    monkeypatch.setattr(tasks.sync_payment_to_qbo, "delay", lambda payment_id: retried.append(payment_id))
+
+    tasks.sync_pending_to_qbo()
+    assert [i["bId"] for i in batches[0]] == [str(payments[0].id), str(payments[2].id)]
+    assert retried == [payments[1].id]
+    assert Payment.objects.get(id=payments[1].id).qbo_sync_error == qbo_customers.UNRESOLVED
@@ -0,0 +1,144 @@
+import gzip, json, threading, pytest
+from datetime import timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+from django.utils import timezone
+from schools.models import School, QBOConnection
+from payments.models import Payment
+from qbo import tokens
+from qbo.client import QBOClient, QBOError
+from qbo.sessions import close_sessions
+from qbo.tasks import sync_payment_to_qbo
+
+class _QBO(BaseHTTPRequestHandler):
+    """Stand-in for the QBO accounting API and Intuit's token endpoint."""
+    protocol_version = "HTTP/1.1"  # keep-alive
+
+    @classmethod
+    def reset(cls):
+        cls.connections, cls.posts, cls.created = set(), [], {}
+        cls.fail_next, cls.token, cls.invoices = [], "at", []
+
+    def _send(self, status, data):
+        body = json.dumps(data).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        if "gzip" in self.headers.get("Accept-Encoding", ""):
+            body = gzip.compress(body)
+            self.send_header("Content-Encoding", "gzip")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _authorized(self):
+        _QBO.connections.add(self.client_address)
+        if self.headers.get("Authorization") != f"Bearer {_QBO.token}":
+            self._send(401, {"fault": {"error": [{"message": "AuthenticationFailed"}], "type": "AUTHENTICATION"}})
+            return False
+        return True
+
+    def do_GET(self):
+        if not self._authorized():
+            return
+        statement = parse_qs(urlsplit(self.path).query)["query"][0]
+        self._send(200, {"QueryResponse": {"Invoice": _QBO.invoices if "FROM Invoice" in statement else []}})
+
+    def do_POST(self):
+        raw = self.rfile.read(int(self.headers["Content-Length"]))
+        if self.path.startswith("/oauth2/"):
+            _QBO.token = "at-refreshed"
+            return self._send(200, {"access_token": _QBO.token, "refresh_token": "rt-2", "expires_in": 3600})
+        if not self._authorized():
+            return
+        if self.headers.get("Content-Encoding") == "gzip":
+            raw = gzip.decompress(raw)
+        url = urlsplit(self.path)
+        request_id = parse_qs(url.query).get("requestid", [""])[0]
+        body = json.loads(raw)
+        _QBO.posts.append((url.path.rsplit("/", 1)[-1], request_id, self.headers.get("Content-Encoding")))
+        if _QBO.fail_next:
+            return self._send(_QBO.fail_next.pop(0), {"Fault": {"Error": [{"Message": "Service unavailable"}]}})
+        if body.get("CustomerRef", {}).get("value") == "BAD":
+            return self._send(400, {"Fault": {"Error": [{"Message": "Invalid Reference Id", "Detail": "Customer"}],
+                                              "type": "ValidationException"}})
+        if request_id not in _QBO.created:  # QBO answers a repeated requestid with the first result
+            entity = "SalesReceipt" if url.path.endswith("salesreceipt") else "Payment"
+            _QBO.created[request_id] = {entity: {**body, "Id": str(len(_QBO.created) + 1)}}
+        self._send(200, _QBO.created[request_id])
+
+    def log_message(self, *args):
+        pass
+
+@pytest.fixture
+def qbo_server(db, settings, monkeypatch):
+    settings.QBO_SYNC_ENABLED = True
+    settings.QBO_GZIP_MIN_BYTES = 0
+    settings.QBO_CLIENT_ID, settings.QBO_CLIENT_SECRET = "cid", "secret"
+    _QBO.reset()
+    server = ThreadingHTTPServer(("127.0.0.1", 0), _QBO)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base = f"http://127.0.0.1:{server.server_address[1]}"
+    monkeypatch.setattr("qbo.client.API_BASE", base)
+    monkeypatch.setattr("qbo.oauth.TOKEN_URL", f"{base}/oauth2/v1/tokens/bearer")
+    school = School.objects.create(name="Northgreen", code="ng")
+    QBOConnection.objects.create(school=school, realm_id="r1", access_token="at", refresh_token="rt",
+                                 token_expires_at=timezone.now() + timedelta(hours=1))
+    yield school
+    server.shutdown()
+    close_sessions()
+
+def _payment(school, n, **fields):
+    return Payment.objects.create(school=school, provider="SUREPAY", external_txn_id=f"t{n}", provider_student_id="p1",
+                                  amount=250, currency="UGX", status="SUCCEEDED", narration="Fees", **fields)
+
+def _client(school):
+    client = QBOClient(school)
+    assert client.ensure_token()
+    return client
+
+def test_creates_are_retried_with_one_requestid_and_never_duplicated(qbo_server):
+    p = _payment(qbo_server, 1)
+    client = _client(qbo_server)
+    _QBO.fail_next = [503]
+    receipt = client.create_sales_receipt(p, "C1")
+    assert receipt["Id"] == "1" and receipt["CustomerRef"] == {"value": "C1"}   # gzip both ways
+    assert len(_QBO.posts) == 2 and _QBO.posts[0] == _QBO.posts[1] == ("salesreceipt", _QBO.posts[0][1], "gzip")
+
+    # a later task run resends the same create: QBO hands back the same receipt
+    assert _client(qbo_server).create_sales_receipt(p, "C1")["Id"] == "1"
+    assert len(_QBO.created) == 1
+    assert len(_QBO.connections) == 1                                            # one pooled keep-alive connection
+
+def test_payment_requestid_does_not_depend_on_the_invoice(qbo_server):
+    p = _payment(qbo_server, 1)
+    client = _client(qbo_server)
+    first = client.create_payment(p, "C1", "INV-1")
+    assert client.create_payment(p, "C1", "INV-2")["Id"] == first["Id"]          # a retry that matched another invoice
+    assert len(_QBO.created) == 1
+
+def test_validation_errors_are_parked_not_retried(qbo_server):
+    p = _payment(qbo_server, 1, qbo_customer_id="BAD")
+    with pytest.raises(QBOError) as exc:
+        _client(qbo_server).create_sales_receipt(p, "BAD")
+    assert exc.value.status == 400 and not exc.value.retryable
+    assert len(_QBO.posts) == 1
+
+    sync_payment_to_qbo(payment_id=p.id)                                         # no exception, so no Celery retry
+    p.refresh_from_db()
+    assert p.qbo_txn_id is None and "ValidationException" in p.qbo_sync_error
+    assert p.qbo_customer_id is None                                             # an invalid customer is resolved again
+
+def test_rejected_token_is_refreshed_once_through_the_oauth_session(qbo_server):
+    p = _payment(qbo_server, 1, qbo_customer_id="C1")
+    client = _client(qbo_server)
+    _QBO.token = "at-rotated-elsewhere"                                          # QBO no longer accepts "at"
+    assert client.find_open_invoices("C1") == []                                 # 401, so refresh and retry once
+    assert client.access_token == "at-refreshed"
+    tokens._local.clear()
+    assert tokens.get_token(qbo_server.id) == ("r1", "at-refreshed")
+
+    _QBO.invoices = [{"Id": "INV-1", "Balance": 250.0, "Line": [{"Description": "Fees"}]}]
+    sync_payment_to_qbo(payment_id=p.id)
+    p.refresh_from_db()
+    assert (p.qbo_txn_type, p.qbo_invoice_id, p.qbo_txn_id) == ("Payment", "INV-1", "1")
+    assert _QBO.created[_QBO.posts[-1][1]]["Payment"]["Line"][0]["LinkedTxn"] == [{"TxnId": "INV-1", "TxnType": "Invoice"}]
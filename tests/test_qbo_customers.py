@@ -0,0 +1,111 @@
+import pytest
+from django.core.management import call_command
+from django.utils import timezone
+from schools.models import School, Student, StudentQBOCustomer, QBOConnection
+from payments.models import Payment
+from qbo import customers, tokens
+
+class FakeQBO:
+    """Customers keyed by display name; records every query and batch."""
+    batch_limit = 30
+
+    def __init__(self, existing=()):
+        self.realm_id = "r1"
+        self.customers = {name: str(i) for i, name in enumerate(existing, 100)}
+        self.queries, self.batches = [], []
+        self.refused = set()   # e.g. names already taken by a vendor
+
+    def query(self, statement):
+        self.queries.append(statement)
+        return {"Customer": [{"Id": cid, "DisplayName": name} for name, cid in self.customers.items()
+                             if customers._quote(name) in statement]}
+
+    def batch(self, items):
+        self.batches.append(items)
+        out = []
+        for item in items:
+            name = item["Customer"]["DisplayName"]
+            if name in self.refused:
+                out.append({"bId": item["bId"], "Fault": {"type": "ValidationFault",
+                                                          "Error": [{"Message": "Duplicate Name Exists Error"}]}})
+                continue
+            self.customers[name] = str(len(self.customers) + 100)
+            out.append({"bId": item["bId"], "Customer": {"Id": self.customers[name], "DisplayName": name}})
+        return out
+
+@pytest.fixture
+def school(db):
+    school = School.objects.create(name="Northgreen", code="ng")
+    Student.objects.bulk_create([Student(school=school, school_student_id=f"S{i}", full_name=f"Kid {i}") for i in range(40)])
+    return school
+
+def test_students_resolved_in_bulk_and_remembered(school):
+    qbo = FakeQBO(existing=["Kid 0 (S0)", "Kid 1 (S1)"])
+    students = list(Student.objects.filter(school=school).order_by("id"))
+
+    mapped = customers.resolve_students(qbo, students)
+    assert len(mapped) == 40 and len(set(mapped.values())) == 40
+    assert mapped[students[0].id] == qbo.customers["Kid 0 (S0)"]
+    assert len(qbo.queries) == 1                                  # 40 names fit one IN (...)
+    assert [len(b) for b in qbo.batches] == [30, 8]               # only the missing ones are created
+    assert StudentQBOCustomer.objects.filter(realm_id="r1").count() == 40
+
+    qbo.queries.clear(); qbo.batches.clear()
+    assert customers.resolve_students(qbo, students) == mapped
+    customers.clear()                                             # a fresh worker reads the table
+    assert customers.resolve_students(qbo, students) == mapped
+    assert qbo.queries == [] and qbo.batches == []
+
+def test_payments_use_student_then_provider_name(school):
+    qbo = FakeQBO()
+    student = Student.objects.get(school=school, school_student_id="S3")
+    base = dict(school=school, provider="SUREPAY", amount=100, currency="UGX", status="SUCCEEDED")
+    linked = Payment.objects.create(external_txn_id="t1", provider_student_id="p3", student=student, **base)
+    unlinked = Payment.objects.create(external_txn_id="t2", provider_student_id="p9", **base)
+    booked = Payment.objects.create(external_txn_id="t3", provider_student_id="p9", qbo_customer_id="77", **base)
+
+    out = customers.resolve_payments(qbo, [linked, unlinked, booked])
+    assert out[linked.id] == qbo.customers["Kid 3 (S3)"]
+    assert out[unlinked.id] == qbo.customers["p9 (SUREPAY)"]
+    assert out[booked.id] == "77"
+
+def test_onboarding_command_maps_every_student(school, monkeypatch):
+    QBOConnection.objects.create(school=school, realm_id="r1", access_token="at", refresh_token="rt",
+                                 token_expires_at=timezone.now() + timezone.timedelta(hours=1))
+    qbo = FakeQBO()
+    monkeypatch.setattr("qbo.client.QBOClient.query", lambda self, s: qbo.query(s))
+    monkeypatch.setattr("qbo.client.QBOClient.batch", lambda self, items: qbo.batch(items))
+    call_command("sync_qbo_customers", school="ng", batch_size=25)
+    assert StudentQBOCustomer.objects.filter(student__school=school).count() == 40
+    assert tokens.get_token(school.id) == ("r1", "at")
+    call_command("sync_qbo_customers", school="ng")
+    assert len(qbo.batches) == 2                                  # nothing left to create
+
+def test_display_names_fit_qbo_and_unresolved_payments_are_left_out(school):
+    long = Student.objects.create(school=school, school_student_id="S-LONG", full_name="Nakato " * 30)
+    assert len(customers.student_display_name(long)) <= customers.NAME_MAX
+    assert customers.student_display_name(long).endswith(" (S-LONG)")
+
+    qbo = FakeQBO()
+    qbo.refused.add("Kid 2 (S2)")
+    base = dict(school=school, provider="SUREPAY", amount=100, currency="UGX", status="SUCCEEDED")
+    ok = Payment.objects.create(external_txn_id="t1", provider_student_id="p1",
+                                student=Student.objects.get(school_student_id="S1"), **base)
+    refused = Payment.objects.create(external_txn_id="t2", provider_student_id="p2",
+                                     student=Student.objects.get(school_student_id="S2"), **base)
+    out = customers.resolve_payments(qbo, [ok, refused])
+    assert out == {ok.id: qbo.customers["Kid 1 (S1)"]}
+    assert not StudentQBOCustomer.objects.filter(student=refused.student).exists()
+
+def test_memory_is_bounded_and_invalid_customers_are_forgotten(school, settings):
+    settings.QBO_CUSTOMER_CACHE_SIZE = 10
+    qbo = FakeQBO()
+    students = list(Student.objects.filter(school=school).order_by("id"))
+    mapped = customers.resolve_students(qbo, students)
+    assert len(customers._by_student) == 10 and len(customers._by_name) == 10
+
+    merged = students[0]
+    customers.forget("r1", mapped[merged.id])                    # QBO answered "Invalid Reference Id"
+    assert not StudentQBOCustomer.objects.filter(student=merged).exists()
+    del qbo.customers[customers.student_display_name(merged)]
+    assert customers.resolve_students(qbo, [merged])[merged.id] != mapped[merged.id]
@@ -0,0 +1,74 @@
+import pytest
+from django.utils import timezone
+from schools.models import School, QBOConnection, QBOInvoice, QBOInvoiceClaim
+from payments.models import Payment
+from qbo import invoices
+from qbo.client import QBOClient
+from qbo.tasks import sync_payment_to_qbo, sync_qbo_invoices
+
+def _inv(inv_id, balance, desc="Fees", customer="C1", linked=()):
+    return {"Id": inv_id, "Balance": balance, "CustomerRef": {"value": customer}, "Line": [{"Description": desc}],
+            "LinkedTxn": [{"TxnId": t, "TxnType": "Payment"} for t in linked],
+            "MetaData": {"LastUpdatedTime": "2026-10-01T10:00:00-07:00"}}
+
+@pytest.fixture
+def qbo(db, settings, monkeypatch):
+    settings.QBO_SYNC_ENABLED = True
+    school = School.objects.create(name="Northgreen", code="ng")
+    QBOConnection.objects.create(school=school, realm_id="r1", access_token="at", refresh_token="rt",
+                                 token_expires_at=timezone.now())
+    state = {"query": [], "cdc": [], "cdc_calls": 0}
+    monkeypatch.setattr(QBOClient, "ensure_token", lambda self: True)
+    monkeypatch.setattr(QBOClient, "query", lambda self, statement: {"Invoice": state["query"]})
+    def cdc(self, entities, since):
+        state["cdc_calls"] += 1
+        return {"Invoice": state["cdc"]}
+    monkeypatch.setattr(QBOClient, "change_data_capture", cdc)
+    def live(self, customer_id):
+        raise AssertionError("matched live despite the cache")
+    monkeypatch.setattr(QBOClient, "find_open_invoices", live)
+    monkeypatch.setattr(QBOClient, "find_or_create_customer", lambda self, p: {"Id": "C1"})
+    state["school"] = school
+    return state
+
+def _payment(school, n, amount=250):
+    return Payment.objects.create(school=school, provider="SUREPAY", external_txn_id=f"t{n}", provider_student_id="p1",
+                                  amount=amount, currency="UGX", status="SUCCEEDED", narration="Fees")
+
+def test_one_invoice_is_never_matched_twice(qbo, monkeypatch):
+    qbo["query"] = [_inv("INV-1", 250.0), _inv("INV-2", 99.0), _inv("INV-3", 250.0, desc="Transport")]
+    assert sync_qbo_invoices() == 3
+    assert invoices.is_cached(qbo["school"].id)
+
+    applied = []
+    monkeypatch.setattr(QBOClient, "create_payment",
+                        lambda self, p, customer_id, invoice_id: applied.append(invoice_id) or {"Id": f"PAY-{p.id}"})
+    monkeypatch.setattr(QBOClient, "create_sales_receipt", lambda self, p, customer_id: {"Id": f"SR-{p.id}"})
+    first, second = _payment(qbo["school"], 1), _payment(qbo["school"], 2)
+    sync_payment_to_qbo(payment_id=first.id)
+    sync_payment_to_qbo(payment_id=second.id)
+
+    assert applied == ["INV-1"]
+    assert Payment.objects.get(id=second.id).qbo_txn_type == "SalesReceipt"
+    assert QBOInvoice.objects.get(invoice_id="INV-1").open_minor == 0
+
+    # a CDC poll from before QBO applied the payment keeps the claim; once LinkedTxn shows it, it settles
+    qbo["cdc"] = [_inv("INV-1", 250.0)]
+    sync_qbo_invoices()
+    assert QBOInvoice.objects.get(invoice_id="INV-1").open_minor == 0 and QBOInvoiceClaim.objects.count() == 1
+    qbo["cdc"] = [_inv("INV-1", 0.0, linked=[f"PAY-{first.id}"])]
+    sync_qbo_invoices()
+    assert QBOInvoiceClaim.objects.count() == 0 and qbo["cdc_calls"] == 2
+
+def test_failed_payment_releases_the_claim(qbo, monkeypatch):
+    qbo["query"] = [_inv("INV-1", 250.0)]
+    sync_qbo_invoices()
+    def boom(self, p, customer_id, invoice_id):
+        raise RuntimeError("QBO down")
+    monkeypatch.setattr(QBOClient, "create_payment", boom)
+    p = _payment(qbo["school"], 1)
+    with pytest.raises(RuntimeError):
+        sync_payment_to_qbo(payment_id=p.id)
+    assert QBOInvoice.objects.get(invoice_id="INV-1").open_minor == 25000
+    assert QBOInvoiceClaim.objects.count() == 0
+    assert invoices.claim(p, "C1") == "INV-1"   # index rebuilt after the release
@@ -0,0 +1,89 @@
+import pytest
+from datetime import datetime, timedelta
+from django.utils import timezone
+from freezegun import freeze_time
+from schools.models import School, QBOConnection
+from payments.models import Payment
+from qbo import ratelimit
+from qbo.client import QBOClient
+from qbo.ratelimit import Throttled
+from qbo.tasks import sync_payment_to_qbo
+
+T0 = datetime(2026, 10, 1, 10, 0, 0)
+
+class Resp:
+    def __init__(self, status, headers=None, body=None):
+        self.status_code, self.headers, self._body = status, headers or {}, body or {}
+    def json(self):
+        return self._body
+    def raise_for_status(self):
+        assert self.status_code < 400
+
+def test_allowance_spreads_the_rate_over_the_minute():
+    for rate in (450, 45, 500):
+        per_second = [ratelimit.allowance(rate, s) for s in range(1_000_000, 1_000_060)]
+        assert sum(per_second) == rate and max(per_second) - min(per_second) <= 1
+
+def test_requests_are_paced_per_second(settings):
+    settings.QBO_RATE_LIMIT_PER_MINUTE = 120
+    with freeze_time(T0) as frozen:
+        for _ in range(2):
+            with ratelimit.slot("r1", max_wait=0):
+                pass
+        with pytest.raises(Throttled) as exc:
+            with ratelimit.slot("r1", max_wait=0):
+                pass
+        assert 0 < exc.value.retry_after <= 1
+        with ratelimit.slot("r2", max_wait=0):   # other realms have their own budget
+            pass
+        frozen.tick(1)
+        with ratelimit.slot("r1", max_wait=0):
+            pass
+
+def test_concurrent_requests_are_capped(settings):
+    settings.QBO_MAX_CONCURRENT = 2
+    with ratelimit.slot("r1", max_wait=0), ratelimit.slot("r1", max_wait=0):
+        with pytest.raises(Throttled):
+            with ratelimit.slot("r1", max_wait=0):
+                pass
+    with ratelimit.slot("r1", max_wait=0):
+        pass
+
+def test_429_pauses_the_realm_and_halves_the_rate(db, settings, monkeypatch):
+    settings.QBO_RATE_INCREASE = 10
+    client = QBOClient(School.objects.create(name="Northgreen", code="ng"))
+    client.realm_id, client.access_token = "r1", "at"
+    monkeypatch.setattr("requests.Session.request", lambda *a, **kw: Resp(429, {"Retry-After": "3"}))
+    with freeze_time(T0) as frozen:
+        with pytest.raises(Throttled) as exc:
+            client.query("SELECT * FROM Customer")
+        assert exc.value.retry_after == 3
+        assert ratelimit.throttled("r1", "3") == 3        # another 429 of the same burst: no second cut
+        assert ratelimit.current_rate("r1") == 225
+        with pytest.raises(Throttled):
+            with ratelimit.slot("r1", max_wait=1):
+                pass
+
+        frozen.tick(4)
+        monkeypatch.setattr("requests.Session.request",
+                            lambda *a, **kw: Resp(200, body={"QueryResponse": {"Customer": []}}))
+        assert client.query("SELECT * FROM Customer") == {"Customer": []}
+        assert ratelimit.current_rate("r1") == 235        # additive increase, once per second
+        client.query("SELECT * FROM Customer")
+        assert ratelimit.current_rate("r1") == 235
+
+def test_throttled_sync_retries_after_retry_after(db, settings, monkeypatch):
+    settings.QBO_SYNC_ENABLED = True
+    school = School.objects.create(name="Northgreen", code="ng")
+    QBOConnection.objects.create(school=school, realm_id="r1", access_token="at", refresh_token="rt",
+                                 token_expires_at=timezone.now() + timedelta(hours=1))
+    p = Payment.objects.create(school=school, provider="SUREPAY", external_txn_id="t1", provider_student_id="p1",
+                               amount=100, currency="UGX", status="SUCCEEDED", qbo_customer_id="C1", qbo_invoice_id="I1")
+    def throttled(self, *args):
+        raise Throttled("r1", 12.5)
+    monkeypatch.setattr(QBOClient, "create_payment", throttled)
+    retries = []
+    monkeypatch.setattr(sync_payment_to_qbo, "retry", lambda **kw: retries.append(kw) or RuntimeError("retry"))
+    with pytest.raises(RuntimeError):
+        sync_payment_to_qbo(payment_id=p.id)
+    assert 13 <= retries[0]["countdown"] <= 18 and retries[0]["max_retries"] == 20
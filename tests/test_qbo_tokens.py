@@ -0,0 +1,60 @@
+import threading, time, pytest
+from datetime import timedelta
+from django.core.cache import cache
+from django.utils import timezone
+from schools.models import School, QBOConnection
+from qbo import tokens
+from qbo.tasks import refresh_qbo_tokens
+
+@pytest.fixture
+def refreshes(monkeypatch):
+    calls = []
+    def fake_refresh(refresh_token):
+        calls.append(refresh_token)
+        return {"access_token": f"at{len(calls)}", "refresh_token": f"rt{len(calls)}", "expires_in": 3600}
+    monkeypatch.setattr("qbo.oauth.refresh_access_token", fake_refresh)
+    return calls
+
+def _conn(code, expires_in):
+    school = School.objects.create(name=code, code=code)
+    return QBOConnection.objects.create(school=school, realm_id=f"realm-{code}", access_token="at0", refresh_token="rt0",
+                                        token_expires_at=timezone.now() + timedelta(seconds=expires_in))
+
+@pytest.mark.django_db
+def test_valid_token_is_cached_across_clients(refreshes, django_assert_num_queries):
+    conn = _conn("ng", 3600)
+    assert tokens.get_token(conn.school_id) == ("realm-ng", "at0")
+    tokens._local.clear()  # another worker process: shared cache only
+    with django_assert_num_queries(0):
+        assert tokens.get_token(conn.school_id) == ("realm-ng", "at0")
+    assert refreshes == []
+
+@pytest.mark.django_db
+def test_expired_token_is_refreshed_once_with_the_latest_refresh_token(refreshes):
+    conn = _conn("ng", -10)
+    assert tokens.get_token(conn.school_id) == ("realm-ng", "at1")
+    conn.refresh_from_db()
+    assert (conn.refresh_token, refreshes) == ("rt1", ["rt0"])
+    tokens._local.clear()
+    assert tokens.get_token(conn.school_id) == ("realm-ng", "at1")
+    assert refreshes == ["rt0"]
+
+@pytest.mark.django_db
+def test_waiter_reuses_the_lock_holders_token(refreshes):
+    conn = _conn("ng", -10)
+    cache.add(tokens.LOCK_KEY.format(realm_id=conn.realm_id), "other-worker", 30)
+    publisher = threading.Timer(0.1, tokens._publish, (conn.school_id, ("realm-ng", "fresh", time.time() + 3600)))
+    publisher.start()
+    try:
+        assert tokens.get_token(conn.school_id) == ("realm-ng", "fresh")
+    finally:
+        publisher.join()
+    assert refreshes == []
+
+@pytest.mark.django_db
+def test_beat_refreshes_tokens_close_to_expiry(refreshes):
+    soon, later = _conn("ng", 120), _conn("hs", 3600)
+    assert refresh_qbo_tokens() == 1
+    soon.refresh_from_db(); later.refresh_from_db()
+    assert (soon.access_token, later.access_token) == ("at1", "at0")
+    assert tokens.get_token(soon.school_id) == ("realm-ng", "at1")
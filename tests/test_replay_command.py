@@ -0,0 +1,47 @@
+import json, pytest
+from io import StringIO
+from django.core.management import call_command
+from schools.models import School
+from payments.models import AggregatorAccount, WebhookEvent, Payment
+
+@pytest.fixture
+def backlog(db):
+    accounts = []
+    for code in ("ng", "hs"):
+        school = School.objects.create(name=code, code=code)
+        accounts.append(AggregatorAccount.objects.create(school=school, provider="SUREPAY", webhook_secret="sek"))
+    for n in range(7):
+        acct = accounts[n % 2]
+        WebhookEvent.objects.create(
+            aggregator_account=acct, provider="SUREPAY", event_id=f"e{n}",
+            payload={"event_id":f"e{n}","transaction_id":f"t{n}","amount":500,"currency":"UGX","status":"SUCCESS","student_id":"p1"})
+    return accounts
+
+def _replay(tmp_path, *args):
+    out = StringIO()
+    call_command("replay_webhook_events", "--workers", "0", "--chunk-size", "2",
+                 "--checkpoint", str(tmp_path / "cp.json"), *args, stdout=out)
+    return out.getvalue()
+
+def test_dry_run_changes_nothing(backlog, tmp_path):
+    out = _replay(tmp_path, "--dry-run", "--school", "ng")
+    assert "would replay 4 events in 2 chunks" in out
+    assert not WebhookEvent.objects.filter(processed=True).exists()
+
+def test_provider_filter_ignores_case(backlog, tmp_path):
+    assert "would replay 7 events" in _replay(tmp_path, "--dry-run", "--provider", "surepay")
+
+def test_replay_filters_and_checkpoints(backlog, tmp_path):
+    out = _replay(tmp_path, "--school", "ng")
+    assert "replayed 4 events" in out
+    assert set(Payment.objects.values_list("external_txn_id", flat=True)) == {"t0", "t2", "t4", "t6"}
+    saved = json.loads((tmp_path / "cp.json").read_text())
+    assert saved["last_id"] == WebhookEvent.objects.get(event_id="e6").id
+
+def test_resume_starts_after_checkpoint(backlog, tmp_path):
+    cutoff = WebhookEvent.objects.get(event_id="e3").id
+    (tmp_path / "cp.json").write_text(json.dumps(
+        {"last_id": cutoff, "filters": {"school": None, "provider": None, "since": None, "until": None}}))
+    out = _replay(tmp_path, "--resume")
+    assert "3 unprocessed events after id" in out
+    assert set(Payment.objects.values_list("external_txn_id", flat=True)) == {"t4", "t5", "t6"}
@@ -0,0 +1,100 @@
+import json, threading, pytest
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from schools.models import School, SchoolDirectoryConnection
+from school_api.client import SchoolAPIClient, close_sessions
+
+class _Directory(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"  # keep-alive
+    connections = set()
+    posts = 0
+    def do_GET(self):
+        type(self).connections.add(self.client_address)
+        pid = self.path.rsplit("/", 1)[-1]
+        if pid.startswith("missing"):
+            self.send_response(404); self.send_header("Content-Length", "0"); self.end_headers()
+            return
+        body = json.dumps({"school_student_id": f"SCH-{pid}", "full_name": pid}).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+    def do_POST(self):
+        type(self).posts += 1
+        ids = json.loads(self.rfile.read(int(self.headers["Content-Length"])))["provider_student_ids"]
+        if self.path != "/students/by-provider-ids":
+            self.send_response(404); self.send_header("Content-Length", "0"); self.end_headers()
+            return
+        results = [{"provider_student_id": pid, "school_student_id": f"SCH-{pid}", "full_name": pid}
+                   for pid in ids if not pid.startswith("missing")]
+        if "missing-junk" in ids:
+            results[:0] = ["junk", None, 7, ["junk"]]
+        body = json.dumps({"results": results}).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+    def log_message(self, *args):
+        pass
+
+@pytest.fixture
+def directory_server():
+    _Directory.connections = set()
+    _Directory.posts = 0
+    server = ThreadingHTTPServer(("127.0.0.1", 0), _Directory)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield f"http://127.0.0.1:{server.server_address[1]}"
+    server.shutdown()
+    close_sessions()
+
+@pytest.mark.django_db
+def test_lookups_reuse_pooled_connections(directory_server, settings):
+    settings.SCHOOL_API_MAX_CONCURRENCY = 4
+    school = School.objects.create(name="Northgreen", code="ng")
+    conn = SchoolDirectoryConnection.objects.create(school=school, base_url=directory_server, api_key="k")
+
+    for _ in range(5):
+        assert SchoolAPIClient(conn).get_by_provider_student_id("p1")["school_student_id"] == "SCH-p1"
+    assert len(_Directory.connections) == 1
+
+    ids = [f"p{i}" for i in range(20)] + ["missing-1"]
+    out = SchoolAPIClient(conn).get_many(ids)
+    assert out["p7"]["school_student_id"] == "SCH-p7"
+    assert out["missing-1"] is None
+    assert len(out) == 21
+    assert len(_Directory.connections) <= 4 + 1
+
+@pytest.mark.django_db
+def test_bulk_lookup_chunks_ids(directory_server, settings):
+    settings.SCHOOL_API_BULK_CHUNK = 10
+    school = School.objects.create(name="Northgreen", code="ng")
+    conn = SchoolDirectoryConnection.objects.create(
+        school=school, base_url=directory_server, api_key="k", students_by_provider_ids_path="/students/by-provider-ids")
+
+    ids = [f"p{i}" for i in range(25)] + ["missing-1"]
+    out = SchoolAPIClient(conn).get_many(ids)
+    assert _Directory.posts == 3
+    assert out["p24"]["school_student_id"] == "SCH-p24"
+    assert out["missing-1"] is None
+    assert len(out) == 26
+
+@pytest.mark.django_db
+def test_bulk_lookup_skips_malformed_elements(directory_server):
+    school = School.objects.create(name="Northgreen", code="ng")
+    conn = SchoolDirectoryConnection.objects.create(
+        school=school, base_url=directory_server, api_key="k", students_by_provider_ids_path="/students/by-provider-ids")
+
+    out = SchoolAPIClient(conn).get_many(["p1", "missing-junk"])
+    assert _Directory.posts == 1
+    assert out == {"p1": {"provider_student_id": "p1", "school_student_id": "SCH-p1", "full_name": "p1"}, "missing-junk": None}
+
+@pytest.mark.django_db
+def test_bulk_lookup_falls_back_to_single_lookups(directory_server):
+    school = School.objects.create(name="Northgreen", code="ng")
+    conn = SchoolDirectoryConnection.objects.create(
+        school=school, base_url=directory_server, api_key="k", students_by_provider_ids_path="/no-such-endpoint")
+
+    out = SchoolAPIClient(conn).get_many(["p1", "p2"])
+    assert _Directory.posts == 1
+    assert out["p2"]["school_student_id"] == "SCH-p2"
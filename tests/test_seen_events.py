@@ -0,0 +1,52 @@
+import json, hmac, hashlib, pytest
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from schools.models import School
+from payments.models import AggregatorAccount, WebhookEvent
+from webhooks.dedupe import get_seen_events
+
+def _post(client, payload):
+    body = json.dumps(payload).encode()
+    sig = hmac.new(b"sek", body, hashlib.sha256).hexdigest()
+    url = reverse("payment-webhook", kwargs={"provider":"SUREPAY"})
+    return client.post(url, data=body, content_type="application/json",
+                       HTTP_X_SIGNATURE=sig, HTTP_X_SCHOOL_CODE="ng")
+
+@pytest.fixture
+def account(db):
+    school = School.objects.create(name="Northgreen", code="ng")
+    return AggregatorAccount.objects.create(school=school, provider="SUREPAY", webhook_secret="sek", is_active=True)
+
+PAYLOAD = {"event_id":"e1","transaction_id":"t1","amount":1000,"currency":"UGX","status":"PENDING","student_id":"prov-001"}
+
+@pytest.mark.django_db(transaction=True)
+def test_processed_duplicate_answered_without_db(client, account):
+    assert _post(client, PAYLOAD).status_code == 200
+    assert WebhookEvent.objects.get(event_id="e1").processed
+    assert get_seen_events().is_processed(account.id, "e1")
+
+    _post(client, PAYLOAD)  # warm the account cache hit path
+    with CaptureQueriesContext(connection) as ctx:
+        res = _post(client, PAYLOAD)
+    assert res.data == {"status":"ok", "idempotent": True}
+    assert len(ctx.captured_queries) == 0
+
+@pytest.mark.django_db
+def test_unprocessed_duplicate_is_not_reported_as_processed(client, account, monkeypatch):
+    from payments.tasks import process_webhook_event_task
+    monkeypatch.setattr(process_webhook_event_task, "delay", lambda event_id, school_id=None: None)
+    assert _post(client, PAYLOAD).status_code == 200
+    assert not get_seen_events().is_processed(account.id, "e1")
+    res = _post(client, PAYLOAD)
+    assert res.data == {"status":"ok"}  # re-dispatched, not short-circuited
+
+@pytest.mark.django_db
+def test_shared_tier_is_consulted(settings):
+    settings.WEBHOOK_SEEN_EVENTS_SHARED = True
+    seen = get_seen_events()
+    seen.mark_processed(7, "evt")
+    seen.clear()  # another worker: empty local set, same shared cache
+    assert seen.is_processed(7, "evt")
+    assert seen.processed_among(7, ["evt", "other"]) == {"evt"}
+    assert not seen.is_processed(7, "other")
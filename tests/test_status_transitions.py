@@ -0,0 +1,55 @@
+import pytest
+from schools.models import School
+from payments.models import AggregatorAccount, WebhookEvent, Payment, PaymentOutbox, PaymentStatusRejection
+from payments.tasks import process_webhook_event_task, process_webhook_events_batch
+from payments import transitions
+
+@pytest.fixture
+def acct(db):
+    school = School.objects.create(name="Northgreen", code="ng")
+    return AggregatorAccount.objects.create(school=school, provider="SUREPAY", webhook_secret="sek", is_active=True)
+
+def _queued():
+    return list(PaymentOutbox.objects.values_list("payment_id", flat=True))
+
+def _event(acct, n, status, at, **over):
+    payload = {"event_id":f"e{n}","transaction_id":"t1","amount":500,"currency":"UGX","status":status,
+               "student_id":"prov-001","occurred_at":at}
+    payload.update(over)
+    return WebhookEvent.objects.create(aggregator_account=acct, provider="SUREPAY", event_id=f"e{n}", payload=payload)
+
+def test_regressive_and_stale_events_are_dropped(acct, upsert_path):
+    for n, status, at in [(1, "PENDING", "2026-01-01T10:00:00Z"), (2, "SUCCESS", "2026-01-01T10:05:00Z")]:
+        process_webhook_event_task(event_id=_event(acct, n, status, at).id)
+    p = Payment.objects.get(external_txn_id="t1")
+    assert p.status == "SUCCEEDED" and len(_queued()) == 1
+
+    # late PENDING retry, then an older SUCCESS with a different amount
+    process_webhook_event_task(event_id=_event(acct, 3, "PENDING", "2026-01-01T10:00:00Z").id)
+    process_webhook_event_task(event_id=_event(acct, 4, "SUCCESS", "2026-01-01T10:01:00Z", amount=900).id)
+    after = Payment.objects.get(id=p.id)
+    assert (after.status, after.amount, after.updated_at) == ("SUCCEEDED", 500, p.updated_at)
+    assert len(_queued()) == 1
+    assert WebhookEvent.objects.filter(processed=False).count() == 0
+    assert sorted(PaymentStatusRejection.objects.values_list("reason", flat=True)) == ["regressive", "stale"]
+    assert transitions.stats() == {"regressive": 1, "stale": 1}
+
+    process_webhook_event_task(event_id=_event(acct, 5, "REFUNDED", "2026-01-01T09:00:00Z").id)
+    assert Payment.objects.get(id=p.id).status == "REFUNDED"
+
+def test_batch_folds_out_of_order_events(acct):
+    events = [
+        _event(acct, 1, "SUCCESS", "2026-01-01T10:05:00Z"),
+        _event(acct, 2, "PENDING", "2026-01-01T10:00:00Z"),
+        _event(acct, 3, "FAILED", "2026-01-01T10:02:00Z"),
+        _event(acct, 4, "REFUNDED", "2026-01-01T11:00:00Z"),
+        _event(acct, 5, "SUCCESS", "2026-01-01T10:05:00Z"),
+    ]
+    process_webhook_events_batch(event_ids=[e.id for e in events])
+    p = Payment.objects.get(external_txn_id="t1")
+    assert p.status == "REFUNDED" and p.status_at.hour == 11
+    rejected = PaymentStatusRejection.objects.order_by("event_id")
+    assert [(r.event.event_id, r.from_status, r.to_status) for r in rejected] == [
+        ("e2", "SUCCEEDED", "PENDING"), ("e3", "SUCCEEDED", "FAILED"), ("e5", "REFUNDED", "SUCCEEDED")]
+    assert all(r.payment_id == p.id for r in rejected)
+    assert _queued() == []
@@ -0,0 +1,54 @@
+import pytest
+from datetime import timedelta
+from django.utils import timezone
+from freezegun import freeze_time
+from schools.models import School
+from payments.models import AggregatorAccount, WebhookEvent, Payment
+from payments.tasks import sweep_stuck_events, process_webhook_event_task, process_webhook_events_batch
+
+def _event(acct, n, minutes_ago, **fields):
+    payload = {"event_id":f"e{n}","transaction_id":f"t{n}","amount":500,"currency":"UGX","status":"SUCCESS","student_id":"p1"}
+    return WebhookEvent.objects.create(aggregator_account=acct, provider="SUREPAY", event_id=f"e{n}", payload=payload,
+                                       received_at=timezone.now() - timedelta(minutes=minutes_ago), **fields)
+
+@pytest.fixture
+def acct(db):
+    school = School.objects.create(name="Northgreen", code="ng")
+    return AggregatorAccount.objects.create(school=school, provider="SUREPAY", webhook_secret="sek")
+
+def test_sweeper_reenqueues_with_backoff(acct, settings, monkeypatch):
+    settings.WEBHOOK_SWEEP_MAX_ATTEMPTS = 3
+    published = []
+    monkeypatch.setattr(process_webhook_events_batch, "apply_async",
+                        lambda kwargs, priority: published.append((kwargs["school_id"], kwargs["event_ids"], priority)))
+    stuck = _event(acct, 1, 30)
+    _event(acct, 2, 1)                                     # still fresh
+    _event(acct, 3, 30, processed=True)
+    _event(acct, 4, 30, attempts=3)                        # gave up
+
+    assert sweep_stuck_events() == 1
+    assert published == [(acct.school_id, [stuck.id], settings.CELERY_BULK_PRIORITY)]   # behind live webhooks
+    stuck.refresh_from_db()
+    assert stuck.attempts == 1 and stuck.next_attempt_at > timezone.now()
+
+    assert sweep_stuck_events() == 0                       # backing off
+    with freeze_time(timezone.now() + timedelta(seconds=61)):
+        assert sweep_stuck_events() == 1
+    stuck.refresh_from_db()
+    assert stuck.attempts == 2
+    assert stuck.next_attempt_at - timezone.now() > timedelta(seconds=100)   # 120s after the second try
+
+def test_sweep_processes_events_end_to_end(acct):
+    _event(acct, 1, 30)
+    sweep_stuck_events()
+    assert WebhookEvent.objects.get(event_id="e1").processed
+    assert Payment.objects.filter(external_txn_id="t1").exists()
+
+def test_failed_task_records_processing_error(acct):
+    ev = _event(acct, 1, 0)
+    ev.payload = {**ev.payload, "amount": "lots"}
+    ev.save()
+    with pytest.raises(Exception):
+        process_webhook_event_task(event_id=ev.id)
+    ev.refresh_from_db()
+    assert not ev.processed and "ValidationError" in ev.processing_error
@@ -0,0 +1,61 @@
+import pytest
+from datetime import timedelta
+from django.utils import timezone
+from schools.models import School, SchoolDirectoryConnection, Student, StudentIdMap
+from schools.resolution import student_resolver
+from school_api import client as dir_client
+
+@pytest.fixture
+def directory(monkeypatch):
+    calls = []
+    answers = {"prov-001": {"school_student_id":"SCH-123","full_name":"Jane Doe"}}
+    def fake(self, provider_student_id):
+        calls.append(provider_student_id)
+        return answers.get(provider_student_id)
+    monkeypatch.setattr(dir_client.SchoolAPIClient, "get_by_provider_student_id", fake)
+    return calls, answers
+
+@pytest.fixture
+def school(db):
+    school = School.objects.create(name="Northgreen", code="ng")
+    SchoolDirectoryConnection.objects.create(school=school, base_url="https://dir.example.com", api_key="k")
+    return school
+
+def test_directory_only_on_true_miss(school, directory, django_assert_num_queries):
+    calls, _ = directory
+    student, sch_sid = student_resolver.resolve(school, "prov-001")
+    assert sch_sid == "SCH-123" and student.full_name == "Jane Doe"
+    assert StudentIdMap.objects.filter(school=school, provider_student_id="prov-001").exists()
+
+    with django_assert_num_queries(0):
+        assert student_resolver.resolve(school, "prov-001")[1] == "SCH-123"
+    student_resolver.clear()  # e.g. another worker: served from StudentIdMap
+    assert student_resolver.resolve(school, "prov-001")[1] == "SCH-123"
+    assert calls == ["prov-001"]
+
+def test_stale_mapping_is_refreshed(school, directory, settings, django_assert_num_queries):
+    calls, answers = directory
+    settings.STUDENT_MAPPING_MAX_AGE = 3600
+    old = Student.objects.create(school=school, school_student_id="SCH-OLD")
+    StudentIdMap.objects.create(school=school, provider_student_id="prov-001", student=old,
+                                resolved_at=timezone.now() - timedelta(hours=2))
+    assert student_resolver.resolve(school, "prov-001")[1] == "SCH-123"
+    assert calls == ["prov-001"]
+    assert StudentIdMap.objects.get(provider_student_id="prov-001").student.school_student_id == "SCH-123"
+
+    # directory down: the stale mapping is still served
+    StudentIdMap.objects.update(resolved_at=timezone.now() - timedelta(hours=2))
+    student_resolver.clear()
+    answers.clear()
+    assert student_resolver.resolve(school, "prov-001")[1] == "SCH-123"
+    with django_assert_num_queries(0):  # held as checked: no re-read or refresh per payment
+        assert student_resolver.resolve(school, "prov-001")[1] == "SCH-123"
+
+def test_resolve_many_hits_directory_once_per_unknown_id(school, directory):
+    calls, answers = directory
+    answers["prov-002"] = {"school_student_id":"SCH-2","full_name":"B"}
+    known = Student.objects.create(school=school, school_student_id="SCH-9")
+    StudentIdMap.objects.create(school=school, provider_student_id="prov-009", student=known)
+    out = student_resolver.resolve_many(school, ["prov-001", "prov-002", "prov-009", "prov-001", "nobody"])
+    assert {k: v[1] for k, v in out.items()} == {"prov-001":"SCH-123", "prov-002":"SCH-2", "prov-009":"SCH-9"}
+    assert sorted(calls) == ["nobody", "prov-001", "prov-002"]
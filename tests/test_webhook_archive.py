@@ -0,0 +1,107 @@
+import gzip, json, pytest
+from datetime import datetime, timezone as dt_timezone
+from io import StringIO
+from django.core.management import call_command
+from django.db import IntegrityError, connection, transaction
+from freezegun import freeze_time
+from schools.models import School
+from payments.models import AggregatorAccount, WebhookEvent
+from payments import partitions
+from payments.tasks import create_webhook_partitions
+from webhooks.ingest import insert_events
+
+@pytest.fixture
+def acct(db):
+    school = School.objects.create(name="Northgreen", code="ng")
+    return AggregatorAccount.objects.create(school=school, provider="SUREPAY", webhook_secret="sek")
+
+def _event(acct, n, when):
+    return WebhookEvent.objects.create(aggregator_account=acct, provider="SUREPAY", event_id=f"e{n}",
+                                       payload={"event_id": f"e{n}"}, received_at=when)
+
+def _archive(tmp_path, *args):
+    out = StringIO()
+    call_command("archive_webhook_events", "--retention-months", "2", "--dir", str(tmp_path), *args, stdout=out)
+    return out.getvalue()
+
+def test_month_arithmetic():
+    assert partitions.add_months(datetime(2026, 11, 20).date(), 3) == datetime(2027, 2, 1).date()
+    assert partitions.add_months(datetime(2026, 1, 5).date(), -1) == datetime(2025, 12, 1).date()
+    assert partitions.partition_name(datetime(2026, 3, 1).date()) == "payments_webhookevent_p202603"
+    with freeze_time("2026-10-18"):
+        assert partitions.retention_cutoff(13) == datetime(2025, 9, 1).date()
+
+@freeze_time("2026-10-18T12:00:00Z")
+def test_archive_exports_and_drops_expired_months(acct, tmp_path):
+    utc = dt_timezone.utc
+    _event(acct, 1, datetime(2026, 6, 3, tzinfo=utc))
+    _event(acct, 2, datetime(2026, 6, 30, 23, 59, tzinfo=utc))
+    _event(acct, 3, datetime(2026, 7, 31, tzinfo=utc))
+    _event(acct, 4, datetime(2026, 8, 1, tzinfo=utc))        # inside the window (Aug..Oct)
+
+    out = _archive(tmp_path, "--dry-run")
+    assert "2026-06: 2 events" in out and "2026-07: 1 events" in out
+    assert WebhookEvent.objects.count() == 4
+
+    out = _archive(tmp_path)
+    assert "2026-06: archived 2 events" in out
+    assert list(WebhookEvent.objects.values_list("event_id", flat=True)) == ["e4"]
+    with gzip.open(tmp_path / "webhookevents-2026-06.ndjson.gz", "rt") as f:
+        rows = [json.loads(line) for line in f]
+    assert [r["event_id"] for r in rows] == ["e1", "e2"]
+    assert rows[0]["payload"] == {"event_id": "e1"} and rows[0]["aggregator_account_id"] == acct.id
+    assert not list(tmp_path.glob("*.part"))
+
+    assert _archive(tmp_path).strip() == "nothing to archive"
+
+on_postgres = pytest.mark.skipif(connection.vendor != "postgresql", reason="partitioning is Postgres only")
+
+@pytest.mark.skipif(connection.vendor == "postgresql", reason="partitions exist on Postgres")
+def test_partition_task_is_a_noop_off_postgres(db):
+    assert create_webhook_partitions() == []
+
+@on_postgres
+def test_migrated_table_is_partitioned_and_keeps_event_ids_unique(acct):
+    assert partitions.is_partitioned()
+    first = _event(acct, 1, datetime(2026, 6, 3, tzinfo=dt_timezone.utc))
+    second = _event(acct, 2, datetime(2026, 7, 3, tzinfo=dt_timezone.utc))
+    assert second.id > first.id                                # ids come from the new table's sequence
+    with pytest.raises(IntegrityError), transaction.atomic():
+        _event(acct, 1, datetime(2026, 8, 3, tzinfo=dt_timezone.utc))
+
+def test_event_ids_stay_unique_per_account(acct):
+    _event(acct, 1, datetime(2026, 6, 3, tzinfo=dt_timezone.utc))
+    with pytest.raises(IntegrityError), transaction.atomic():
+        _event(acct, 1, datetime(2026, 7, 3, tzinfo=dt_timezone.utc))
+
+@on_postgres
+@freeze_time("2026-10-18T12:00:00Z")
+def test_default_partition_rows_are_moved_into_new_months_and_archived(acct, tmp_path):
+    utc = dt_timezone.utc
+    stray = _event(acct, 1, datetime(2031, 5, 3, tzinfo=utc))   # no partition that far ahead: DEFAULT
+    _event(acct, 2, datetime(2019, 3, 1, tzinfo=utc))           # nor that far back
+    assert partitions.default_months() == [datetime(2019, 3, 1).date(), datetime(2031, 5, 1).date()]
+
+    partitions.create_partition(datetime(2031, 5, 1).date())
+    assert partitions.default_months() == [datetime(2019, 3, 1).date()]
+    assert WebhookEvent.objects.get(event_id="e1").id == stray.id
+    with pytest.raises(IntegrityError), transaction.atomic():
+        _event(acct, 1, datetime(2026, 8, 3, tzinfo=utc))        # its key moved with it
+
+    assert "2019-03: archived 1 events" in _archive(tmp_path)
+    assert partitions.default_months() == []
+    _event(acct, 2, datetime(2026, 9, 3, tzinfo=utc))            # key went with the archived row
+
+def test_stored_events_are_left_out_of_the_bulk_insert(acct, monkeypatch):
+    utc = dt_timezone.utc
+    first = _event(acct, 1, datetime(2026, 6, 3, tzinfo=utc))
+    def event(n):
+        return WebhookEvent(aggregator_account=acct, provider="SUREPAY", event_id=f"e{n}",
+                            payload={"event_id": f"e{n}"}, received_at=datetime(2026, 6, 4, tzinfo=utc))
+    def no_single_inserts(self, *args, **kwargs):
+        raise AssertionError("fell back to one insert per row")
+    monkeypatch.setattr(WebhookEvent, "save", no_single_inserts)
+    stored = insert_events([event(1), event(2), event(2)])
+    assert stored[(acct.id, "e1")] == (first.id, False)
+    assert set(stored) == {(acct.id, "e1"), (acct.id, "e2")}
+    assert WebhookEvent.objects.count() == 2
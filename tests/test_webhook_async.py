@@ -0,0 +1,48 @@
+import json, hmac, hashlib, pytest
+from django.urls import reverse
+from schools.models import School
+from payments.models import AggregatorAccount, WebhookEvent
+
+def _post(client, payload, secret=b"sek"):
+    body = json.dumps(payload).encode()
+    sig = hmac.new(secret, body, hashlib.sha256).hexdigest()
+    url = reverse("payment-webhook-async", kwargs={"provider":"SUREPAY"})
+    return client.post(url, data=body, content_type="application/json",
+                       HTTP_X_SIGNATURE=sig, HTTP_X_SCHOOL_CODE="ng")
+
+@pytest.fixture
+def published(monkeypatch):
+    # the publish runs on the pool thread; keep it off the test DB connection
+    from payments.tasks import process_webhook_event_task
+    ids = []
+    monkeypatch.setattr(process_webhook_event_task, "delay", lambda event_id, school_id=None: ids.append(event_id))
+    return ids
+
+@pytest.mark.django_db
+def test_async_webhook_writes_event_and_publishes(client, published):
+    school = School.objects.create(name="Northgreen", code="ng")
+    acct = AggregatorAccount.objects.create(school=school, provider="SUREPAY", webhook_secret="sek", is_active=True)
+    payload = {"event_id":"e1","transaction_id":"t1","amount":250000,"currency":"UGX","status":"SUCCESS","student_id":"prov-001"}
+
+    res = _post(client, payload)
+    assert res.status_code == 200
+    ev = WebhookEvent.objects.get(event_id="e1", aggregator_account=acct)
+    assert published == [ev.id]
+
+    WebhookEvent.objects.filter(id=ev.id).update(processed=True)
+    res = _post(client, payload)
+    assert res.json() == {"status":"ok", "idempotent": True}
+    assert published == [ev.id]
+
+@pytest.mark.django_db
+def test_async_webhook_rejects_bad_signature_and_unknown_school(client, published, django_capture_on_commit_callbacks):
+    payload = {"event_id":"e1","transaction_id":"t1","amount":1,"currency":"UGX","status":"SUCCESS","student_id":"p"}
+    assert _post(client, payload).status_code == 404
+
+    with django_capture_on_commit_callbacks(execute=True):
+        school = School.objects.create(name="Northgreen", code="ng")
+        AggregatorAccount.objects.create(school=school, provider="SUREPAY", webhook_secret="sek", is_active=True)
+    res = _post(client, payload, secret=b"wrong")
+    assert res.status_code == 400
+    assert "signature" in res.json()["detail"]
+    assert published == []
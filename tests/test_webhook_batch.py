@@ -0,0 +1,68 @@
+import json, hmac, hashlib, pytest
+from django.urls import reverse
+from schools.models import School
+from payments.models import AggregatorAccount, WebhookEvent, Payment
+
+def _item(n, **extra):
+    return {"event_id":f"e{n}","transaction_id":f"t{n}","amount":1000+n,"currency":"UGX","status":"SUCCESS","student_id":"prov-001", **extra}
+
+def _post(client, body: bytes, content_type="application/json"):
+    sig = hmac.new(b"sek", body, hashlib.sha256).hexdigest()
+    url = reverse("payment-webhook-batch", kwargs={"provider":"SUREPAY"})
+    return client.post(url, data=body, content_type=content_type,
+                       HTTP_X_SIGNATURE=sig, HTTP_X_SCHOOL_CODE="ng")
+
+@pytest.fixture
+def account(db):
+    school = School.objects.create(name="Northgreen", code="ng")
+    return AggregatorAccount.objects.create(school=school, provider="SUREPAY", webhook_secret="sek", is_active=True)
+
+@pytest.mark.django_db
+def test_ndjson_batch_inserts_and_processes_in_chunks(client, account, settings, monkeypatch):
+    settings.WEBHOOK_BATCH_DISPATCH_SIZE = 2
+    from payments import tasks
+    published = []
+    original = tasks.process_webhook_events_batch.apply_async
+    monkeypatch.setattr(tasks.process_webhook_events_batch, "apply_async",
+                        lambda kwargs, priority=None: (published.append(list(kwargs["event_ids"])), original(kwargs=kwargs))[1])
+
+    body = "\n".join(json.dumps(_item(n)) for n in range(5)).encode()
+    res = _post(client, body, content_type="application/x-ndjson")
+    assert res.status_code == 200
+    assert res.data["accepted"] == 5
+    assert [len(c) for c in published] == [2, 2, 1]
+    assert WebhookEvent.objects.filter(aggregator_account=account, processed=True).count() == 5
+    assert Payment.objects.count() == 5
+
+@pytest.mark.django_db
+def test_array_batch_reports_per_item_results(client, account):
+    WebhookEvent.objects.create(aggregator_account=account, provider="SUREPAY", event_id="e0",
+                                payload=_item(0), processed=True)
+    items = [_item(0), _item(1), {"event_id":"bad"}, _item(1)]
+    res = _post(client, json.dumps(items).encode())
+    assert res.status_code == 200
+    statuses = [r["status"] for r in res.data["results"]]
+    assert statuses == ["duplicate", "accepted", "rejected", "duplicate"]
+    assert "schema" in res.data["results"][2]["detail"]
+    assert WebhookEvent.objects.filter(aggregator_account=account).count() == 2
+
+@pytest.mark.django_db
+def test_batch_item_that_was_not_stored_is_rejected(client, account, monkeypatch):
+    from webhooks import views
+    insert_events = views.insert_events
+    monkeypatch.setattr(views, "insert_events",
+                        lambda events: {k: v for k, v in insert_events(events).items() if k[1] != "e2"})
+    res = _post(client, json.dumps([_item(1), _item(2)]).encode())
+    assert res.status_code == 200
+    assert [r["status"] for r in res.data["results"]] == ["accepted", "rejected"]
+    assert res.data["results"][1]["detail"] == "event could not be stored"
+    assert res.data["accepted"] == 1 and res.data["rejected"] == 1
+
+@pytest.mark.django_db
+def test_batch_rejects_bad_signature(client, account):
+    body = json.dumps([_item(1)]).encode()
+    url = reverse("payment-webhook-batch", kwargs={"provider":"SUREPAY"})
+    res = client.post(url, data=body, content_type="application/json",
+                      HTTP_X_SIGNATURE="nope", HTTP_X_SCHOOL_CODE="ng")
+    assert res.status_code == 400
+    assert not WebhookEvent.objects.exists()
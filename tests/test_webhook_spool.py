@@ -0,0 +1,130 @@
+import json, hmac, hashlib, pytest
+from django.db import IntegrityError, OperationalError
+from django.urls import reverse
+from schools.models import School
+from payments.models import AggregatorAccount, WebhookEvent, Payment
+from webhooks.spool import WebhookSpool, read_segment, get_spool
+
+@pytest.fixture
+def spool_dir(tmp_path, settings):
+    settings.WEBHOOK_SPOOL_DIR = str(tmp_path / "spool")
+    settings.WEBHOOK_SPOOL_SEGMENT_SECONDS = 0
+    yield tmp_path / "spool"
+    get_spool().close()
+
+def _post(client, payload):
+    body = json.dumps(payload).encode()
+    sig = hmac.new(b"sek", body, hashlib.sha256).hexdigest()
+    url = reverse("payment-webhook", kwargs={"provider":"SUREPAY"})
+    return client.post(url, data=body, content_type="application/json",
+                       HTTP_X_SIGNATURE=sig, HTTP_X_SCHOOL_CODE="ng")
+
+def test_segments_round_trip_and_torn_tail_is_dropped(tmp_path):
+    spool = WebhookSpool(tmp_path, segment_bytes=200, segment_seconds=0)
+    for n in range(5):
+        spool.append({"n": n, "pad": "x" * 60})
+    spool.close()
+    segments = spool.closed_segments()
+    assert len(segments) > 1  # rotated on size
+
+    with open(segments[-1], "ab") as fh:
+        fh.write(b"\x00\x00\x01\x00garbage")  # crash mid-append
+    seen = []
+    assert spool.drain(lambda batch: seen.extend(r["n"] for r in batch)) == 5
+    assert seen == [0, 1, 2, 3, 4]
+    assert spool.closed_segments() == []
+    assert spool.stats()["corrupt_records"] == 1
+
+def test_failed_drain_keeps_segment(tmp_path):
+    spool = WebhookSpool(tmp_path, segment_seconds=0)
+    spool.append({"n": 1})
+    spool.rotate()
+    def boom(batch):
+        raise OperationalError("db down")
+    with pytest.raises(OperationalError):
+        spool.drain(boom)
+    (segment,) = spool.closed_segments()
+    assert read_segment(segment) == ([{"n": 1}], 0)
+
+def test_refused_records_are_quarantined_not_retried(tmp_path):
+    spool = WebhookSpool(tmp_path, segment_seconds=0)
+    for n in range(4):
+        spool.append({"n": n})
+    spool.rotate()
+    loaded = []
+    def load(batch):
+        if any(r["n"] == 2 for r in batch):
+            raise IntegrityError("violates foreign key constraint")
+        loaded.extend(r["n"] for r in batch)
+    assert spool.drain(load, quarantine=(IntegrityError,)) == 3
+    assert loaded == [0, 1, 3] and spool.closed_segments() == []
+    (quarantined,) = tmp_path.glob("quarantine-*.log")
+    assert read_segment(quarantined) == ([{"n": 2}], 0)
+    assert spool.stats()["quarantined_records"] == 1
+
+def test_active_segment_is_not_drained(tmp_path):
+    spool = WebhookSpool(tmp_path, segment_seconds=0)
+    spool.append({"n": 1})
+    other = WebhookSpool(tmp_path)  # e.g. the drainer process
+    assert other.drain(lambda batch: None) == 0
+    spool.close()
+    assert other.drain(lambda batch: None) == 1
+
+@pytest.mark.django_db
+def test_fallback_spools_when_db_fails_then_drains(client, admin_client, settings, spool_dir, monkeypatch):
+    settings.WEBHOOK_SPOOL_MODE = "fallback"
+    school = School.objects.create(name="Northgreen", code="ng")
+    acct = AggregatorAccount.objects.create(school=school, provider="SUREPAY", webhook_secret="sek", is_active=True)
+
+    def db_down(*a, **kw):
+        raise OperationalError("could not connect")
+    monkeypatch.setattr(WebhookEvent.objects, "get_or_create", db_down)
+    payload = {"event_id":"e1","transaction_id":"t1","amount":1000,"currency":"UGX","status":"SUCCESS","student_id":"prov-001"}
+    res = _post(client, payload)
+    assert res.status_code == 200
+    assert res.data == {"status":"ok", "spooled": True}
+    assert not WebhookEvent.objects.exists()
+    monkeypatch.undo()
+
+    from django.core.management import call_command
+    from payments.tasks import process_webhook_events_batch
+    priorities, original = [], process_webhook_events_batch.apply_async
+    monkeypatch.setattr(process_webhook_events_batch, "apply_async",
+                        lambda kwargs, priority=None: (priorities.append(priority), original(kwargs=kwargs))[1])
+    get_spool().rotate()
+    call_command("drain_webhook_spool", "--once")
+    assert priorities == [settings.CELERY_BULK_PRIORITY]
+    ev = WebhookEvent.objects.get(aggregator_account=acct, event_id="e1")
+    assert ev.processed
+    assert Payment.objects.filter(external_txn_id="t1").exists()
+
+    assert client.get("/metrics/webhooks/").status_code == 403
+    metrics = admin_client.get("/metrics/webhooks/").json()
+    assert metrics["spool"]["drained_total"] == 1
+    assert metrics["spool"]["segments"] == 0
+
+@pytest.mark.django_db
+@pytest.mark.parametrize("name", ["payment-webhook", "payment-webhook-async", "payment-webhook-batch"])
+def test_account_lookup_failure_is_retried_not_spooled(client, settings, spool_dir, monkeypatch, name):
+    settings.WEBHOOK_SPOOL_MODE = "fallback"
+    def db_down(*a, **kw):
+        raise OperationalError("could not connect")
+    monkeypatch.setattr(AggregatorAccount.objects, "select_related", db_down)   # cold account cache, DB down
+    body = json.dumps({"event_id":"e1","transaction_id":"t1","amount":1000,"currency":"UGX","status":"SUCCESS",
+                       "student_id":"prov-001"}).encode()
+    res = client.post(reverse(name, kwargs={"provider":"SUREPAY"}), data=body, content_type="application/json",
+                      HTTP_X_SIGNATURE="forged", HTTP_X_SCHOOL_CODE="ng")
+    assert res.status_code == 503 and res["Retry-After"]
+    get_spool().rotate()
+    assert get_spool().closed_segments() == []     # nothing unverified reaches the spool
+
+def test_concurrent_appends_share_fsyncs(tmp_path):
+    import threading
+    spool = WebhookSpool(tmp_path, segment_seconds=0)
+    threads = [threading.Thread(target=lambda: [spool.append({"n": i}) for i in range(50)]) for _ in range(8)]
+    for t in threads: t.start()
+    for t in threads: t.join()
+    spool.close()
+    assert spool.appended == 400
+    assert spool.fsyncs <= 400
+    assert sum(len(read_segment(p)[0]) for p in spool.closed_segments()) == 400
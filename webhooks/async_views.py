@@ -0,0 +1,105 @@
+# webhooks/async_views.py
+import asyncio, json
+from concurrent.futures import ThreadPoolExecutor
+from django.conf import settings
+from django.db import InterfaceError, OperationalError
+from django.http import JsonResponse
+
+from payments.models import WebhookEvent
+from aggregators.factory import get_adapter_class
+from aggregators.schemas import to_compact
+from webhooks.validators import get_signature_header, get_timestamp_header, verify_hmac_with_timestamp
+from webhooks.cache import account_cache
+from webhooks.dedupe import get_seen_events
+from webhooks.views import RETRY_AFTER, UNAVAILABLE, _canonicalize
+from webhooks.ingest import dispatcher, spool_record
+from webhooks.spool import get_spool
+
+# Broker clients are blocking; publishes run here so a slow Redis can't stall the event loop
+_publish_pool: ThreadPoolExecutor | None = None
+
+def _get_publish_pool() -> ThreadPoolExecutor:
+    global _publish_pool
+    if _publish_pool is None:
+        _publish_pool = ThreadPoolExecutor(
+            max_workers=int(getattr(settings, "WEBHOOK_ASYNC_PUBLISH_THREADS", 16)),
+            thread_name_prefix="webhook-publish",
+        )
+    return _publish_pool
+
+async def _publish(event_id: int, school_id: int):
+    loop = asyncio.get_running_loop()
+    await loop.run_in_executor(_get_publish_pool(), dispatcher.add, event_id, school_id)
+
+async def _spool(record: dict):
+    loop = asyncio.get_running_loop()
+    await loop.run_in_executor(None, get_spool().append, record)
+
+async def payment_webhook_async(request, provider: str):
+    """
+    ASGI counterpart of webhooks.views.payment_webhook with the same checks and responses.
+    Account lookup and the idempotent insert use the async ORM; the Celery publish goes
+    through a bounded thread pool.
+    """
+    if request.method != "POST":
+        return JsonResponse({"detail":f'Method "{request.method}" not allowed.'}, status=405)
+    try:
+        body = request.body
+        payload = json.loads(body.decode("utf-8"))
+    except Exception:
+        return JsonResponse({"detail":"invalid json"}, status=400)
+
+    school_code = request.headers.get("X-School-Code")
+    if not school_code:
+        return JsonResponse({"detail":"missing school"}, status=400)
+
+    try:
+        account = await account_cache.aget(school_code, provider)
+    except (OperationalError, InterfaceError):
+        return JsonResponse(UNAVAILABLE, status=503, headers={"Retry-After": RETRY_AFTER})
+    if account is None:
+        return JsonResponse({"detail":f"no active {provider} account"}, status=404)
+
+    sig = get_signature_header(request)
+    ts  = get_timestamp_header(request)
+    if not verify_hmac_with_timestamp(account.webhook_secret or "", body, sig, ts):
+        return JsonResponse({"detail":"signature/timestamp invalid"}, status=400)
+
+    adapter = get_adapter_class(account.provider)(account)
+    canonical, error = _canonicalize(adapter, payload)
+    if error:
+        return JsonResponse({"detail": error}, status=400)
+
+    seen = get_seen_events()
+    if await seen.ais_processed(account.id, canonical["event_id"]):
+        return JsonResponse({"status":"ok", "idempotent": True})
+
+    spool_mode = getattr(settings, "WEBHOOK_SPOOL_MODE", "off")
+    if spool_mode == "always":
+        await _spool(spool_record(account, payload, sig, canonical, adapter.version))
+        return JsonResponse({"status":"ok", "spooled": True})
+
+    try:
+        event, created = await WebhookEvent.objects.aget_or_create(
+            aggregator_account=account,
+            event_id=canonical["event_id"],
+            defaults={
+                "provider": account.provider, "payload": payload, "signature": sig,
+                "canonical": to_compact(canonical), "adapter_version": adapter.version,
+            },
+        )
+    except (OperationalError, InterfaceError):
+        if spool_mode != "fallback":
+            raise
+        await _spool(spool_record(account, payload, sig, canonical, adapter.version))
+        return JsonResponse({"status":"ok", "spooled": True})
+    if not created and event.processed:
+        seen.mark_processed(account.id, event.event_id, broadcast=False)
+        return JsonResponse({"status":"ok", "idempotent": True})
+
+    await _publish(event.id, account.school_id)
+    return JsonResponse({"status":"ok"})
+
+# Providers can't send CSRF tokens; set the flag directly since Django 4.2's
+# csrf_exempt wrapper would hide that this view is a coroutine function.
+payment_webhook_async.csrf_exempt = True
@@ -0,0 +1,133 @@
+# webhooks/cache.py
+import threading, time
+from collections import OrderedDict
+from django.conf import settings
+from django.core.cache import cache as shared_cache
+from payments.models import AggregatorAccount
+
+GENERATION_KEY = "webhooks:account-cache:gen"
+
+class AccountCache:
+    """
+    Per-process TTL/LRU cache of active AggregatorAccount rows keyed by (school_code, provider).
+    Negative results (no active account) are cached as None. When WEBHOOK_ACCOUNT_CACHE_SHARED
+    is on, invalidations bump a generation counter in the shared cache so every worker drops
+    its local entries on the next lookup.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._entries: OrderedDict = OrderedDict()
+        self._local_gen = 0
+        self._shared_gen = None
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    def get(self, school_code: str, provider: str) -> AggregatorAccount | None:
+        key = (school_code, (provider or "").upper())
+        if _shared_enabled():
+            try:
+                self._apply_shared_generation(shared_cache.get(GENERATION_KEY))
+            except Exception:
+                pass
+        hit, account, gen = self._lookup(key)
+        if hit:
+            return account
+        account = _load_account(*key)
+        self._store(key, account, gen)
+        return account
+
+    async def aget(self, school_code: str, provider: str) -> AggregatorAccount | None:
+        """Same as get() for async views: the shared-cache read and DB load don't block the loop."""
+        key = (school_code, (provider or "").upper())
+        if _shared_enabled():
+            try:
+                self._apply_shared_generation(await shared_cache.aget(GENERATION_KEY))
+            except Exception:
+                pass
+        hit, account, gen = self._lookup(key)
+        if hit:
+            return account
+        try:
+            account = await (AggregatorAccount.objects.select_related("school")
+                             .aget(school__code=key[0], provider=key[1], is_active=True))
+        except AggregatorAccount.DoesNotExist:
+            account = None
+        self._store(key, account, gen)
+        return account
+
+    def _lookup(self, key) -> tuple[bool, AggregatorAccount | None, int]:
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] > now:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return True, entry[1], self._local_gen
+            self.misses += 1
+            return False, None, self._local_gen
+
+    def _store(self, key, account, gen: int):
+        ttl = float(getattr(settings, "WEBHOOK_ACCOUNT_CACHE_TTL", 60))
+        size = int(getattr(settings, "WEBHOOK_ACCOUNT_CACHE_SIZE", 1024))
+        with self._lock:
+            # an invalidation raced with the DB read; don't store what may be stale
+            if gen == self._local_gen and ttl > 0:
+                self._entries[key] = (time.monotonic() + ttl, account)
+                self._entries.move_to_end(key)
+                while len(self._entries) > size:
+                    self._entries.popitem(last=False)
+
+    def invalidate(self, broadcast: bool = True):
+        self._clear_local()
+        if broadcast and _shared_enabled():
+            try:
+                if not shared_cache.add(GENERATION_KEY, 1, None):
+                    shared_cache.incr(GENERATION_KEY)
+            except Exception:
+                pass  # local entries are gone; other workers fall back to TTL expiry
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._local_gen += 1
+            self._shared_gen = None
+            self.hits = self.misses = self.invalidations = 0
+
+    def stats(self) -> dict:
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "size": len(self._entries),
+                "hits": self.hits,
+                "misses": self.misses,
+                "invalidations": self.invalidations,
+                "hit_ratio": round(self.hits / total, 4) if total else 0.0,
+            }
+
+    def _clear_local(self):
+        with self._lock:
+            self._entries.clear()
+            self._local_gen += 1
+            self.invalidations += 1
+
+    def _apply_shared_generation(self, gen):
+        if gen != self._shared_gen:
+            if self._shared_gen is not None or self._entries:
+                self._clear_local()
+            self._shared_gen = gen
+
+def _shared_enabled() -> bool:
+    return bool(getattr(settings, "WEBHOOK_ACCOUNT_CACHE_SHARED", False))
+
+def _load_account(school_code: str, provider: str) -> AggregatorAccount | None:
+    try:
+        return (AggregatorAccount.objects.select_related("school")
+                .get(school__code=school_code, provider=provider, is_active=True))
+    except AggregatorAccount.DoesNotExist:
+        return None
+
+account_cache = AccountCache()
+
+def get_account(school_code: str, provider: str) -> AggregatorAccount | None:
+    return account_cache.get(school_code, provider)
@@ -0,0 +1,135 @@
+# webhooks/dedupe.py
+import threading
+from collections import OrderedDict
+from importlib import import_module
+from django.conf import settings
+from django.core.cache import cache as shared_cache
+
+KEY_PREFIX = "webhooks:seen"
+
+class SeenEventFilter:
+    """
+    Exact set of (aggregator_account_id, event_id) pairs known to be *processed*, so retried
+    deliveries can be answered as idempotent without a DB round-trip. A bounded LRU per
+    worker, optionally backed by the shared cache with a TTL. Only exact keys are stored
+    (no probabilistic structure) and pairs are added only after processing committed, so
+    a "processed" answer is never wrong; a miss just falls through to the database.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._keys: OrderedDict = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def is_processed(self, account_id: int, event_id: str) -> bool:
+        key = (account_id, event_id)
+        if self._local_hit(key):
+            return True
+        if _shared_enabled():
+            try:
+                found = shared_cache.get(_shared_key(key)) is not None
+            except Exception:
+                found = False
+            if found:
+                self._remember(key)
+                self._count(hit=True)
+                return True
+        self._count(hit=False)
+        return False
+
+    async def ais_processed(self, account_id: int, event_id: str) -> bool:
+        key = (account_id, event_id)
+        if self._local_hit(key):
+            return True
+        if _shared_enabled():
+            try:
+                found = await shared_cache.aget(_shared_key(key)) is not None
+            except Exception:
+                found = False
+            if found:
+                self._remember(key)
+                self._count(hit=True)
+                return True
+        self._count(hit=False)
+        return False
+
+    def processed_among(self, account_id: int, event_ids) -> set:
+        """Batch variant of is_processed: the subset of event_ids known to be processed."""
+        found = {eid for eid in event_ids if self._local_hit((account_id, eid), count=False)}
+        rest = [eid for eid in event_ids if eid not in found]
+        if rest and _shared_enabled():
+            try:
+                shared = shared_cache.get_many([_shared_key((account_id, eid)) for eid in rest])
+            except Exception:
+                shared = {}
+            for eid in rest:
+                if _shared_key((account_id, eid)) in shared:
+                    self._remember((account_id, eid))
+                    found.add(eid)
+        with self._lock:
+            self.hits += len(found)
+            self.misses += len(event_ids) - len(found)
+        return found
+
+    def mark_processed(self, account_id: int, event_id: str, broadcast: bool = True):
+        key = (account_id, event_id)
+        self._remember(key)
+        if broadcast and _shared_enabled():
+            try:
+                shared_cache.set(_shared_key(key), 1, int(getattr(settings, "WEBHOOK_SEEN_EVENTS_TTL", 7 * 86400)))
+            except Exception:
+                pass
+
+    def clear(self):
+        with self._lock:
+            self._keys.clear()
+            self.hits = self.misses = 0
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"size": len(self._keys), "hits": self.hits, "misses": self.misses}
+
+    def _local_hit(self, key, count: bool = True) -> bool:
+        with self._lock:
+            if key in self._keys:
+                self._keys.move_to_end(key)
+                if count:
+                    self.hits += 1
+                return True
+        return False
+
+    def _remember(self, key):
+        size = int(getattr(settings, "WEBHOOK_SEEN_EVENTS_SIZE", 100_000))
+        with self._lock:
+            self._keys[key] = None
+            self._keys.move_to_end(key)
+            while len(self._keys) > size:
+                self._keys.popitem(last=False)
+
+    def _count(self, hit: bool):
+        with self._lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+def _shared_enabled() -> bool:
+    return bool(getattr(settings, "WEBHOOK_SEEN_EVENTS_SHARED", False))
+
+def _shared_key(key) -> str:
+    return f"{KEY_PREFIX}:{key[0]}:{key[1]}"
+
+def _load_filter() -> SeenEventFilter:
+    dotted = getattr(settings, "WEBHOOK_SEEN_EVENTS_FILTER", None)
+    if not dotted:
+        return SeenEventFilter()
+    module_path, cls_name = dotted.rsplit(".", 1)
+    return getattr(import_module(module_path), cls_name)()
+
+_filter: SeenEventFilter | None = None
+
+def get_seen_events() -> SeenEventFilter:
+    global _filter
+    if _filter is None:
+        _filter = _load_filter()
+    return _filter
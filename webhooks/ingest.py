@@ -0,0 +1,175 @@
+# webhooks/ingest.py
+import atexit, logging, threading, time
+from collections import defaultdict
+from datetime import datetime
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.utils import timezone
+from aggregators.schemas import to_compact
+from payments.models import AggregatorAccount, PayloadBlob, WebhookEvent
+from payments.tasks import process_webhook_event_task, process_webhook_events_batch
+
+logger = logging.getLogger(__name__)
+
+def insert_events(events: list[WebhookEvent]) -> dict[tuple[int, str], tuple[int, bool]]:
+    """
+    Insert events in bulk, skipping ones already stored. Returns
+    {(aggregator_account_id, event_id): (id, processed)} for every input event.
+    """
+    if not events:
+        return {}
+    by_account = defaultdict(list)
+    for ev in events:
+        by_account[ev.aggregator_account_id].append(ev.event_id)
+    with transaction.atomic():
+        # on the partitioned table a duplicate trips the idempotency-key trigger instead of being
+        # skipped by ON CONFLICT, so events already stored (redeliveries) are left out up front
+        stored = _stored(by_account)
+        new = {}
+        for ev in events:
+            if (ev.aggregator_account_id, ev.event_id) not in stored:
+                new.setdefault((ev.aggregator_account_id, ev.event_id), ev)
+        if not new:
+            return stored
+        new = list(new.values())
+        PayloadBlob.objects.store_pending(new)
+        try:
+            with transaction.atomic():
+                WebhookEvent.objects.bulk_create(new, ignore_conflicts=True, batch_size=500)
+        except IntegrityError:
+            # a concurrent request stored one of them in the meantime
+            for ev in new:
+                try:
+                    with transaction.atomic():
+                        ev.save(force_insert=True)
+                except IntegrityError:
+                    pass
+        return _stored(by_account)
+
+def _stored(by_account: dict[int, list[str]]) -> dict[tuple[int, str], tuple[int, bool]]:
+    stored = {}
+    for account_id, event_ids in by_account.items():
+        for eid, pk, processed in (WebhookEvent.objects
+                                   .filter(aggregator_account_id=account_id, event_id__in=event_ids)
+                                   .values_list("event_id", "id", "processed")):
+            stored[(account_id, eid)] = (pk, processed)
+    return stored
+
+def dispatch_events(event_ids: list[int], school_id: int | None = None, priority: int | None = None):
+    """Publish processing in chunks of WEBHOOK_BATCH_DISPATCH_SIZE rather than one task per event."""
+    size = int(getattr(settings, "WEBHOOK_BATCH_DISPATCH_SIZE", 200))
+    for i in range(0, len(event_ids), size):
+        process_webhook_events_batch.apply_async(kwargs={"event_ids": event_ids[i:i + size], "school_id": school_id},
+                                                 priority=priority)
+
+def spool_record(account, payload: dict, sig: str | None, canonical: dict, adapter_version: str) -> dict:
+    """What the spool keeps for one verified webhook: enough to rebuild the WebhookEvent row."""
+    return {
+        "account_id": account.id, "provider": account.provider, "event_id": canonical["event_id"],
+        "payload": payload, "signature": sig,
+        "canonical": to_compact(canonical), "adapter_version": adapter_version,
+        "received_at": timezone.now().isoformat(),
+    }
+
+def load_spooled(records: list[dict]):
+    """Spool drain handler: insert the spooled events and dispatch the ones still unprocessed."""
+    events = [
+        WebhookEvent(
+            aggregator_account_id=r["account_id"], provider=r["provider"], event_id=r["event_id"],
+            payload=r["payload"], signature=r["signature"],
+            canonical=r["canonical"], adapter_version=r["adapter_version"],
+            received_at=datetime.fromisoformat(r["received_at"]),
+        )
+        for r in records
+    ]
+    stored = insert_events(events)
+    schools = dict(AggregatorAccount.objects.filter(id__in={r["account_id"] for r in records})
+                   .values_list("id", "school_id"))
+    by_school = defaultdict(set)
+    for (account_id, _), (pk, processed) in stored.items():
+        if not processed:
+            by_school[schools.get(account_id)].add(pk)
+    # a drained spool can be a large backlog: let live webhooks on the same shards go first
+    priority = int(getattr(settings, "CELERY_BULK_PRIORITY", 9))
+    for school_id, ids in by_school.items():
+        dispatch_events(sorted(ids), school_id, priority=priority)
+
+class EventDispatcher:
+    """
+    Micro-batches accepted event ids into process_webhook_events_batch publishes: a batch goes
+    out after WEBHOOK_DISPATCH_LINGER_MS or once WEBHOOK_DISPATCH_MAX_BATCH ids are buffered.
+    Ids are grouped per school so each batch lands on its school's queue. With a linger of 0
+    every event is published on its own. Ids still buffered when a process dies are never
+    published: their events stay processed=False in the database until the stuck-event sweeper
+    (payments.tasks.sweep_stuck_events) finds them WEBHOOK_SWEEP_AFTER_MINUTES later. Without
+    the sweeper running they are not processed at all.
+    """
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._ids: dict[int | None, list[int]] = defaultdict(list)
+        self._count = 0
+        self._deadline = 0.0
+        self._thread: threading.Thread | None = None
+        self.published_batches = 0
+
+    def add(self, event_id: int, school_id: int | None = None):
+        linger_ms = float(getattr(settings, "WEBHOOK_DISPATCH_LINGER_MS", 0))
+        if linger_ms <= 0:
+            process_webhook_event_task.delay(event_id=event_id, school_id=school_id)
+            return
+        max_batch = int(getattr(settings, "WEBHOOK_DISPATCH_MAX_BATCH", 100))
+        batch = None
+        with self._cond:
+            if not self._count:
+                self._deadline = time.monotonic() + linger_ms / 1000
+            self._ids[school_id].append(event_id)
+            self._count += 1
+            if self._count >= max_batch:
+                batch = self._take()
+            else:
+                self._ensure_thread()
+                self._cond.notify()
+        if batch:
+            self._publish(batch)
+
+    def flush(self):
+        with self._cond:
+            batch = self._take()
+        if batch:
+            self._publish(batch)
+
+    def _take(self) -> dict[int | None, list[int]]:
+        batch, self._ids, self._count = self._ids, defaultdict(list), 0
+        return batch
+
+    def _publish(self, batch: dict[int | None, list[int]]):
+        """Publish per school; what is left in `batch` if this raises was not published."""
+        for school_id, ids in list(batch.items()):
+            process_webhook_events_batch.delay(event_ids=ids, school_id=school_id)
+            del batch[school_id]
+            self.published_batches += 1
+
+    def _ensure_thread(self):
+        if self._thread is None or not self._thread.is_alive():
+            self._thread = threading.Thread(target=self._run, name="webhook-dispatch", daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._count:
+                    self._cond.wait()
+                remaining = self._deadline - time.monotonic()
+                if remaining > 0:
+                    self._cond.wait(remaining)
+                    continue
+                batch = self._take()
+            try:
+                self._publish(batch)
+            except Exception:
+                # broker hiccup: the events stay unprocessed in the DB for the sweeper
+                logger.warning("webhook dispatch failed, left to the stuck-event sweeper: event ids %s",
+                               sorted(i for ids in batch.values() for i in ids), exc_info=True)
+
+dispatcher = EventDispatcher()
+atexit.register(dispatcher.flush)
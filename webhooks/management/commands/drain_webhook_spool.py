@@ -0,0 +1,41 @@
+import time
+from django.core.management.base import BaseCommand
+from django.db import DatabaseError, IntegrityError, close_old_connections
+from webhooks.ingest import load_spooled
+from webhooks.spool import WebhookSpool, get_spool
+
+class Command(BaseCommand):
+    help = "Load spooled webhooks into WebhookEvent and enqueue processing (runs next to the web process)."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--once", action="store_true", help="Drain what is spooled now and exit.")
+        parser.add_argument("--interval", type=float, default=1.0, help="Seconds between drain passes.")
+        parser.add_argument("--batch-size", type=int, default=500)
+        parser.add_argument("--dir", action="append", dest="dirs", default=[],
+                            help="Drain this spool directory instead, e.g. a volume left behind by a "
+                                 "scaled-down pod (repeatable).")
+
+    def handle(self, *args, once=False, interval=1.0, batch_size=500, dirs=(), **opts):
+        spools = [WebhookSpool(d, segment_seconds=0) for d in dirs] or [get_spool()]
+        self.stdout.write(f"draining {', '.join(str(s.dir) for s in spools)}")
+        backoff = interval
+        while True:
+            close_old_connections()
+            try:
+                for spool in spools:
+                    # rows the database refuses (IntegrityError) would block the spool forever
+                    drained = spool.drain(load_spooled, batch_size=batch_size, quarantine=(IntegrityError,))
+                    if drained:
+                        self.stdout.write(f"drained {drained} events from {spool.dir}; {spool.stats()}")
+                backoff = interval
+            except DatabaseError as exc:
+                # DB still unhealthy: keep the segments and retry with backoff
+                self.stderr.write(f"drain failed, retrying in {backoff:.0f}s: {exc}")
+                if once:
+                    raise
+                time.sleep(backoff)
+                backoff = min(backoff * 2, 60)
+                continue
+            if once:
+                return
+            time.sleep(interval)
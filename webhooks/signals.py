@@ -0,0 +1,14 @@
+from django.db import transaction
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+from payments.models import AggregatorAccount
+from schools.models import School
+from webhooks.cache import account_cache
+
+@receiver([post_save, post_delete], sender=AggregatorAccount)
+@receiver([post_save, post_delete], sender=School)
+def invalidate_account_cache(sender, **kwargs):
+    # Writes to these tables are rare; dropping every entry keeps renamed school codes and
+    # newly activated accounts (cached as negatives) correct without tracking old keys. After
+    # commit, so a lookup racing the transaction can't cache the old row again.
+    transaction.on_commit(account_cache.invalidate)
@@ -0,0 +1,246 @@
+# webhooks/spool.py
+"""
+Local write-ahead spool for verified webhooks, used when the database is slow or down.
+
+Records are appended to segment files as  <len:u32><crc32:u32><json>  and fsync'd before the
+webhook is acknowledged. Concurrent appends share one fsync (group commit). The writer holds an
+exclusive flock on its active segment; any segment that can be flocked is closed (rotated, or
+left behind by a dead process) and is drained into WebhookEvent, then deleted. A torn record at
+the tail of a crashed segment fails its checksum and is dropped; it was never acknowledged.
+Records the database refuses outright are set aside in quarantine-*.log files (same framing)
+so they can't hold up the rest of the spool.
+"""
+import fcntl, json, os, struct, threading, time, zlib
+from pathlib import Path
+from django.conf import settings
+
+HEADER = struct.Struct(">II")
+SEGMENT_GLOB = "segment-*.log"
+QUARANTINE_GLOB = "quarantine-*.log"
+STATS_FILE = "drain-stats.json"
+
+class WebhookSpool:
+    def __init__(self, directory: str | os.PathLike, segment_bytes: int = 16 * 1024 * 1024,
+                 segment_seconds: float = 2.0):
+        self.dir = Path(directory)
+        self.segment_bytes = segment_bytes
+        self.segment_seconds = segment_seconds
+        self._write_lock = threading.Lock()
+        self._sync_lock = threading.Lock()
+        self._fd: int | None = None
+        self._path: Path | None = None
+        self._segment_no = 0
+        self._written = 0  # bytes written to the active segment
+        self._synced = 0   # bytes known to be on disk
+        self.appended = 0
+        self.fsyncs = 0
+
+    # --- writer -------------------------------------------------------------------------------
+
+    def append(self, record: dict):
+        data = json.dumps(record, separators=(",", ":")).encode()
+        frame = HEADER.pack(len(data), zlib.crc32(data)) + data
+        with self._write_lock:
+            if self._fd is None or self._written >= self.segment_bytes:
+                self._rotate_locked()
+            os.write(self._fd, frame)
+            self._written += len(frame)
+            segment, end = self._segment_no, self._written
+            self.appended += 1
+        self._sync(segment, end)
+
+    def rotate(self):
+        """Close the active segment so the drainer can pick it up."""
+        with self._write_lock:
+            self._close_locked()  # the next append opens a fresh segment
+
+    def close(self):
+        with self._write_lock:
+            self._close_locked()
+
+    def _sync(self, segment: int, end: int):
+        # Group commit: whoever takes the lock first fsyncs everything written so far, and the
+        # appends queued behind it find their bytes already durable. A rotated segment was
+        # fsync'd on close, under this same lock.
+        with self._sync_lock:
+            if segment != self._segment_no or self._synced >= end:
+                return
+            target = self._written
+            os.fsync(self._fd)
+            self._synced = target
+            self.fsyncs += 1
+
+    def _rotate_locked(self):
+        self._close_locked()
+        self.dir.mkdir(parents=True, exist_ok=True)
+        name = f"segment-{time.time_ns():020d}-{os.getpid()}"
+        # lock under a name the drainer doesn't list, then publish it with a rename
+        tmp = self.dir / f".{name}.new"
+        fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o600)
+        fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        path = self.dir / f"{name}.log"
+        os.rename(tmp, path)
+        _fsync_dir(self.dir)
+        with self._sync_lock:
+            self._fd, self._path, self._written, self._synced = fd, path, 0, 0
+        if self.segment_seconds > 0:
+            # hand quiet segments to the drainer without waiting for the size limit
+            timer = threading.Timer(self.segment_seconds, self._rotate_if_current, args=(self._segment_no,))
+            timer.daemon = True
+            timer.start()
+
+    def _rotate_if_current(self, segment: int):
+        with self._write_lock:
+            if self._segment_no == segment and self._fd is not None:
+                self._close_locked()
+
+    def _close_locked(self):
+        if self._fd is None:
+            return
+        with self._sync_lock:
+            os.fsync(self._fd)
+            fcntl.flock(self._fd, fcntl.LOCK_UN)
+            os.close(self._fd)
+            self._fd, self._path, self._written, self._synced = None, None, 0, 0
+            self._segment_no += 1
+
+    # --- reader / drainer ---------------------------------------------------------------------
+
+    def closed_segments(self) -> list[Path]:
+        active = self._path
+        return sorted(p for p in self.dir.glob(SEGMENT_GLOB) if p != active)
+
+    def drain(self, handle_batch, batch_size: int = 500, quarantine: tuple[type[Exception], ...] = ()) -> int:
+        """
+        Feed spooled records to handle_batch(list[dict]) in order, deleting each segment once all
+        of its records were handled. An exception from handle_batch leaves the segment in place
+        for the next run (records may be handed over again: at-least-once), except for the
+        `quarantine` exception types: the batch is retried record by record and the records
+        that still fail are moved to a quarantine file.
+        """
+        drained, started = 0, time.monotonic()
+        for path in self.closed_segments():
+            try:
+                fd = os.open(path, os.O_RDONLY)
+            except FileNotFoundError:
+                continue
+            try:
+                try:
+                    fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    continue  # still being written by a live process
+                records, corrupt = read_segment(path)
+                poisoned = []
+                for i in range(0, len(records), batch_size):
+                    batch = records[i:i + batch_size]
+                    try:
+                        handle_batch(batch)
+                    except quarantine:
+                        poisoned += _one_by_one(handle_batch, batch, quarantine)
+                if poisoned:
+                    _write_segment(self.dir / path.name.replace("segment-", "quarantine-", 1), poisoned)
+                drained += len(records) - len(poisoned)
+                path.unlink()
+                _fsync_dir(self.dir)
+                if corrupt or poisoned:
+                    self._bump_stats(corrupt=corrupt, quarantined=len(poisoned))
+            finally:
+                os.close(fd)
+        if drained:
+            self._bump_stats(drained=drained, seconds=time.monotonic() - started)
+        return drained
+
+    # --- metrics ------------------------------------------------------------------------------
+
+    def stats(self) -> dict:
+        sizes = [p.stat().st_size for p in self.dir.glob(SEGMENT_GLOB)] if self.dir.exists() else []
+        drain = self._read_stats()
+        return {
+            "segments": len(sizes),
+            "depth_bytes": sum(sizes),
+            "appended": self.appended,
+            "fsyncs": self.fsyncs,
+            "drained_total": drain.get("drained_total", 0),
+            "drain_rate_per_sec": drain.get("drain_rate_per_sec", 0.0),
+            "last_drain_at": drain.get("last_drain_at"),
+            "corrupt_records": drain.get("corrupt_records", 0),
+            "quarantined_records": drain.get("quarantined_records", 0),
+            "quarantine_files": len(list(self.dir.glob(QUARANTINE_GLOB))) if self.dir.exists() else 0,
+        }
+
+    def _read_stats(self) -> dict:
+        try:
+            return json.loads((self.dir / STATS_FILE).read_text())
+        except (FileNotFoundError, ValueError):
+            return {}
+
+    def _bump_stats(self, drained: int = 0, seconds: float = 0.0, corrupt: int = 0, quarantined: int = 0):
+        data = self._read_stats()
+        data["drained_total"] = data.get("drained_total", 0) + drained
+        data["corrupt_records"] = data.get("corrupt_records", 0) + corrupt
+        data["quarantined_records"] = data.get("quarantined_records", 0) + quarantined
+        if drained:
+            data["drain_rate_per_sec"] = round(drained / seconds, 1) if seconds > 0 else float(drained)
+            data["last_drain_at"] = time.time()
+        tmp = self.dir / (STATS_FILE + ".tmp")
+        tmp.write_text(json.dumps(data))
+        os.replace(tmp, self.dir / STATS_FILE)
+
+def read_segment(path: Path) -> tuple[list[dict], int]:
+    """Valid records of a segment, and 1 if a torn/corrupt record cut the read short (else 0)."""
+    records, corrupt = [], 0
+    data = path.read_bytes()
+    pos = 0
+    while pos < len(data):
+        if pos + HEADER.size > len(data):
+            corrupt += 1
+            break
+        length, crc = HEADER.unpack_from(data, pos)
+        body = data[pos + HEADER.size: pos + HEADER.size + length]
+        if len(body) != length or zlib.crc32(body) != crc:
+            corrupt += 1
+            break
+        records.append(json.loads(body))
+        pos += HEADER.size + length
+    return records, corrupt
+
+def _one_by_one(handle_batch, batch: list[dict], errors: tuple[type[Exception], ...]) -> list[dict]:
+    """Hand records over singly; returns the ones that still raise one of `errors`."""
+    failed = []
+    for record in batch:
+        try:
+            handle_batch([record])
+        except errors:
+            failed.append(record)
+    return failed
+
+def _write_segment(path: Path, records: list[dict]):
+    with open(path, "ab") as fh:
+        for record in records:
+            data = json.dumps(record, separators=(",", ":")).encode()
+            fh.write(HEADER.pack(len(data), zlib.crc32(data)) + data)
+        fh.flush()
+        os.fsync(fh.fileno())
+
+def _fsync_dir(path: Path):
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+_spool: WebhookSpool | None = None
+_spool_lock = threading.Lock()
+
+def get_spool() -> WebhookSpool:
+    global _spool
+    with _spool_lock:
+        if _spool is None or str(_spool.dir) != str(settings.WEBHOOK_SPOOL_DIR):
+            if _spool is not None:
+                _spool.close()
+            _spool = WebhookSpool(
+                settings.WEBHOOK_SPOOL_DIR,
+                segment_bytes=int(getattr(settings, "WEBHOOK_SPOOL_SEGMENT_BYTES", 16 * 1024 * 1024)),
+                segment_seconds=float(getattr(settings, "WEBHOOK_SPOOL_SEGMENT_SECONDS", 2.0)),
+            )
+        return _spool
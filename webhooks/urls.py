@@ -1,6 +1,9 @@
 from django.urls import path
-from .views import payment_webhook
+from .views import payment_webhook, payment_webhook_batch
+from .async_views import payment_webhook_async
 
 urlpatterns = [
     path("<str:provider>", payment_webhook, name="payment-webhook"),
+    path("<str:provider>/batch", payment_webhook_batch, name="payment-webhook-batch"),
+    path("<str:provider>/async", payment_webhook_async, name="payment-webhook-async"),
 ]
\ No newline at end of file
@@ -1,15 +1,48 @@
 import json
-from django.db import transaction
+from django.conf import settings
+from django.db import transaction, InterfaceError, OperationalError
 from rest_framework.decorators import api_view, permission_classes
-from rest_framework.permissions import AllowAny
+from rest_framework.permissions import AllowAny, IsAdminUser
 from rest_framework.response import Response
 from rest_framework import status
 from pydantic import ValidationError
 
-from payments.models import AggregatorAccount, WebhookEvent
+from payments.models import WebhookEvent
+from payments import transitions
 from aggregators.factory import get_adapter_class
+from aggregators.schemas import to_compact
 from webhooks.validators import get_signature_header, get_timestamp_header, verify_hmac_with_timestamp
-from payments.tasks import process_webhook_event_task
+from webhooks.cache import account_cache, get_account
+from webhooks.dedupe import get_seen_events
+from webhooks.ingest import insert_events, dispatch_events, dispatcher, spool_record
+from webhooks.spool import get_spool
+
+# Account lookups that fail on the database: without the account there is no secret to verify the
+# body against, and unverified bodies are never spooled, so the provider is asked to retry
+UNAVAILABLE = {"detail": "temporarily unavailable"}
+RETRY_AFTER = "30"
+
+def _canonicalize(adapter, payload) -> tuple[dict | None, str | None]:
+    """Validate one payload with the provider adapter -> (canonical, error detail)."""
+    if not isinstance(payload, dict):
+        return None, "payload must be an object"
+    try:
+        canonical = adapter.parse_webhook(payload)
+    except ValidationError as ve:
+        return None, f"schema invalid: {ve.errors()}"
+    if not (canonical.get("provider_student_id") or "").strip():
+        return None, "provider_student_id is required"
+    return canonical, None
+
+def _parse_batch(body: bytes, content_type: str) -> list:
+    """A JSON array, or NDJSON (one object per line, blank lines ignored)."""
+    text = body.decode("utf-8")
+    if "ndjson" not in content_type and text.lstrip().startswith("["):
+        items = json.loads(text)
+        if not isinstance(items, list):
+            raise ValueError("expected a JSON array")
+        return items
+    return [json.loads(line) for line in text.splitlines() if line.strip()]
 
 @api_view(["POST"])  
 @permission_classes([AllowAny])
@@ -25,9 +58,10 @@ def payment_webhook(request, provider: str):
         return Response({"detail":"missing school"}, status=status.HTTP_400_BAD_REQUEST)
 
     try:
-        account = (AggregatorAccount.objects.select_related("school")
-                   .get(school__code=school_code, provider=provider.upper(), is_active=True))
-    except AggregatorAccount.DoesNotExist:
+        account = get_account(school_code, provider)
+    except (OperationalError, InterfaceError):
+        return Response(UNAVAILABLE, status=status.HTTP_503_SERVICE_UNAVAILABLE, headers={"Retry-After": RETRY_AFTER})
+    if account is None:
         return Response({"detail":f"no active {provider} account"}, status=status.HTTP_404_NOT_FOUND)
 
     sig = get_signature_header(request)
@@ -35,22 +69,136 @@ def payment_webhook(request, provider: str):
     if not verify_hmac_with_timestamp(account.webhook_secret or "", body, sig, ts):
         return Response({"detail":"signature/timestamp invalid"}, status=status.HTTP_400_BAD_REQUEST)
 
+    adapter = get_adapter_class(account.provider)(account)
+    canonical, error = _canonicalize(adapter, payload)
+    if error:
+        return Response({"detail": error}, status=status.HTTP_400_BAD_REQUEST)
+
+    seen = get_seen_events()
+    if seen.is_processed(account.id, canonical["event_id"]):
+        return Response({"status":"ok", "idempotent": True})
+
+    spool_mode = getattr(settings, "WEBHOOK_SPOOL_MODE", "off")
+    if spool_mode == "always":
+        get_spool().append(spool_record(account, payload, sig, canonical, adapter.version))
+        return Response({"status":"ok", "spooled": True})
+
     try:
-        adapter = get_adapter_class(account.provider)(account)
-        canonical = adapter.parse_webhook(payload)
-    except ValidationError as ve:
-        return Response({"detail": f"schema invalid: {ve.errors()}"}, status=status.HTTP_400_BAD_REQUEST)
-    if not (canonical.get("provider_student_id") or "").strip():
-        return Response({"detail":"provider_student_id is required"}, status=status.HTTP_400_BAD_REQUEST)
-
-    with transaction.atomic():
-        event, created = WebhookEvent.objects.get_or_create(
-            aggregator_account=account,
-            event_id=canonical["event_id"],
-            defaults={"provider": account.provider, "payload": payload, "signature": sig},
-        )
-        if not created and event.processed:
-            return Response({"status":"ok", "idempotent": True})
-
-    process_webhook_event_task.delay(event_id=event.id)
-    return Response({"status":"ok"})
\ No newline at end of file
+        with transaction.atomic():
+            event, created = WebhookEvent.objects.get_or_create(
+                aggregator_account=account,
+                event_id=canonical["event_id"],
+                defaults={
+                    "provider": account.provider, "payload": payload, "signature": sig,
+                    "canonical": to_compact(canonical), "adapter_version": adapter.version,
+                },
+            )
+    except (OperationalError, InterfaceError):
+        if spool_mode != "fallback":
+            raise
+        # database unavailable: acknowledge from the durable spool, the drainer loads it later
+        get_spool().append(spool_record(account, payload, sig, canonical, adapter.version))
+        return Response({"status":"ok", "spooled": True})
+    if not created and event.processed:
+        seen.mark_processed(account.id, event.event_id, broadcast=False)
+        return Response({"status":"ok", "idempotent": True})
+
+    dispatcher.add(event.id, account.school_id)
+    return Response({"status":"ok"})
+
+@api_view(["POST"])
+@permission_classes([AllowAny])
+def payment_webhook_batch(request, provider: str):
+    """
+    Many events under one signature, as a JSON array or NDJSON stream. Each item is
+    validated on its own; valid ones are inserted in one statement and dispatched in chunks.
+    """
+    body = request.body
+    school_code = request.headers.get("X-School-Code")
+    if not school_code:
+        return Response({"detail":"missing school"}, status=status.HTTP_400_BAD_REQUEST)
+
+    try:
+        account = get_account(school_code, provider)
+    except (OperationalError, InterfaceError):
+        return Response(UNAVAILABLE, status=status.HTTP_503_SERVICE_UNAVAILABLE, headers={"Retry-After": RETRY_AFTER})
+    if account is None:
+        return Response({"detail":f"no active {provider} account"}, status=status.HTTP_404_NOT_FOUND)
+
+    sig = get_signature_header(request)
+    ts  = get_timestamp_header(request)
+    if not verify_hmac_with_timestamp(account.webhook_secret or "", body, sig, ts):
+        return Response({"detail":"signature/timestamp invalid"}, status=status.HTTP_400_BAD_REQUEST)
+
+    try:
+        items = _parse_batch(body, request.content_type or "")
+    except Exception:
+        return Response({"detail":"invalid json"}, status=status.HTTP_400_BAD_REQUEST)
+    max_items = int(getattr(settings, "WEBHOOK_BATCH_MAX_ITEMS", 10000))
+    if len(items) > max_items:
+        return Response({"detail":f"too many items (max {max_items})"}, status=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE)
+
+    adapter = get_adapter_class(account.provider)(account)
+    results, canonicals = [], []
+    for index, payload in enumerate(items):
+        canonical, error = _canonicalize(adapter, payload)
+        if error:
+            results.append({"index": index, "status": "rejected", "detail": error})
+            continue
+        results.append({"index": index, "event_id": canonical["event_id"]})
+        canonicals.append((canonical, payload))
+
+    seen = get_seen_events()
+    known = seen.processed_among(account.id, list({c["event_id"] for c, _ in canonicals}))
+    rows = {}
+    for canonical, payload in canonicals:
+        event_id = canonical["event_id"]
+        if event_id in known:
+            continue
+        rows.setdefault(event_id, WebhookEvent(
+            aggregator_account=account, provider=account.provider, event_id=event_id,
+            payload=payload, signature=sig,
+            canonical=to_compact(canonical), adapter_version=adapter.version,
+        ))
+
+    stored = insert_events(list(rows.values()))
+
+    to_dispatch, handled = [], set()
+    for r in results:
+        if "event_id" not in r:
+            continue
+        event_id = r["event_id"]
+        if event_id in known:
+            r["status"] = "duplicate"
+            continue
+        entry = stored.get((account.id, event_id))
+        if entry is None:  # neither inserted nor found (e.g. archived meanwhile): the sender can resend it
+            r.update(status="rejected", detail="event could not be stored")
+            continue
+        pk, processed = entry
+        if processed:
+            seen.mark_processed(account.id, event_id, broadcast=False)
+        if processed or event_id in handled:
+            r["status"] = "duplicate"
+        else:
+            r["status"] = "accepted"
+            to_dispatch.append(pk)
+        handled.add(event_id)
+
+    dispatch_events(to_dispatch, account.school_id)
+
+    counts = {k: sum(1 for r in results if r["status"] == k) for k in ("accepted", "duplicate", "rejected")}
+    return Response({"status":"ok", **counts, "results": results})
+
+
+@api_view(["GET"])
+@permission_classes([IsAdminUser])  # staff only: cache, spool and rejection stats are internal
+def webhook_metrics(request):
+    data = {
+        "account_cache": account_cache.stats(),
+        "seen_events": get_seen_events().stats(),
+        "rejected_status_events": transitions.stats(),
+    }
+    if getattr(settings, "WEBHOOK_SPOOL_MODE", "off") != "off":
+        data["spool"] = get_spool().stats()
+    return Response(data)